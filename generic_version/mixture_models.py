@@ -14,6 +14,7 @@ from utils_linear_units import *
 from utils_rnn_units import *
 from utils_training import *
 from utils_optimization import *
+from utils_profiling import *
 
 # reproducibility by fixing the random seed
 #np.random.seed(1)
@@ -32,10 +33,17 @@ class mixture_statistic():
         '''
         self.sess = session
         self.para_train = para_train
+        # index in the graph collections, > 0 for the chains of multi-chain sampling,
+        # also offsets the random seed of the rnn initializers and dropout of each chain
+        self.collection_idx = 0
                 
     def network_ini(self, 
-                    hyper_para):
+                    hyper_para,
+                    placeholders = None):
         '''
+        Argu.:
+          placeholders: None, or [x, y, keep_prob] of another model in the same graph to share the inputs
+        
         Dictionary of abbreviation:
            nllk: negative log likelihood
            hetero: heteroskedasticity
@@ -59,20 +67,25 @@ class mixture_statistic():
         
         # ----- ini
         # placeholders
-        # y: [B 1]
-        self.y = tf.placeholder(tf.float32,
-                                [None, self.para_train['y_dim']],
-                                name = 'y')
-        # x: [S, [B T D]]
-        self.x = []
-        for i in range(self.para_train['para_num_source']):
-            self.x.append(tf.placeholder(tf.float32,
-                                         [None, self.para_train['x_steps'][i], self.para_train['x_dims'][i]],
-                                         name = 'x' + str(i)))
-        if self.para_train['para_model_type'] == "rnn":
-            self.keep_prob = tf.placeholder(tf.float32,
-                                            shape = (),
-                                            name = 'keep_prob')
+        if placeholders != None:
+            self.x, self.y, self.keep_prob = placeholders
+        else:
+            # y: [B 1]
+            self.y = tf.placeholder(tf.float32,
+                                    [None, self.para_train['y_dim']],
+                                    name = 'y')
+            # x: [S, [B T D]]
+            self.x = []
+            for i in range(self.para_train['para_num_source']):
+                self.x.append(tf.placeholder(tf.float32,
+                                             [None, self.para_train['x_steps'][i], self.para_train['x_dims'][i]],
+                                             name = 'x' + str(i)))
+            self.keep_prob = None
+            if self.para_train['para_model_type'] == "rnn":
+                self.keep_prob = tf.placeholder(tf.float32,
+                                                shape = (),
+                                                name = 'keep_prob')
+        self.placeholders = [self.x, self.y, self.keep_prob]
         # ---------- tempory
         self.y_normalizer = tf.slice(self.y, [0, 1,], [-1, 1])
         self.y_desea = tf.slice(self.y, [0, 2,], [-1, -1])
@@ -87,7 +100,56 @@ class mixture_statistic():
                 self.pre_x.append(tf.slice(self.x[i], [0, 0, 0], [-1, x_steps[i]-1, -1]))
                 self.cur_x.append(tf.slice(self.x[i], [0, 1, 0], [-1, x_steps[i]-1, -1]))
         '''
-        if self.para_train['para_model_type'] == "linear":
+        # two-level gate over the source groups, []: flat gating
+        # only the sources of the top-m groups of each instance are evaluated
+        self.gate_groups = self.para_train['para_gate_groups']
+        if len(self.gate_groups) > 0 and sorted([i for tmp_group in self.gate_groups for i in tmp_group]) != list(range(self.para_train['para_num_source'])):
+            print("\n --- GATE GROUP ERROR ---- \n")
+        if len(self.gate_groups) > 0 and (self.para_train['para_model_type'] != "linear" or self.para_train['para_add_common_factor'] == True or self.para_train['para_share_type_gate'] != "no_share"):
+            raise ValueError("para_gate_groups is only supported with the linear model, without para_add_common_factor and para_share_type_gate: %s, %s, %s"%(self.para_train['para_model_type'], 
+                                                                                                                                                       self.para_train['para_add_common_factor'], 
+                                                                                                                                                       self.para_train['para_share_type_gate']))
+        if len(self.gate_groups) > 0 and (self.para_train['para_gate_group_topk'] <= 0 or self.para_train['para_gate_group_topk'] > len(self.gate_groups)):
+            raise ValueError("para_gate_group_topk should be in [1, number of groups = %d]: %d"%(len(self.gate_groups), 
+                                                                                               self.para_train['para_gate_group_topk']))
+        
+        # sparse gating on the top-k sources of each instance, 0: dense gating
+        if self.para_train['para_gate_topk'] < 0 or self.para_train['para_gate_topk'] > self.para_train['para_num_source']:
+            raise ValueError("para_gate_topk should be in [0, para_num_source = %d]: %d"%(self.para_train['para_num_source'], 
+                                                                                      self.para_train['para_gate_topk']))
+        self.gate_topk = self.para_train['para_gate_topk'] if 0 < self.para_train['para_gate_topk'] < self.para_train['para_num_source'] and len(self.gate_groups) == 0 else 0
+        # the sparse heads have no common factor and no shared gate logits
+        if self.gate_topk > 0 and (self.para_train['para_add_common_factor'] == True or self.para_train['para_share_type_gate'] != "no_share"):
+            raise ValueError("para_gate_topk is not supported with para_add_common_factor or para_share_type_gate: %s, %s"%(self.para_train['para_add_common_factor'], 
+                                                                                                                          self.para_train['para_share_type_gate']))
+        # the low-rank bilinear heads have no common factor and no mixed gate sharing
+        if self.para_train['para_model_type'] == "bilinear" and (self.para_train['para_add_common_factor'] == True or self.para_train['para_share_type_gate'] not in ["no_share", "share"]):
+            raise ValueError("para_model_type bilinear is not supported with para_add_common_factor or para_share_type_gate: %s, %s"%(self.para_train['para_add_common_factor'], 
+                                                                                                                                   self.para_train['para_share_type_gate']))
+        
+        if self.para_train['para_model_type'] == "linear" and len(self.gate_groups) > 0:
+            #[S B]                                                           [G B]            [B G]
+            tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_gate, tmp_group_logit, regu_group, group_mask = multi_src_predictor_linear_group(x = self.x,
+                                                                                                                                                  n_src = self.para_train['para_num_source'],
+                                                                                                                                                  steps = self.para_train['x_steps'],
+                                                                                                                                                  dims = self.para_train['x_dims'],
+                                                                                                                                                  groups = self.gate_groups,
+                                                                                                                                                  group_topk = self.para_train['para_gate_group_topk'],
+                                                                                                                                                  bool_bias = [self.para_train['para_bool_bias_in_mean'], self.para_train['para_bool_bias_in_var'], self.para_train['para_bool_bias_in_gate']],
+                                                                                                                                                  bool_scope_reuse= [False, False, False],
+                                                                                                                                                  str_scope = "linear")
+            regu_gate += regu_group
+        elif self.para_train['para_model_type'] == "linear" and self.gate_topk > 0:
+            #[S B]
+            tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_gate = multi_src_predictor_linear_topk(x = self.x,
+                                                                                                           n_src = self.para_train['para_num_source'],
+                                                                                                           steps = self.para_train['x_steps'],
+                                                                                                           dims = self.para_train['x_dims'],
+                                                                                                           bool_bias = [self.para_train['para_bool_bias_in_mean'], self.para_train['para_bool_bias_in_var'], self.para_train['para_bool_bias_in_gate']],
+                                                                                                           bool_scope_reuse= [False, False, False],
+                                                                                                           str_scope = "linear",
+                                                                                                           top_k = self.gate_topk)
+        elif self.para_train['para_model_type'] == "linear":
             #[S B]
             tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_gate = multi_src_predictor_linear(x = self.x,
                                                                                                       n_src = self.para_train['para_num_source'],
@@ -99,6 +161,17 @@ class mixture_statistic():
                                                                                                       para_share_logit = self.para_train['para_share_type_gate'],
                                                                                                       bool_common_factor = self.para_train['para_add_common_factor'],
                                                                                                       common_factor_dim = 0)
+        elif self.para_train['para_model_type'] == "bilinear":
+            #[S B]
+            tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_gate = multi_src_predictor_bilinear(x = self.x,
+                                                                                                        n_src = self.para_train['para_num_source'],
+                                                                                                        steps = self.para_train['x_steps'],
+                                                                                                        dims = self.para_train['x_dims'],
+                                                                                                        bool_bias = [self.para_train['para_bool_bias_in_mean'], self.para_train['para_bool_bias_in_var'], self.para_train['para_bool_bias_in_gate']],
+                                                                                                        bool_scope_reuse= [False, False, False],
+                                                                                                        str_scope = "bilinear",
+                                                                                                        para_share_logit = self.para_train['para_share_type_gate'],
+                                                                                                        rank = int(self.hyper_para['bilinear_rank']))
         elif self.para_train['para_model_type'] == "rnn":
             #[S B]
             tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_gate = multi_src_predictor_rnn(x = self.x,
@@ -110,7 +183,11 @@ class mixture_statistic():
                                                                                                    rnn_cell_type = "lstm",
                                                                                                    dropout_keep = self.hyper_para['dropout_keep_prob'],
                                                                                                    dense_num = int(self.hyper_para['dense_num']),
-                                                                                                   max_norm_cons = self.hyper_para['max_norm_cons'])
+                                                                                                   max_norm_cons = self.hyper_para['max_norm_cons'],
+                                                                                                   steps = self.para_train['x_steps'],
+                                                                                                   dims = self.para_train['x_dims'],
+                                                                                                   encoder_type = self.para_train['para_rnn_encoder'],
+                                                                                                   seed = 1 + self.collection_idx)
         # ----- individual means and variance
         
         # -- mean
@@ -132,8 +209,68 @@ class mixture_statistic():
         # ----- gates
         # [B S]
         gate_logits = tf.transpose(tmp_logit, [1, 0])
-        # gate probability
-        self.gate_src = tf.nn.softmax(gate_logits, axis = -1)
+        # dense gate probability
+        gate_dense = tf.nn.softmax(gate_logits, axis = -1)
+        
+        # probability and routing mask of the load balancing
+        balance_prob = gate_dense
+        
+        if len(self.gate_groups) > 0:
+            # p(s) = p(g) * p(s|g), g: the group of source s, on the top-m groups of each instance
+            num_group = len(self.gate_groups)
+            # [S]
+            src_group = np.zeros(self.para_train['para_num_source'], dtype = np.int32)
+            for tmp_idx, tmp_group in enumerate(self.gate_groups):
+                src_group[tmp_group] = tmp_idx
+            
+            # -- group-level gate
+            # [B G]
+            group_logits = tf.transpose(tmp_group_logit, [1, 0])
+            # group probability renormalized on the top-m groups, zero on the others
+            self.gate_group = tf.nn.softmax(group_logits - 1e9*(1.0 - group_mask), axis = -1)
+            
+            # -- within-group gates
+            # softmax over the sources of each group, [S B]
+            # the logits of the groups not selected are zero and their group probability is zero
+            tmp_logit_max = tf.gather(tf.unsorted_segment_max(tmp_logit, src_group, num_group), src_group)
+            tmp_exp_logit = tf.exp(tmp_logit - tf.stop_gradient(tmp_logit_max))
+            gate_within = tmp_exp_logit/tf.gather(tf.unsorted_segment_sum(tmp_exp_logit, src_group, num_group), src_group)
+            
+            # [S B] * [S B] -> [B S]
+            self.gate_src = tf.transpose(gate_within*tf.gather(tf.transpose(self.gate_group, [1, 0]), src_group), [1, 0])
+            
+            # [B S]
+            gate_mask = tf.gather(group_mask, src_group, axis = 1)
+            # unit inverse variance on the sources not selected, so that the zero-gated terms stay finite
+            inv_var_stack = gate_mask*inv_var_stack + (1.0 - gate_mask)
+            
+            # balanced across groups, the only gate computed on all of them
+            balance_prob = tf.nn.softmax(group_logits, axis = -1)
+            balance_mask = group_mask
+            
+        elif self.gate_topk > 0:
+            # [B k]
+            _, topk_idx = tf.nn.top_k(gate_logits, 
+                                      k = self.gate_topk)
+            # [B S]
+            gate_mask = tf.reduce_sum(tf.one_hot(topk_idx, self.para_train['para_num_source']), 1)
+            # gate probability renormalized on the top-k sources, zero on the others
+            self.gate_src = tf.nn.softmax(gate_logits - 1e9*(1.0 - gate_mask), axis = -1)
+            # unit inverse variance on the sources not selected, so that the zero-gated terms stay finite
+            inv_var_stack = gate_mask*inv_var_stack + (1.0 - gate_mask)
+            balance_mask = gate_mask
+        else:
+            gate_mask = tf.ones_like(gate_logits)
+            # gate probability
+            self.gate_src = gate_dense
+            balance_mask = gate_mask
+        
+        # -- load balancing across sources, or across groups
+        # fraction of instances routed to each source and mean dense gate probability, [S] or [G]
+        route_frac = tf.reduce_mean(balance_mask, 0)/tf.reduce_sum(tf.reduce_mean(balance_mask, 0))
+        prob_frac = tf.reduce_mean(balance_prob, 0)
+        # minimized at the uniform routing
+        self.regu_gate_balance = (len(self.gate_groups) if len(self.gate_groups) > 0 else self.para_train['para_num_source'])*tf.reduce_sum(tf.stop_gradient(route_frac)*prob_frac)
         
         # ----- mixture mean, variance and nllk
         
@@ -332,26 +469,74 @@ class mixture_statistic():
         # nnllk        
         elif self.para_train['para_loss_type'] in ['heter_lk', 'heter_lk_inv', 'homo_lk_inv']:
             
-            self.loss = self.nnllk_loss
-            self.monitor = [self.loss]
+            # regularization terms, kept apart for the distillation loss
+            self.regu_loss = 0.0
+            self.monitor = [self.nnllk_loss]
             
             if self.para_train['para_regu_mean'] == True:
-                self.loss += ( self.hyper_para["l2_mean"]*self.regu_mean )
+                self.regu_loss += ( self.hyper_para["l2_mean"]*self.regu_mean )
                 self.monitor.append(self.hyper_para["l2_mean"]*self.regu_mean)
                 
             if self.para_train['para_regu_var'] == True:
-                self.loss += (self.hyper_para["l2_var"]*self.regu_var)
+                self.regu_loss += (self.hyper_para["l2_var"]*self.regu_var)
                 self.monitor.append(self.hyper_para["l2_var"]*self.regu_var)
                 
             if self.para_train['para_regu_gate'] == True:
-                self.loss += (self.hyper_para["l2_gate"]*self.regu_gate)
+                self.regu_loss += (self.hyper_para["l2_gate"]*self.regu_gate)
                 self.monitor.append((self.hyper_para["l2_gate"]*self.regu_gate))
                 
+            if self.para_train['para_regu_gate_balance'] == True:
+                self.regu_loss += (self.hyper_para["lambda_gate_balance"]*self.regu_gate_balance)
+                self.monitor.append((self.hyper_para["lambda_gate_balance"]*self.regu_gate_balance))
+            
+            self.loss = self.nnllk_loss + self.regu_loss
+                
         # self.gates [B S]
         #         self.monitor.append(tf.slice(self.gate_src, [0, 0], [3, -1]))
         
+    #   replace the likelihood loss by the distance to the predictive distribution of a teacher ensemble
+    def distillation_ini(self):
+        '''
+        Call after network_ini and before train_ini, 
+        the teacher targets are fed to the placeholder "teacher" in train_batch, 
+        and in inference for the monitor metric.
+        
+        teacher: [B 2+S], predictive mean, total variance and gates of the teacher
+        '''
+        if self.para_train['para_loss_type'] not in ['heter_lk', 'heter_lk_inv', 'homo_lk_inv']:
+            print("\n --- DISTILLATION ERROR ---- \n")
+            return
+        
+        self.teacher = tf.placeholder(tf.float32,
+                                      [None, 2 + self.para_train['para_num_source']],
+                                      name = 'teacher')
+        # [B 1] [B 1] [B S]
+        teacher_mean = tf.slice(self.teacher, [0, 0], [-1, 1])
+        teacher_var = tf.slice(self.teacher, [0, 1], [-1, 1])
+        teacher_gate = tf.slice(self.teacher, [0, 2], [-1, -1])
+        
+        # KL( N(teacher_mean, teacher_var) || N(py_mean, py_var) ) on the moments of the two mixtures
+        student_var = self.py_var + 1e-5
+        teacher_var = teacher_var + 1e-5
+        self.distill_kl = tf.reduce_mean(0.5*(tf.log(student_var) - tf.log(teacher_var) + (teacher_var + tf.square(teacher_mean - self.py_mean))/student_var - 1.0))
+        
+        # cross entropy of the gates
+        self.distill_gate = tf.reduce_mean(-1.0*tf.reduce_sum(teacher_gate*tf.log(self.gate_src + 1e-5), -1))
+        
+        self.loss = self.distill_kl + self.para_train['para_distill_lambda_gate']*self.distill_gate + self.regu_loss
+        self.monitor = [self.distill_kl, self.para_train['para_distill_lambda_gate']*self.distill_gate] + self.monitor[1:]
+        
+        return
+    
     #   initialize loss and optimization operations for training
-    def train_ini(self):
+    def train_ini(self,
+                  loss = None):
+        '''
+        Argu.:
+          loss: None for self.loss, or the summed loss of the chains of multi-chain sampling
+        '''
+        if loss == None:
+            loss = self.loss
         
         # ----- learning rate set-up
         tf_lr_ini = tf.constant(value = self.hyper_para["lr"], 
@@ -391,6 +576,20 @@ class mixture_statistic():
                                 tf.float32)        
             optimizer_lr = ((1.0-is_warmup)*optimizer_lr + is_warmup*warmup_learning_rate)
         
+        # -- cyclical, replaces the decay and warm-up
+        # ref: "Cyclical Stochastic Gradient MCMC for Bayesian Deep Learning", https://arxiv.org/abs/1902.03932
+        # scale of the injected noise, 0 in the exploration phase of each cycle
+        noise_scale = 1.0
+        
+        if self.para_train['para_lr_cycle_num'] > 0:
+            
+            cycle_steps = int(np.ceil(self.para_train['para_n_epoch']*int(np.ceil(self.para_train['tr_num_ins']/int(self.hyper_para["batch_size"])))/self.para_train['para_lr_cycle_num']))
+            # position in the current cycle, [0, 1)
+            cycle_percent_done = tf.cast(tf.mod(global_step, cycle_steps), tf.float32)/cycle_steps
+            
+            optimizer_lr = 0.5*tf_lr_ini*(tf.cos(np.pi*cycle_percent_done) + 1.0)
+            noise_scale = tf.cast(cycle_percent_done >= self.para_train['para_lr_cycle_explore_ratio'], tf.float32)
+        
         # ----- optimizer
         
         # -- conventional 
@@ -416,6 +615,13 @@ class mixture_statistic():
                                                             learning_rate = optimizer_lr)
         # -- SG-MCMC
         # stochastic gradient Monto-Carlo Markov Chain
+        # flat-buffer samplers: one packed update over all trainable variables, 
+        # also used by the cyclical schedule to switch off the noise in the exploration phase
+        elif self.para_train['para_optimizer'] in ['sg_mcmc_adam', 'sg_mcmc_adam_revision', 'sg_mcmc_RMSprop', 'sgld'] and (self.para_train['para_sg_mcmc_flat'] == True or self.para_train['para_lr_cycle_num'] > 0):
+            train_optimizer = flat_sg_mcmc(learning_rate = optimizer_lr,
+                                           method = self.para_train['para_optimizer'],
+                                           noise_scale = noise_scale)
+            
         elif self.para_train['para_optimizer'] == 'sg_mcmc_adam':
             train_optimizer = sg_mcmc_adam(learning_rate = optimizer_lr)
             
@@ -427,13 +633,31 @@ class mixture_statistic():
             
         elif self.para_train['para_optimizer'] == 'sgld':
             train_optimizer = StochasticGradientLangevinDynamics(learning_rate = optimizer_lr)
-            
+        
+        # -- full-batch quasi-Newton
+        # each call of train_batch on the full training data runs para_lbfgs_iter iterations, i.e., one epoch
+        # the line search needs a deterministic objective, so no dropout, i.e., linear models only
+        elif self.para_train['para_optimizer'] == 'lbfgs':
+            if self.para_train['para_model_type'] != "linear":
+                raise ValueError("para_optimizer lbfgs is only supported with para_model_type linear: %s"%(self.para_train['para_model_type']))
+            train_optimizer = tf.contrib.opt.ScipyOptimizerInterface(loss,
+                                                                     method = 'L-BFGS-B',
+                                                                     options = {'maxiter': self.para_train['para_lbfgs_iter']})
+            # one global step per L-BFGS iteration
+            self.global_step_incr = tf.assign_add(global_step, 1)
+        # -- expectation-maximization
+        # the updates are computed in NumPy by utils_em.mixture_linear_em and loaded into the graph
+        elif self.para_train['para_optimizer'] == 'em':
+            train_optimizer = None
         else:
             print("\n --- OPTIMIZER ERROR ---- \n")
         
         # -- training operation
-        self.train_op = train_optimizer.minimize(self.loss,
-                                                 global_step = global_step)
+        if self.para_train['para_optimizer'] in ['lbfgs', 'em']:
+            self.train_op = train_optimizer
+        else:
+            self.train_op = train_optimizer.minimize(loss,
+                                                     global_step = global_step)
         # -- initialize the graph
         self.init = tf.global_variables_initializer()
         self.sess.run(self.init)
@@ -441,9 +665,16 @@ class mixture_statistic():
     #   training on batch of data
     def train_batch(self, 
                     x, 
-                    y,):
+                    y,
+                    teacher = None):
+        '''
+        Argu.:
+          teacher: None, or [B 2+S] teacher targets of distillation_ini
+        '''
         data_dict = {}
         data_dict["y:0"] = y
+        if teacher is not None:
+            data_dict["teacher:0"] = teacher
         
         # x: [S, [B T D]]
         for i in range(len(x)):
@@ -452,8 +683,14 @@ class mixture_statistic():
             data_dict["keep_prob:0"] = self.hyper_para['dropout_keep_prob']
         
         # update the paramters
-        _ = self.sess.run(self.train_op,
-                          feed_dict = data_dict)
+        if self.para_train['para_optimizer'] == 'lbfgs':
+            # loss and gradients computed in the graph, updates in scipy
+            self.train_op.minimize(self.sess,
+                                   feed_dict = data_dict,
+                                   step_callback = lambda tmp_x: self.sess.run(self.global_step_incr))
+        else:
+            _ = self.sess.run(self.train_op,
+                              feed_dict = data_dict)
         return
     
     def inference_ini(self):
@@ -487,41 +724,51 @@ class mixture_statistic():
         tf.add_to_collection("py_mean_src", self.py_mean_src)
         tf.add_to_collection("py_var_src", self.py_var_src)
         tf.add_to_collection("py_lk", self.lk)
+        if len(self.gate_groups) > 0:
+            tf.add_to_collection("py_gate_group", self.gate_group)
         
     # infer given testing data
     def inference(self, 
                   x, 
                   y,
-                  bool_instance_eval):
+                  bool_instance_eval,
+                  teacher = None):
         '''
         Argu.:
           x: [S [B T D]]
           y: [B 1]
+          teacher: None, or [B 2+S] teacher targets of distillation_ini, 
+                   required for the monitor metric of a student when bool_instance_eval = False
         '''
         # --
-        data_dict = {}
-        data_dict['y:0'] = y
-        for i in range(len(x)):
-            data_dict["x" + str(i) + ":0"] = x[i]
-        if self.para_train['para_model_type'] == "rnn":
-            data_dict["keep_prob:0"] = 1.0
+        with profiler.stage("inference_feed", num_ins = len(y)):
+            data_dict = {}
+            data_dict['y:0'] = y
+            if teacher is not None:
+                data_dict["teacher:0"] = teacher
+            for i in range(len(x)):
+                data_dict["x" + str(i) + ":0"] = x[i]
+            if self.para_train['para_model_type'] == "rnn":
+                data_dict["keep_prob:0"] = 1.0
             
         # error metric
-        rmse, mae, mape, nnllk = self.sess.run([tf.get_collection('rmse')[0],
-                                                tf.get_collection('mae')[0],
-                                                tf.get_collection('mape')[0],
-                                                tf.get_collection('nnllk')[0]],
-                                               feed_dict = data_dict)
+        with profiler.stage("inference_run_metric", num_ins = len(y)):
+            rmse, mae, mape, nnllk = self.sess.run([tf.get_collection('rmse')[self.collection_idx],
+                                                    tf.get_collection('mae')[self.collection_idx],
+                                                    tf.get_collection('mape')[self.collection_idx],
+                                                    tf.get_collection('nnllk')[self.collection_idx]],
+                                                   feed_dict = data_dict)
         # predictions
         if bool_instance_eval == True:
             # [B 1]  [B 1]   [B S]
-            py_mean, py_var, py_gate_src, py_mean_src, py_var_src, py_lk = self.sess.run([tf.get_collection('py_mean')[0],
-                                                                                          tf.get_collection('py_var')[0],
-                                                                                          tf.get_collection('py_gate_src')[0],
-                                                                                          tf.get_collection('py_mean_src')[0],
-                                                                                          tf.get_collection('py_var_src')[0], 
-                                                                                          tf.get_collection('py_lk')[0],],
-                                                                                         feed_dict = data_dict)
+            with profiler.stage("inference_run_py", num_ins = len(y)):
+                py_mean, py_var, py_gate_src, py_mean_src, py_var_src, py_lk = self.sess.run([tf.get_collection('py_mean')[self.collection_idx],
+                                                                                              tf.get_collection('py_var')[self.collection_idx],
+                                                                                              tf.get_collection('py_gate_src')[self.collection_idx],
+                                                                                              tf.get_collection('py_mean_src')[self.collection_idx],
+                                                                                              tf.get_collection('py_var_src')[self.collection_idx], 
+                                                                                              tf.get_collection('py_lk')[self.collection_idx],],
+                                                                                             feed_dict = data_dict)
             # error metric tuple [rmse, mae, mape, nnllk], py tuple []
             return [rmse, mae, mape, nnllk], [py_mean, py_var, py_mean_src, py_var_src, py_gate_src, py_lk], []
         else:
@@ -533,7 +780,7 @@ class mixture_statistic():
             py_lk = None
             
             # monitor metric
-            monitor_metric = self.sess.run([tf.get_collection(str(tmp_idx))[0] for tmp_idx in range(len(self.monitor))],
+            monitor_metric = self.sess.run([tf.get_collection(str(tmp_idx))[self.collection_idx] for tmp_idx in range(len(self.monitor))],
                                        feed_dict = data_dict)
             # error metric tuple [rmse, mae, mape, nnllk], py tuple []
             return [rmse, mae, mape, nnllk], [py_mean, py_var, py_mean_src, py_var_src, py_gate_src, py_lk], monitor_metric
@@ -17,6 +17,8 @@ from tensorflow.contrib import rnn
 from utils_training import *
 from utils_inference import *
 from mixture_models import *
+from utils_profiling import *
+from utils_em import *
 
 def prepare_data(para_train):
     
@@ -132,9 +134,16 @@ def train_validate_process(xtr,
                         retrain_bayes_steps,
                         retrain_bool,
                         retrain_iter_idx,
-                        random_seed):
+                        random_seed,
+                        step_reservoir = None,
+                        xts = None,
+                        yts = None,
+                        py_store = None):
     '''
     Argu.:
+      py_store: None, or prediction_store recording the predictions on (xts, yts) of the saved epochs
+      step_reservoir: None, or step_sample_reservoir filled with batch-step samples, 
+                      weights or the predictions on step_reservoir.eval_x by para_train['para_step_sample_type']
       xtr: [num_src, N, T, D]
          S: num_src
          N: number of data samples
@@ -188,6 +197,12 @@ def train_validate_process(xtr,
                                 y = ytr,
                                 batch_size = int(hyper_para["batch_size"]), 
                                 num_src = int(para_train['para_num_source']))
+        # -- EM updates in NumPy, loaded into the graph each epoch
+        if para_train['para_optimizer'] == 'em':
+            em = mixture_linear_em(para_train,
+                                   hyper_para)
+            em.fit_ini(xtr,
+                       ytr)
         # -- begin training
         
         # training and validation error log
@@ -195,21 +210,47 @@ def train_validate_process(xtr,
         
         # training time counter
         st_time = time.time()
+        # batch step counter
+        train_step = 0
         
         for epoch in range(para_train['para_n_epoch']):
             
-            # shuffle traning instances each epoch
-            batch_gen.re_shuffle()
-            batch_x, batch_y, bool_last = batch_gen.one_batch()
-            
-            # - loop over all batches
-            while batch_x != None:
-                # one-step training on a batch of training data
-                model.train_batch(batch_x, 
-                                  batch_y,)                
-                # next batch
+            if para_train['para_optimizer'] == 'lbfgs':
+                # - one epoch-equivalent of full-batch iterations
+                model.train_batch(xtr,
+                                  ytr,)
+            elif para_train['para_optimizer'] == 'em':
+                # - one EM iteration over the full training data
+                em.iterate()
+                em_weights_load(em.export(),
+                                sess)
+            else:
+                # shuffle traning instances each epoch
+                batch_gen.re_shuffle()
                 batch_x, batch_y, bool_last = batch_gen.one_batch()
                 
+                # - loop over all batches
+                while batch_x != None:
+                    # one-step training on a batch of training data
+                    model.train_batch(batch_x, 
+                                      batch_y,)                
+                    train_step += 1
+                    
+                    # step-level samples
+                    if step_reservoir != None and step_reservoir.bool_collect(train_step):
+                        if para_train['para_step_sample_type'] == "weights":
+                            step_reservoir.names = [tmp_var.name for tmp_var in tf.trainable_variables()]
+                            step_reservoir.add(train_step, 
+                                               sess.run(tf.trainable_variables()))
+                        else:
+                            _, tmp_py, _ = model.inference(step_reservoir.eval_x,
+                                                           step_reservoir.eval_y,
+                                                           bool_instance_eval = True)
+                            step_reservoir.add(train_step,
+                                               tmp_py)
+                    # next batch
+                    batch_x, batch_y, bool_last = batch_gen.one_batch()
+                
             # - epoch-wise validating
             val_metric, _, monitor_metric = model.inference(xval,
                                                             yval,
@@ -239,6 +280,15 @@ def train_validate_process(xtr,
             if retrain_bool == True and model_saver_flag != None:
                 print("\n    [MODEL SAVED] " + model_saver_flag + " \n " + para_train['path_model'] + para_train['para_model_type'] + '_' + str(retrain_iter_idx) + '_' + str(epoch))
                 
+                # online test predictions of the saved epoch
+                if py_store != None:
+                    _, tmp_py, _ = model.inference(xts,
+                                                   yts,
+                                                   bool_instance_eval = True)
+                    py_store.write(retrain_iter_idx, 
+                                   epoch, 
+                                   tmp_py)
+                
         ed_time = time.time()
         
     # sort step_error based on para_validation_metric
@@ -248,17 +298,191 @@ def train_validate_process(xtr,
            1.0*(ed_time - st_time)/(epoch + 1e-5),\
 
 # ------
+
+def train_validate_process_chains(xtr,
+                                  ytr,
+                                  xval,
+                                  yval,
+                                  hyper_para,
+                                  para_train,
+                                  retrain_top_steps, 
+                                  retrain_bayes_steps,
+                                  retrain_iter_idx,
+                                  random_seed,
+                                  xts = None,
+                                  yts = None,
+                                  py_store = None):
+    '''
+    Multi-chain SG-MCMC: para_train['para_sg_mcmc_chains'] chains of the model in one graph, 
+    sampled in parallel on the same minibatches, with independent noise per chain.
+    
+    The snapshots of chain c are saved under the retrain id str(retrain_iter_idx) + "c" + str(c), 
+    with the meta graph and variable names of a single model, so that test_process restores them as usual.
+    
+    Return:
+      [C [sort_step_error, chain retrain id]], training time per epoch
+    '''
+    # the chains are sampled by minibatch updates in the graph
+    if para_train['para_optimizer'] in ['lbfgs', 'em']:
+        raise ValueError("para_optimizer is not supported with para_sg_mcmc_chains: %s"%(para_train['para_optimizer']))
+    
+    num_chain = para_train['para_sg_mcmc_chains']
+    chain_ids = [str(retrain_iter_idx) + "c" + str(tmp_chain) for tmp_chain in range(num_chain)]
+    
+    # -- meta graph of a single model, shared by the snapshots of all chains
+    template_graph = tf.Graph()
+    with template_graph.as_default():
+        
+        template_model = mixture_statistic(session = tf.Session(),
+                                           para_train = para_train)
+        template_model.network_ini(hyper_para = hyper_para)
+        template_saver = tf.train.Saver(max_to_keep = None)
+        template_model.train_ini()
+        template_model.inference_ini()
+        template_model.sess.close()
+    
+    tf.reset_default_graph()
+    
+    with tf.device('/device:GPU:0'):
+        
+        # fix the random seed to stabilize the network
+        os.environ['PYTHONHASHSEED'] = str(random_seed)
+        random.seed(random_seed)
+        np.random.seed(random_seed)
+        tf.set_random_seed(random_seed)
+        
+        # session set-up
+        config = tf.ConfigProto()
+        config.allow_soft_placement = True
+        config.gpu_options.allow_growth = True
+        sess = tf.Session(config = config)
+        
+        # -- chains
+        # chain 0 owns the placeholders and the variable names of a single model
+        models = []
+        chain_savers = []
+        
+        for tmp_chain in range(num_chain):
+            
+            tmp_vari_pre = set(tf.global_variables())
+            
+            with tf.variable_scope("chain_" + str(tmp_chain) if tmp_chain > 0 else tf.get_variable_scope()):
+                model = mixture_statistic(session = sess,
+                                          para_train = para_train)
+                # set before network_ini, the chains start from different weights and dropout masks
+                model.collection_idx = tmp_chain
+                model.network_ini(hyper_para = hyper_para,
+                                  placeholders = None if tmp_chain == 0 else models[0].placeholders)
+            models.append(model)
+            
+            # variables of this chain under the names of a single model
+            tmp_prefix = "chain_" + str(tmp_chain) + "/"
+            chain_savers.append(tf.train.Saver({tmp_var.op.name[len(tmp_prefix):] if tmp_chain > 0 else tmp_var.op.name: tmp_var for tmp_var in tf.global_variables() if tmp_var not in tmp_vari_pre}, 
+                                               max_to_keep = None))
+        
+        # one sampler over the variables of all chains
+        models[0].train_ini(loss = tf.add_n([tmp_model.loss for tmp_model in models]))
+        for tmp_model in models:
+            tmp_model.inference_ini()
+        
+        # -- set up training batch parameters
+        batch_gen = data_loader(x = xtr,
+                                y = ytr,
+                                batch_size = int(hyper_para["batch_size"]), 
+                                num_src = int(para_train['para_num_source']))
+        # -- begin training
+        
+        # training and validation error log per chain
+        step_error = [[] for _ in range(num_chain)]
+        bool_nan = [False]*num_chain
+        
+        # training time counter
+        st_time = time.time()
+        
+        for epoch in range(para_train['para_n_epoch']):
+            
+            # shuffle traning instances each epoch
+            batch_gen.re_shuffle()
+            batch_x, batch_y, bool_last = batch_gen.one_batch()
+            
+            # - loop over all batches, all chains in one step
+            while batch_x != None:
+                models[0].train_batch(batch_x, 
+                                      batch_y,)                
+                batch_x, batch_y, bool_last = batch_gen.one_batch()
+            
+            for tmp_chain, tmp_model in enumerate(models):
+                
+                if bool_nan[tmp_chain] == True:
+                    continue
+                
+                # - epoch-wise validating
+                val_metric, _, monitor_metric = tmp_model.inference(xval,
+                                                                    yval,
+                                                                    bool_instance_eval = False)
+                tr_metric, _, _ = tmp_model.inference(xtr,
+                                                      ytr,
+                                                      bool_instance_eval = False)
+                # NAN value exception 
+                if np.isnan(monitor_metric[0]) == True:
+                    print("\n --- NAN loss at chain %d !! \n"%(tmp_chain))
+                    bool_nan[tmp_chain] = True
+                    continue
+                
+                step_error[tmp_chain].append([epoch, tr_metric, val_metric])
+                
+                # - model saver
+                tmp_path = para_train['path_model'] + para_train['para_model_type'] + '_' + chain_ids[tmp_chain] + '_' + str(epoch)
+                if epoch in retrain_top_steps or epoch in retrain_bayes_steps:
+                    chain_savers[tmp_chain].save(sess, 
+                                                 tmp_path,
+                                                 write_meta_graph = False)
+                    with template_graph.as_default():
+                        template_saver.export_meta_graph(tmp_path + '.meta')
+                    
+                    print("\n    [MODEL SAVED] chain " + str(tmp_chain) + " \n " + tmp_path)
+                    
+                    # online test predictions of the saved epoch
+                    if py_store != None:
+                        _, tmp_py, _ = tmp_model.inference(xts,
+                                                           yts,
+                                                           bool_instance_eval = True)
+                        py_store.write(chain_ids[tmp_chain], 
+                                       epoch, 
+                                       tmp_py)
+                
+                print("\n --- At epoch %d chain %d : \n  %s "%(epoch, tmp_chain, str(step_error[tmp_chain][-1])))
+            
+            if all(bool_nan) == True:
+                break
+            
+        ed_time = time.time()
+    
+    # sort step_error based on para_validation_metric
+    return [[sorted(tmp_step_error, key = lambda x:x[2][para_train['para_metric_map'][para_train['para_validation_metric']]]), tmp_id] for tmp_step_error, tmp_id in zip(step_error, chain_ids) if len(tmp_step_error) != 0],\
+           1.0*(ed_time - st_time)/(epoch + 1e-5),\
+
+# ------
     
 def test_process(retrain_snapshots,
                  retrain_ids,
                  xts,
                  yts,
                  snapshot_features, 
-                 para_train):
-    
+                 para_train,
+                 py_store = None,
+                 snapshot_weights = []):
+    '''
+    Argu.:
+      py_store: None, or prediction_store, the snapshots recorded in it are read instead of restored
+      snapshot_weights: empty for uniform, or weights of the snapshots in the order of retrain_ids and retrain_snapshots
+    '''
     # ensemble of model snapshots
     infer = ensemble_inference()
     
+    # stage-wise latency, off by default
+    profiler.enabled = para_train['para_profile_bool']
+    
     with tf.device('/device:GPU:0'):
         
         config = tf.ConfigProto()
@@ -269,6 +493,18 @@ def test_process(retrain_snapshots,
             
             for tmp_model_id in retrain_snapshots[tmp_idx]:
                 
+                # predictions recorded during re-training
+                if py_store != None and py_store.bool_has(tmp_retrain_id, tmp_model_id):
+                    py_tuple = py_store.read(tmp_retrain_id, 
+                                             tmp_model_id)
+                    infer.add_samples(py_mean = py_tuple[0],
+                                      py_var = py_tuple[1],
+                                      py_mean_src = py_tuple[2],
+                                      py_var_src = py_tuple[3],
+                                      py_gate_src = py_tuple[4],
+                                      py_lk = py_tuple[5])
+                    continue
+                
                 # path of the stored models 
                 tmp_meta = para_train['path_model'] + para_train['para_model_type'] + '_' + str(tmp_retrain_id) + '_' + str(tmp_model_id) + '.meta'
                 tmp_data = para_train['path_model'] + para_train['para_model_type'] + '_' + str(tmp_retrain_id) + '_' + str(tmp_model_id)
@@ -277,14 +513,15 @@ def test_process(retrain_snapshots,
                 tf.reset_default_graph()
                 
                 # restore the model
-                saver = tf.train.import_meta_graph(tmp_meta, 
-                                                   clear_devices = True)
-                sess = tf.Session(config = config)
-                
-                model = mixture_statistic(session = sess,
-                                          para_train = para_train)
-                model.model_restore(tmp_data, 
-                                    saver)
+                with profiler.stage("snapshot_restore"):
+                    saver = tf.train.import_meta_graph(tmp_meta, 
+                                                       clear_devices = True)
+                    sess = tf.Session(config = config)
+                    
+                    model = mixture_statistic(session = sess,
+                                              para_train = para_train)
+                    model.model_restore(tmp_data, 
+                                        saver)
                 # one-shot inference
                 error_tuple, py_tuple, _ = model.inference(xts,
                                                         yts, 
@@ -303,11 +540,381 @@ def test_process(retrain_snapshots,
         return ["None"], ["None"]  
     else:
         # ensemble inference
-        if len(snapshot_features) == 0 or num_snapshots == 1:
-            return infer.bayesian_inference(yts)
-        else:
-            return infer.importance_inference(snapshot_features = snapshot_features, 
-                                              y = yts)
+        with profiler.stage("ensemble_aggregation", num_ins = len(yts)):
+            if len(snapshot_features) == 0 or num_snapshots == 1:
+                error_tuple, py_tuple = infer.bayesian_inference(yts,
+                                                                 chunk_size = para_train['para_eval_chunk_size'],
+                                                                 weights = snapshot_weights if len(snapshot_weights) != 0 else None)
+            else:
+                error_tuple, py_tuple = infer.importance_inference(snapshot_features = snapshot_features, 
+                                                                   y = yts,
+                                                                   chunk_size = para_train['para_eval_chunk_size'])
+        if profiler.enabled == True:
+            profiler.dump(para_train['path_profile'])
+            
+        return error_tuple, py_tuple
+
+def snapshot_inference(retrain_id,
+                       model_id,
+                       x,
+                       y,
+                       para_train):
+    '''
+    Restore one snapshot and predict on (x, y).
+    
+    Return:
+      [py_mean, py_var, py_mean_src, py_var_src, py_gate_src, py_lk]
+    '''
+    config = tf.ConfigProto()
+    config.allow_soft_placement = True
+    config.gpu_options.allow_growth = True
+    
+    tmp_data = para_train['path_model'] + para_train['para_model_type'] + '_' + str(retrain_id) + '_' + str(model_id)
+    
+    tf.reset_default_graph()
+    saver = tf.train.import_meta_graph(tmp_data + '.meta', 
+                                       clear_devices = True)
+    sess = tf.Session(config = config)
+    model = mixture_statistic(session = sess,
+                              para_train = para_train)
+    model.model_restore(tmp_data, 
+                        saver)
+    _, py_tuple, _ = model.inference(x,
+                                     y, 
+                                     bool_instance_eval = True)
+    sess.close()
+    
+    return py_tuple
+
+def validation_predictions(retrain_snapshots,
+                           retrain_ids,
+                           xval,
+                           yval,
+                           para_train,
+                           val_py_cache):
+    '''
+    Fill val_py_cache with the validation predictions of the members not yet in it.
+    
+    Return:
+      members: [(retrain_id, epoch)], in the order of test_process
+    '''
+    members = []
+    for tmp_idx, tmp_retrain_id in enumerate(retrain_ids):
+        for tmp_model_id in retrain_snapshots[tmp_idx]:
+            
+            if (tmp_retrain_id, tmp_model_id) not in val_py_cache:
+                val_py_cache[(tmp_retrain_id, tmp_model_id)] = snapshot_inference(tmp_retrain_id,
+                                                                                  tmp_model_id,
+                                                                                  xval,
+                                                                                  yval,
+                                                                                  para_train)
+            members.append((tmp_retrain_id, tmp_model_id))
+    
+    return members
+
+def stacking_weight_process(retrain_snapshots,
+                            retrain_ids,
+                            xval,
+                            yval,
+                            para_train,
+                            val_py_cache):
+    '''
+    Return:
+      weights of the members maximizing the validation likelihood of the weighted mixture, in the order of test_process
+    '''
+    members = validation_predictions(retrain_snapshots,
+                                     retrain_ids,
+                                     xval,
+                                     yval,
+                                     para_train,
+                                     val_py_cache)
+    # [A B]
+    lk_sample = [np.reshape(val_py_cache[tmp_member][5], [-1]) for tmp_member in members]
+    
+    return list(stacking_weights(lk_sample))
+
+def ensemble_pruning_process(retrain_snapshots,
+                             retrain_ids,
+                             xval,
+                             yval,
+                             para_train,
+                             val_py_cache):
+    '''
+    Greedy ensemble pruning on the validation predictions of the members.
+    
+    Argu.:
+      retrain_snapshots, retrain_ids: as test_process
+      val_py_cache: dictionary {(retrain_id, epoch): py_tuple}, validation predictions shared across ensembles
+    Return:
+      pruned retrain_snapshots, retrain_ids, and the weights of the members in the order of test_process
+    '''
+    members = validation_predictions(retrain_snapshots,
+                                     retrain_ids,
+                                     xval,
+                                     yval,
+                                     para_train,
+                                     val_py_cache)
+    # [A B]
+    m_sample = [np.reshape(val_py_cache[tmp_member][0], [-1]) for tmp_member in members]
+    lk_sample = [np.reshape(val_py_cache[tmp_member][5], [-1]) for tmp_member in members]
+    
+    selected_idx, selected_weights, scores = greedy_ensemble_selection(m_sample,
+                                                                       lk_sample,
+                                                                       yval,
+                                                                       metric = para_train['para_ensemble_prune_metric'],
+                                                                       max_size = para_train['para_ensemble_prune_size'])
+    
+    print('\n----- Ensemble pruning: ', len(selected_idx), '/', len(members), ' members, validation ', para_train['para_ensemble_prune_metric'], scores[-1], '\n')
+    
+    # grouped by retrain ids
+    pruned_ids = []
+    pruned_snapshots = []
+    pruned_weights = []
+    for tmp_idx, tmp_weight in zip(selected_idx, selected_weights):
+        tmp_retrain_id, tmp_model_id = members[tmp_idx]
+        if tmp_retrain_id not in pruned_ids:
+            pruned_ids.append(tmp_retrain_id)
+            pruned_snapshots.append([])
+            pruned_weights.append([])
+        pruned_snapshots[pruned_ids.index(tmp_retrain_id)].append(tmp_model_id)
+        pruned_weights[pruned_ids.index(tmp_retrain_id)].append(tmp_weight)
+    
+    return pruned_snapshots, pruned_ids, [w for tmp_w in pruned_weights for w in tmp_w]
+
+def snapshot_diagnostic_process(retrain_id,
+                                snapshots,
+                                snapshots_features,
+                                xval,
+                                yval,
+                                para_train,
+                                val_py_cache):
+    '''
+    Prune redundant snapshots by the ESS or the pairwise disagreement of their predicted means on the validation data.
+    
+    Argu.:
+      snapshots: [A], epochs of the snapshots
+      val_py_cache: dictionary {(retrain_id, epoch): py_tuple}, validation predictions shared across ensembles
+    Return:
+      selected snapshots and features, in the order of the epochs
+    '''
+    # in the order of training
+    tmp_order = np.argsort(snapshots)
+    snapshots = [snapshots[i] for i in tmp_order]
+    snapshots_features = [snapshots_features[i] for i in tmp_order]
+    
+    if len(snapshots) <= 1:
+        return snapshots, snapshots_features
+    
+    members = validation_predictions([snapshots],
+                                     [retrain_id],
+                                     xval,
+                                     yval,
+                                     para_train,
+                                     val_py_cache)
+    # [A B]
+    m_sample = [np.reshape(val_py_cache[tmp_member][0], [-1]) for tmp_member in members]
+    
+    selected_idx, ess = snapshot_subset_selection(np.asarray(m_sample),
+                                                  target_ess = para_train['para_snapshot_ess_target'],
+                                                  target_diversity = para_train['para_snapshot_diversity_target'])
+    
+    print('\n----- Snapshot ESS: ', ess, ' selected snapshots: ', len(selected_idx), '/', len(snapshots), '\n')
+    
+    return [snapshots[i] for i in selected_idx], [snapshots_features[i] for i in selected_idx]
+
+def teacher_targets(retrain_snapshots,
+                    retrain_ids,
+                    snapshot_weights,
+                    x,
+                    y,
+                    para_train):
+    '''
+    Predictive mean, total variance and gates of the teacher ensemble on (x, y).
+    
+    Return:
+      teacher: [N 2+S], fed to the placeholder "teacher" of distillation_ini
+    '''
+    # [A N 1] [A N 1] [A N S]
+    teacher_mean, teacher_var, teacher_gate = [], [], []
+    for tmp_idx, tmp_retrain_id in enumerate(retrain_ids):
+        for tmp_model_id in retrain_snapshots[tmp_idx]:
+            
+            py_tuple = snapshot_inference(tmp_retrain_id,
+                                          tmp_model_id,
+                                          x,
+                                          y,
+                                          para_train)
+            teacher_mean.append(py_tuple[0])
+            teacher_var.append(py_tuple[1])
+            teacher_gate.append(py_tuple[4])
+    
+    # [N] [N] [N] [N] [N S] [N S]
+    bayes_mean, bayes_var_total, _, _, bayes_gate_src, _ = bayesian_ensemble_moments(np.asarray(teacher_mean),
+                                                                                     np.asarray(teacher_var),
+                                                                                     np.asarray(teacher_gate),
+                                                                                     weights = snapshot_weights if len(snapshot_weights) != 0 else None)
+    # [N 2+S]
+    return np.concatenate([bayes_mean[:, None], bayes_var_total[:, None], bayes_gate_src], -1)
+
+def distillation_process(retrain_snapshots,
+                         retrain_ids,
+                         snapshot_weights,
+                         xtr,
+                         ytr,
+                         xval,
+                         yval,
+                         hyper_para,
+                         para_train,
+                         random_seed = 1):
+    '''
+    Train one student mixture_statistic on the predictive mean, total variance and gates 
+    of the teacher ensemble on the training data.
+    
+    Argu.:
+      retrain_snapshots, retrain_ids, snapshot_weights: the teacher ensemble, as test_process
+    Return:
+      epoch of the student snapshot with the best validation error, 
+      saved as the snapshot of the retrain id "distill"
+    '''
+    # -- teacher predictions, computed once for all epochs
+    # the validation targets feed the distillation terms of the monitor metric
+    teacher = teacher_targets(retrain_snapshots,
+                              retrain_ids,
+                              snapshot_weights,
+                              xtr,
+                              ytr,
+                              para_train)
+    teacher_val = teacher_targets(retrain_snapshots,
+                                  retrain_ids,
+                                  snapshot_weights,
+                                  xval,
+                                  yval,
+                                  para_train)
+    y_dim = np.shape(ytr)[1]
+    
+    # -- student
+    tf.reset_default_graph()
+    
+    with tf.device('/device:GPU:0'):
+        
+        os.environ['PYTHONHASHSEED'] = str(random_seed)
+        random.seed(random_seed)
+        np.random.seed(random_seed)
+        tf.set_random_seed(random_seed)
+        
+        config = tf.ConfigProto()
+        config.allow_soft_placement = True
+        config.gpu_options.allow_growth = True
+        sess = tf.Session(config = config)
+        
+        model = mixture_statistic(session = sess,
+                                  para_train = para_train)        
+        model.network_ini(hyper_para = hyper_para)
+        model.distillation_ini()
+        
+        # !! the order of Saver
+        saver = tf.train.Saver(max_to_keep = None)
+        
+        model.train_ini()
+        model.inference_ini()
+        
+        # the teacher targets are batched together with y
+        batch_gen = data_loader(x = xtr,
+                                y = np.concatenate([ytr, teacher], -1),
+                                batch_size = int(hyper_para["batch_size"]), 
+                                num_src = int(para_train['para_num_source']))
+        
+        metric_idx = para_train['para_metric_map'][para_train['para_validation_metric']]
+        best_epoch = None
+        best_val_metric = np.inf
+        
+        for epoch in range(para_train['para_distill_epoch']):
+            
+            batch_gen.re_shuffle()
+            batch_x, batch_y, bool_last = batch_gen.one_batch()
+            
+            while batch_x != None:
+                model.train_batch(batch_x, 
+                                  batch_y[:, :y_dim],
+                                  teacher = batch_y[:, y_dim:])
+                batch_x, batch_y, bool_last = batch_gen.one_batch()
+            
+            val_metric, _, monitor_metric = model.inference(xval,
+                                                            yval,
+                                                            bool_instance_eval = False,
+                                                            teacher = teacher_val)
+            print("\n --- Distillation at epoch %d : \n  %s \n"%(epoch, str(val_metric)), monitor_metric)
+            
+            if np.isnan(monitor_metric[0]) == True:
+                print("\n --- NAN loss !! \n" )
+                break
+            
+            if val_metric[metric_idx] < best_val_metric:
+                best_val_metric = val_metric[metric_idx]
+                best_epoch = epoch
+                saver.save(sess, 
+                           para_train['path_model'] + para_train['para_model_type'] + '_distill_' + str(epoch))
+        sess.close()
+        
+    return best_epoch
+
+def step_sample_test_process(step_reservoirs,
+                             xts,
+                             yts,
+                             hyper_para,
+                             para_train):
+    '''
+    Ensemble of the batch-step samples in memory, without checkpoints.
+    
+    Argu.:
+      step_reservoirs: [R], step_sample_reservoir of each retrain, 
+                       predictions on (xts, yts) or weights by para_train['para_step_sample_type']
+    '''
+    infer = ensemble_inference()
+    
+    if para_train['para_step_sample_type'] == "weights":
+        
+        tf.reset_default_graph()
+        
+        config = tf.ConfigProto()
+        config.allow_soft_placement = True
+        config.gpu_options.allow_growth = True
+        sess = tf.Session(config = config)
+        
+        # one graph, the weights of each sample are loaded in turn
+        model = mixture_statistic(session = sess,
+                                  para_train = para_train)
+        model.network_ini(hyper_para = hyper_para)
+        model.inference_ini()
+        sess.run(tf.global_variables_initializer())
+        
+        vari_dict = {tmp_var.name: tmp_var for tmp_var in tf.trainable_variables()}
+    
+    for tmp_reservoir in step_reservoirs:
+        for tmp_sample in tmp_reservoir.samples:
+            
+            if para_train['para_step_sample_type'] == "weights":
+                for tmp_name, tmp_value in zip(tmp_reservoir.names, tmp_sample):
+                    vari_dict[tmp_name].load(tmp_value, sess)
+                _, py_tuple, _ = model.inference(xts,
+                                                 yts, 
+                                                 bool_instance_eval = True)
+            else:
+                py_tuple = tmp_sample
+            
+            infer.add_samples(py_mean = py_tuple[0],
+                              py_var = py_tuple[1],
+                              py_mean_src = py_tuple[2],
+                              py_var_src = py_tuple[3],
+                              py_gate_src = py_tuple[4],
+                              py_lk = py_tuple[5])
+    
+    if sum([len(tmp_reservoir.samples) for tmp_reservoir in step_reservoirs]) == 0:
+        return ["None"], ["None"]
+    
+    return infer.bayesian_inference(yts,
+                                    chunk_size = para_train['para_eval_chunk_size'])
+
 # ------ 
 
 def train_validate_test(src_tr_x,
@@ -375,25 +982,86 @@ def train_validate_test(src_tr_x,
     retrain_hpara_step_error = []
     retrain_random_seeds = [1] + [randint(0, 1000) for _ in range(para_train['para_hpara_retrain_num']-1)]
     
-    for tmp_retrain_id in range(para_train['para_hpara_retrain_num']):
-                                                                                                   
-        step_error, _ = train_validate_process(src_tr_x,
-                                            tr_y,
-                                            src_val_x,
-                                            val_y,
-                                            hyper_para = best_hpara,
-                                            para_train = para_train,
-                                            retrain_bool = True,
-                                            retrain_top_steps = list(range(para_train['para_n_epoch'])), # top_steps,
-                                            retrain_bayes_steps = list(range(para_train['para_n_epoch'])), # bayes_steps,
-                                            retrain_iter_idx = tmp_retrain_id,
-                                            random_seed = retrain_random_seeds[tmp_retrain_id])
+    # test predictions recorded during re-training
+    py_store = prediction_store(para_train['path_py_store']) if para_train['para_test_online_bool'] == True else None
+    
+    # snapshots at the end of each cycle of the cyclical schedule
+    cycle_steps = cyclical_snapshot_steps(para_train) if para_train['para_lr_cycle_num'] > 0 else []
+    
+    # [[step_error, retrain id]], the chains of multi-chain sampling are tagged retrain ids
+    retrain_step_errors = []
+    # batch-step samples of each retrain
+    retrain_step_reservoirs = []
+    
+    for tmp_retrain_idx in range(para_train['para_hpara_retrain_num']):
+        
+        if para_train['para_sg_mcmc_chains'] > 1:
+            
+            chain_step_errors, _ = train_validate_process_chains(src_tr_x,
+                                                                 tr_y,
+                                                                 src_val_x,
+                                                                 val_y,
+                                                                 hyper_para = best_hpara,
+                                                                 para_train = para_train,
+                                                                 retrain_top_steps = list(range(para_train['para_n_epoch'])),
+                                                                 retrain_bayes_steps = list(range(para_train['para_n_epoch'])),
+                                                                 retrain_iter_idx = tmp_retrain_idx,
+                                                                 random_seed = retrain_random_seeds[tmp_retrain_idx],
+                                                                 xts = src_ts_x,
+                                                                 yts = ts_y,
+                                                                 py_store = py_store)
+            retrain_step_errors.extend(chain_step_errors)
+            
+        else:
+            if para_train['para_test_snapshot_sample_interval'] > 0:
+                step_reservoir = step_sample_reservoir(size = para_train['para_step_sample_reservoir_size'],
+                                                       burnin = para_train['para_step_sample_burnin'],
+                                                       interval = para_train['para_test_snapshot_sample_interval'],
+                                                       random_seed = retrain_random_seeds[tmp_retrain_idx])
+                # predictions are collected on the testing data
+                step_reservoir.eval_x = src_ts_x
+                step_reservoir.eval_y = ts_y
+                retrain_step_reservoirs.append(step_reservoir)
+            else:
+                step_reservoir = None
+            
+            step_error, _ = train_validate_process(src_tr_x,
+                                                tr_y,
+                                                src_val_x,
+                                                val_y,
+                                                hyper_para = best_hpara,
+                                                para_train = para_train,
+                                                retrain_bool = True,
+                                                retrain_top_steps = list(range(para_train['para_n_epoch'])), # top_steps,
+                                                retrain_bayes_steps = list(range(para_train['para_n_epoch'])), # bayes_steps,
+                                                retrain_iter_idx = tmp_retrain_idx,
+                                                random_seed = retrain_random_seeds[tmp_retrain_idx],
+                                                step_reservoir = step_reservoir,
+                                                xts = src_ts_x,
+                                                yts = ts_y,
+                                                py_store = py_store)
+            retrain_step_errors.append([step_error, tmp_retrain_idx])
+    
+    # validation predictions of the snapshots, shared by the snapshot diagnostics, the stacking weights and the ensemble pruning
+    val_py_cache = {}
+    
+    for step_error, tmp_retrain_id in retrain_step_errors:
         
         top_steps, bayes_steps, top_steps_features, bayes_steps_features, val_error, step_error_pairs = snapshot_selection(train_log = step_error,
                                                                                                                            snapshot_num = para_train['para_test_snapshot_num'],
                                                                                                                            total_step_num = para_train['para_n_epoch'],
                                                                                                                            metric_idx = para_train['para_metric_map'][para_train['para_validation_metric']],
-                                                                                                                           val_snapshot_num = para_train['para_vali_snapshot_num'])
+                                                                                                                           val_snapshot_num = para_train['para_vali_snapshot_num'],
+                                                                                                                           cycle_steps = cycle_steps)
+        # redundant snapshots are dropped before testing
+        if len(bayes_steps) != 0 and (para_train['para_snapshot_ess_target'] > 0 or para_train['para_snapshot_diversity_target'] > 0):
+            bayes_steps, bayes_steps_features = snapshot_diagnostic_process(tmp_retrain_id,
+                                                                            bayes_steps,
+                                                                            bayes_steps_features,
+                                                                            src_val_x,
+                                                                            val_y,
+                                                                            para_train = para_train,
+                                                                            val_py_cache = val_py_cache)
         if len(top_steps) != 0:
             retrain_hpara_steps.append([top_steps, bayes_steps, top_steps_features, bayes_steps_features, tmp_retrain_id, val_error])
             retrain_hpara_step_error.append([step_error_pairs, tmp_retrain_id])
@@ -426,7 +1094,8 @@ def train_validate_test(src_tr_x,
                                          xts = src_ts_x, 
                                          yts = ts_y, 
                                          snapshot_features = [],
-                                         para_train = para_train)
+                                         para_train = para_train,
+                                         py_store = py_store)
     log_test_performance(path = para_train['path_log_error'], 
                          error_tuple = [error_tuple], 
                          ensemble_str = "One-shot-one-retrain")
@@ -439,7 +1108,8 @@ def train_validate_test(src_tr_x,
                                          xts = src_ts_x,
                                          yts = ts_y, 
                                          snapshot_features = [],
-                                         para_train = para_train)
+                                         para_train = para_train,
+                                         py_store = py_store)
     log_test_performance(path = para_train['path_log_error'], 
                          error_tuple = [error_tuple], 
                          ensemble_str = "One-shot-multi-retrain")
@@ -452,7 +1122,8 @@ def train_validate_test(src_tr_x,
                                          xts = src_ts_x, 
                                          yts = ts_y, 
                                          snapshot_features = [], 
-                                         para_train = para_train)
+                                         para_train = para_train,
+                                         py_store = py_store)
     log_test_performance(path = para_train['path_log_error'],
                          error_tuple = [error_tuple],
                          ensemble_str = "Top-shots-one-retrain")
@@ -465,7 +1136,8 @@ def train_validate_test(src_tr_x,
                                          xts = src_ts_x,
                                          yts = ts_y,
                                          snapshot_features = [], 
-                                         para_train = para_train)
+                                         para_train = para_train,
+                                         py_store = py_store)
     log_test_performance(path = para_train['path_log_error'], 
                          error_tuple = [error_tuple], 
                          ensemble_str = "Top-shots-multi-retrain")
@@ -478,7 +1150,8 @@ def train_validate_test(src_tr_x,
                                          xts = src_ts_x, 
                                          yts = ts_y,
                                          snapshot_features = [],
-                                         para_train = para_train)
+                                         para_train = para_train,
+                                         py_store = py_store)
     log_test_performance(path = para_train['path_log_error'], 
                          error_tuple = [error_tuple], 
                          ensemble_str = "Bayesian-one-retrain")
@@ -491,13 +1164,72 @@ def train_validate_test(src_tr_x,
                                          xts = src_ts_x,
                                          yts = ts_y,
                                          snapshot_features = [], 
-                                         para_train = para_train)
+                                         para_train = para_train,
+                                         py_store = py_store)
     log_test_performance(path = para_train['path_log_error'],
                          error_tuple = [error_tuple],
                          ensemble_str = "Bayesian-multi-retrain")
     pickle.dump(py_tuple, 
                 open(para_train['path_py'] + "_bayes_multi" + ".p", "wb"))
     
+    # -- weighted bayesian snapshots multi retrain
+    if para_train['para_ensemble_weight'] != "uniform":
+        
+        bayes_snapshots = [tmp_steps[1] for tmp_steps in sort_retrain_hpara_steps]
+        bayes_ids = [i[-2] for i in sort_retrain_hpara_steps[:para_train['para_hpara_ensemble_trial_num']]]
+        
+        if para_train['para_ensemble_weight'] == "stacking":
+            bayes_features = []
+            bayes_weights = stacking_weight_process(retrain_snapshots = bayes_snapshots,
+                                                    retrain_ids = bayes_ids,
+                                                    xval = src_val_x,
+                                                    yval = val_y,
+                                                    para_train = para_train,
+                                                    val_py_cache = val_py_cache)
+        elif para_train['para_ensemble_weight'] == "importance":
+            # [A M], validation metrics of the snapshots
+            bayes_features = [tmp_feature for tmp_steps in sort_retrain_hpara_steps[:len(bayes_ids)] for tmp_feature in tmp_steps[3]]
+            bayes_weights = []
+        
+        error_tuple, py_tuple = test_process(retrain_snapshots = bayes_snapshots,
+                                             retrain_ids = bayes_ids,
+                                             xts = src_ts_x,
+                                             yts = ts_y,
+                                             snapshot_features = bayes_features, 
+                                             para_train = para_train,
+                                             py_store = py_store,
+                                             snapshot_weights = bayes_weights)
+        log_test_performance(path = para_train['path_log_error'],
+                             error_tuple = [error_tuple],
+                             ensemble_str = "Bayesian-multi-retrain-" + para_train['para_ensemble_weight'])
+        pickle.dump(py_tuple, 
+                    open(para_train['path_py'] + "_bayes_multi_" + para_train['para_ensemble_weight'] + ".p", "wb"))
+    
+    # -- student distilled from the bayesian snapshots multi retrain
+    if para_train['para_distill_bool'] == True:
+        
+        distill_epoch = distillation_process(retrain_snapshots = [tmp_steps[1] for tmp_steps in sort_retrain_hpara_steps],
+                                             retrain_ids = [i[-2] for i in sort_retrain_hpara_steps[:para_train['para_hpara_ensemble_trial_num']]],
+                                             snapshot_weights = bayes_weights if para_train['para_ensemble_weight'] == "stacking" else [],
+                                             xtr = src_tr_x,
+                                             ytr = tr_y,
+                                             xval = src_val_x,
+                                             yval = val_y,
+                                             hyper_para = best_hpara,
+                                             para_train = para_train)
+        if distill_epoch != None:
+            error_tuple, py_tuple = test_process(retrain_snapshots = [[distill_epoch]],
+                                                 retrain_ids = ["distill"],
+                                                 xts = src_ts_x,
+                                                 yts = ts_y,
+                                                 snapshot_features = [], 
+                                                 para_train = para_train)
+            log_test_performance(path = para_train['path_log_error'],
+                                 error_tuple = [error_tuple],
+                                 ensemble_str = "Distilled-bayesian-multi-retrain")
+            pickle.dump(py_tuple, 
+                        open(para_train['path_py'] + "_distill" + ".p", "wb"))
+    
     # -- global top1 and topK steps
     retrain_ids, retrain_id_steps = global_top_steps_multi_retrain(retrain_step_error = retrain_hpara_step_error, 
                                                                    num_step = int(para_train['para_test_snapshot_num']*para_train['para_hpara_ensemble_trial_num']))    
@@ -510,10 +1242,58 @@ def train_validate_test(src_tr_x,
                                          xts = src_ts_x,
                                          yts = ts_y, 
                                          snapshot_features = [], 
-                                         para_train = para_train)
+                                         para_train = para_train,
+                                         py_store = py_store)
     log_test_performance(path = para_train['path_log_error'], 
                          error_tuple = [error_tuple], 
                          ensemble_str = "Global-top-steps-multi-retrain ")
     pickle.dump(py_tuple, 
                 open(para_train['path_py'] + "_global" + ".p", "wb"))
-    
\ No newline at end of file
+    
+    # -- pruned top snapshots multi retrain and global top steps
+    if para_train['para_ensemble_prune_bool'] == True:
+        
+        for tmp_snapshots, tmp_ids, tmp_str in [([tmp_steps[0] for tmp_steps in sort_retrain_hpara_steps], 
+                                                 [i[-2] for i in sort_retrain_hpara_steps[:para_train['para_hpara_ensemble_trial_num']]], 
+                                                 "top_multi"),
+                                                (retrain_id_steps,
+                                                 retrain_ids,
+                                                 "global")]:
+            
+            prune_snapshots, prune_ids, prune_weights = ensemble_pruning_process(retrain_snapshots = tmp_snapshots,
+                                                                                 retrain_ids = tmp_ids,
+                                                                                 xval = src_val_x,
+                                                                                 yval = val_y,
+                                                                                 para_train = para_train,
+                                                                                 val_py_cache = val_py_cache)
+            log_test_performance(path = para_train['path_log_error'], 
+                                 error_tuple = [prune_ids, prune_snapshots, prune_weights], 
+                                 ensemble_str = "Pruned-" + tmp_str + ": ")
+            
+            error_tuple, py_tuple = test_process(retrain_snapshots = prune_snapshots, 
+                                                 retrain_ids = prune_ids,
+                                                 xts = src_ts_x,
+                                                 yts = ts_y, 
+                                                 snapshot_features = [], 
+                                                 para_train = para_train,
+                                                 py_store = py_store,
+                                                 snapshot_weights = prune_weights)
+            log_test_performance(path = para_train['path_log_error'], 
+                                 error_tuple = [error_tuple], 
+                                 ensemble_str = "Pruned-" + tmp_str + "-multi-retrain ")
+            pickle.dump(py_tuple, 
+                        open(para_train['path_py'] + "_" + tmp_str + "_pruned" + ".p", "wb"))
+    
+    # -- batch-step samples multi retrain
+    if len(retrain_step_reservoirs) != 0:
+        
+        error_tuple, py_tuple = step_sample_test_process(step_reservoirs = retrain_step_reservoirs,
+                                                         xts = src_ts_x,
+                                                         yts = ts_y,
+                                                         hyper_para = best_hpara,
+                                                         para_train = para_train)
+        log_test_performance(path = para_train['path_log_error'], 
+                             error_tuple = [error_tuple], 
+                             ensemble_str = "Step-samples-multi-retrain ")
+        pickle.dump(py_tuple, 
+                    open(para_train['path_py'] + "_step" + ".p", "wb"))
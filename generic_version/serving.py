@@ -0,0 +1,363 @@
+#!/usr/bin/python
+
+import sys
+import os
+import numpy as np
+import time
+import json
+import asyncio
+
+# local packages
+from utils_numpy_inference import *
+from utils_profiling import *
+
+# ----- snapshot ensembles kept in memory
+'''
+Both ensembles expose samples(x), which returns
+  py_mean, py_var: [A B 1]
+  py_mean_src, py_var_src, py_gate_src: [A B S]
+  py_lk: None
+A: number of snapshots
+'''
+
+def snapshot_paths(path_model,
+                   model_type,
+                   retrain_ids,
+                   retrain_snapshots):
+    '''
+    Snapshot paths in the naming of train_validate_process and test_process.
+
+    Argu.:
+      retrain_ids: [R]
+      retrain_snapshots: [R [epoch]]
+    '''
+    paths = []
+    for tmp_retrain_id, tmp_snapshots in zip(retrain_ids, retrain_snapshots):
+        for tmp_epoch in tmp_snapshots:
+            paths.append(path_model + model_type + '_' + str(tmp_retrain_id) + '_' + str(tmp_epoch))
+    return paths
+
+class snapshot_ensemble_tf(object):
+
+    def __init__(self,
+                 paths):
+        '''
+        Restore each snapshot once into its own graph and session.
+
+        Argu.:
+          paths: [A], snapshot checkpoints, the meta graph is at path + '.meta'
+        '''
+        import tensorflow as tf
+
+        self.sessions = []
+        self.fetches = []
+        self.bool_keep_prob = []
+
+        for tmp_path in paths:
+
+            tmp_graph = tf.Graph()
+            with tmp_graph.as_default():
+
+                tmp_sess = tf.Session(graph = tmp_graph)
+                tmp_saver = tf.train.import_meta_graph(tmp_path + '.meta',
+                                                       clear_devices = True)
+                tmp_saver.restore(tmp_sess,
+                                  tmp_path)
+
+                self.fetches.append([tf.get_collection('py_mean')[0],
+                                     tf.get_collection('py_var')[0],
+                                     tf.get_collection('py_mean_src')[0],
+                                     tf.get_collection('py_var_src')[0],
+                                     tf.get_collection('py_gate_src')[0]])
+                # rnn models have the dropout placeholder
+                self.bool_keep_prob.append("keep_prob" in [tmp_op.name for tmp_op in tmp_graph.get_operations()])
+
+            self.sessions.append(tmp_sess)
+
+    def samples(self,
+                x):
+        '''
+        Argu.:
+          x: [S [B T D]]
+        '''
+        py_samples = []
+
+        for tmp_sess, tmp_fetch, tmp_bool_keep_prob in zip(self.sessions, self.fetches, self.bool_keep_prob):
+
+            data_dict = {}
+            for i in range(len(x)):
+                data_dict["x" + str(i) + ":0"] = x[i]
+            if tmp_bool_keep_prob == True:
+                data_dict["keep_prob:0"] = 1.0
+
+            with profiler.stage("snapshot_run", num_ins = len(x[0])):
+                py_samples.append(tmp_sess.run(tmp_fetch,
+                                               feed_dict = data_dict))
+
+        # [A B 1] [A B 1] [A B S] [A B S] [A B S]
+        py_mean, py_var, py_mean_src, py_var_src, py_gate_src = [np.asarray(tmp) for tmp in zip(*py_samples)]
+
+        return py_mean, py_var, py_mean_src, py_var_src, py_gate_src, None
+
+    def close(self):
+        for tmp_sess in self.sessions:
+            tmp_sess.close()
+
+class snapshot_ensemble_linear(ensemble_linear_numpy):
+
+    def close(self):
+        return
+
+# ----- micro-batching predictor
+
+class micro_batch_predictor(object):
+
+    def __init__(self,
+                 ensemble,
+                 max_batch_size,
+                 max_wait):
+        '''
+        Coalesce concurrent requests into one call of the ensemble.
+
+        Argu.:
+          ensemble: snapshot_ensemble_tf or snapshot_ensemble_linear
+          max_batch_size: int, maximum number of instances in one micro-batch
+          max_wait: float, seconds to wait for more requests after the first one of a micro-batch
+        '''
+        self.ensemble = ensemble
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = None
+        self.worker = None
+
+    def start(self):
+        # called inside the running event loop
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.batch_loop())
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.ensemble.close()
+
+    async def predict(self,
+                      x):
+        '''
+        Argu.:
+          x: [S [b T D]], b instances of one request
+
+        Return:
+          dictionary of mean, var_total, var_data, var_model: [b], gate: [b S]
+        '''
+        x = [np.asarray(tmp_x, dtype = np.float32) for tmp_x in x]
+        tmp_future = asyncio.get_event_loop().create_future()
+        await self.queue.put((x, tmp_future))
+
+        return await tmp_future
+
+    async def batch_loop(self):
+
+        loop = asyncio.get_event_loop()
+
+        while True:
+            # block for the first request of a micro-batch
+            batch = [await self.queue.get()]
+            num_ins = len(batch[0][0][0])
+            deadline = loop.time() + self.max_wait
+
+            while num_ins < self.max_batch_size:
+                tmp_timeout = deadline - loop.time()
+                if tmp_timeout <= 0:
+                    break
+                try:
+                    tmp_request = await asyncio.wait_for(self.queue.get(),
+                                                         timeout = tmp_timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(tmp_request)
+                num_ins += len(tmp_request[0][0])
+
+            # the ensemble runs off the event loop so that requests keep queueing
+            try:
+                results = await loop.run_in_executor(None,
+                                                     self.batch_inference,
+                                                     [tmp[0] for tmp in batch])
+                for tmp_request, tmp_result in zip(batch, results):
+                    if not tmp_request[1].cancelled():
+                        tmp_request[1].set_result(tmp_result)
+
+            except Exception as tmp_exception:
+                for tmp_request in batch:
+                    if not tmp_request[1].cancelled():
+                        tmp_request[1].set_exception(tmp_exception)
+
+    def batch_inference(self,
+                        batch_x):
+        '''
+        Argu.:
+          batch_x: [R [S [b T D]]], R requests
+
+        Return:
+          [R], one result dictionary per request
+        '''
+        # [S [B T D]]
+        x = [np.concatenate(tmp_src, 0) for tmp_src in zip(*batch_x)]
+
+        with profiler.stage("ensemble_samples", num_ins = len(x[0])):
+            py_mean, py_var, _, _, py_gate_src, _ = self.ensemble.samples(x)
+
+        # [B] [B] [B] [B] [B S] [B S]
+        with profiler.stage("ensemble_aggregation", num_ins = len(x[0])):
+            bayes_mean, bayes_var_total, bayes_var_data, bayes_var_model, bayes_gate_src, _ = bayesian_ensemble_moments(py_mean,
+                                                                                                                        py_var,
+                                                                                                                        py_gate_src)
+        results = []
+        tmp_st = 0
+        for tmp_x in batch_x:
+            tmp_ed = tmp_st + len(tmp_x[0])
+            results.append({"mean": bayes_mean[tmp_st:tmp_ed],
+                            "var_total": bayes_var_total[tmp_st:tmp_ed],
+                            "var_data": bayes_var_data[tmp_st:tmp_ed],
+                            "var_model": bayes_var_model[tmp_st:tmp_ed],
+                            "gate": bayes_gate_src[tmp_st:tmp_ed]})
+            tmp_st = tmp_ed
+
+        return results
+
+# ----- HTTP front-end
+
+async def http_response(writer,
+                        status,
+                        body):
+    tmp_body = json.dumps(body).encode("utf-8")
+    writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"%(status, len(tmp_body))).encode("utf-8") + tmp_body)
+    await writer.drain()
+    writer.close()
+
+def http_handler(predictor):
+    '''
+    POST /predict with the JSON body {"x": [S [b T D]]},
+    returns {"mean": [b], "var_total": [b], "var_data": [b], "var_model": [b], "gate": [b S]}
+    '''
+    async def handle(reader,
+                     writer):
+        try:
+            request_line = (await reader.readline()).decode("utf-8").split()
+
+            headers = {}
+            while True:
+                tmp_line = (await reader.readline()).decode("utf-8").strip()
+                if tmp_line == "":
+                    break
+                tmp_key, _, tmp_val = tmp_line.partition(":")
+                headers[tmp_key.strip().lower()] = tmp_val.strip()
+
+            if len(request_line) < 2 or request_line[0] != "POST" or request_line[1] != "/predict":
+                await http_response(writer, "404 Not Found", {"error": "POST /predict"})
+                return
+
+            tmp_body = await reader.readexactly(int(headers.get("content-length", 0)))
+            with profiler.stage("request_decode"):
+                body = json.loads(tmp_body.decode("utf-8"))
+
+            with profiler.stage("request_total", num_ins = len(body["x"][0])):
+                result = await predictor.predict(body["x"])
+
+            with profiler.stage("response_encode"):
+                response = {tmp_key: tmp_val.tolist() for tmp_key, tmp_val in result.items()}
+            await http_response(writer, "200 OK", response)
+
+        except Exception as tmp_exception:
+            await http_response(writer, "400 Bad Request", {"error": str(tmp_exception)})
+
+    return handle
+
+async def profile_dump_loop(path,
+                            interval):
+    while True:
+        await asyncio.sleep(interval)
+        profiler.dump(path)
+
+def serve(ensemble,
+          host,
+          port,
+          max_batch_size,
+          max_wait,
+          path_profile = "",
+          profile_interval = 60.0):
+    '''
+    Argu.:
+      path_profile: if not empty, stage-wise latency is dumped to this path every "profile_interval" seconds
+                    and at shutdown, ".json" or Prometheus text otherwise
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    predictor = micro_batch_predictor(ensemble,
+                                      max_batch_size = max_batch_size,
+                                      max_wait = max_wait)
+    predictor.start()
+
+    profiler.enabled = (path_profile != "")
+    if profiler.enabled == True:
+        profile_task = asyncio.ensure_future(profile_dump_loop(path_profile,
+                                                               profile_interval))
+
+    server = loop.run_until_complete(asyncio.start_server(http_handler(predictor),
+                                                          host = host,
+                                                          port = port))
+    print("\n --- serving on http://%s:%d/predict \n"%(host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(predictor.stop())
+        if profiler.enabled == True:
+            profile_task.cancel()
+            loop.run_until_complete(asyncio.gather(profile_task,
+                                                   return_exceptions = True))
+            profiler.dump(path_profile)
+        loop.close()
+
+# ----- arguments from command line
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshots', '-s', help = "snapshot checkpoints, or exported linear weights with --linear", type = str, nargs = '+')
+    parser.add_argument('--linear', '-l', help = "serve exported linear weights without TensorFlow", action = 'store_true')
+    parser.add_argument('--host', help = "host", type = str, default = "127.0.0.1")
+    parser.add_argument('--port', '-p', help = "port", type = int, default = 8080)
+    parser.add_argument('--max_batch_size', '-b', help = "maximum number of instances in one micro-batch", type = int, default = 256)
+    parser.add_argument('--max_wait', '-w', help = "maximum wait in milliseconds to fill a micro-batch", type = float, default = 2.0)
+    parser.add_argument('--gpu_id', '-g', help = "gpu_id", type = str, default = "")
+    parser.add_argument('--profile', help = "path of the stage-wise latency dump, .json or Prometheus text otherwise", type = str, default = "")
+    parser.add_argument('--profile_interval', help = "seconds between latency dumps", type = float, default = 60.0)
+
+    args = parser.parse_args()
+    print(args)
+
+    # ------ GPU set-up in multi-GPU environment
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+
+    if args.linear == True:
+        ensemble = snapshot_ensemble_linear(args.snapshots)
+    else:
+        ensemble = snapshot_ensemble_tf(args.snapshots)
+
+    serve(ensemble,
+          host = args.host,
+          port = args.port,
+          max_batch_size = args.max_batch_size,
+          max_wait = args.max_wait/1000.0,
+          path_profile = args.profile,
+          profile_interval = args.profile_interval)
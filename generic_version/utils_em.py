@@ -0,0 +1,566 @@
+#!/usr/bin/python
+
+import numpy as np
+import time
+
+# local packages
+from utils_metrics import *
+from utils_numpy_inference import *
+
+# ----- expectation-maximization for the linear Gaussian mixture
+'''
+For para_model_type "linear", para_distr_type "normal" and para_loss_type "heter_lk_inv",
+source s of instance b has
+  mean:             mu_bs = w_mean_s x_bs + b_mean_s
+  inverse variance: lam_bs = f(w_var_s x_bs + b_var_s), f: para_var_type
+  gate:             p_bs = softmax_s(w_gate_s x_bs + b_gate_s)
+and the training loss of mixture_statistic is
+  mean_b -log sum_s p_bs N(y_b; mu_bs, 1/lam_bs) + l2_mean |w_mean|^2 + l2_var |w_var|^2 + l2_gate |w_gate|^2
+while the evaluation nnllk of mixture_statistic normalizes the likelihood by y_b.
+train_validate_process runs one EM iteration per epoch under para_optimizer "em",
+fit and em_snapshot_save are the standalone counterparts.
+'''
+
+def var_link(z,
+             var_type):
+    '''
+    Return:
+      lam, d lam/dz, d^2 lam/dz^2, in the transformation of para_var_type
+    '''
+    if var_type == "square":
+        return np.square(z), 2.0*z, 2.0*np.ones_like(z)
+
+    elif var_type == "exp":
+        tmp_exp = np.exp(z)
+        return tmp_exp, tmp_exp, tmp_exp
+
+    elif var_type == "logexp":
+        tmp_sigmoid = 1.0/(1.0 + np.exp(-z))
+        return np.logaddexp(0.0, z), tmp_sigmoid, tmp_sigmoid*(1.0 - tmp_sigmoid)
+
+    print("\n --- VARIANCE TYPE ERROR ---- \n")
+    return None
+
+def var_link_inverse(lam,
+                     var_type):
+    if var_type == "square":
+        return np.sqrt(lam)
+
+    elif var_type == "exp":
+        return np.log(lam)
+
+    elif var_type == "logexp":
+        return np.log(np.expm1(lam))
+
+    print("\n --- VARIANCE TYPE ERROR ---- \n")
+    return None
+
+def ridge_solve(x,
+                weight,
+                target,
+                ridge):
+    '''
+    Weighted ridge regression of each source in one batched solve.
+
+    Argu.:
+      x: [S B P]
+      weight, target: [S B]
+      ridge: [P], penalty of each coefficient
+    Return:
+      [S P]
+    '''
+    # [S P P]
+    tmp_gram = np.matmul(np.transpose(x, [0, 2, 1]), x*weight[:, :, None]) + np.diag(ridge)
+    # [S P 1]
+    tmp_rhs = np.matmul(np.transpose(x, [0, 2, 1]), (weight*target)[:, :, None])
+    return np.linalg.solve(tmp_gram, tmp_rhs)[:, :, 0]
+
+class mixture_linear_em(object):
+
+    def __init__(self,
+                 para_train,
+                 hyper_para):
+        '''
+        Argu.:
+          para_train, hyper_para: the same set-up as mixture_statistic, only l2_mean, l2_var and l2_gate
+                                  of hyper_para are used, under para_regu_mean, para_regu_var and para_regu_gate
+        '''
+        if para_train['para_model_type'] != "linear" or para_train['para_distr_type'] != "normal" or para_train['para_add_common_factor'] == True \
+           or para_train.get('para_gate_topk', 0) not in [0, para_train['para_num_source']] or len(para_train.get('para_gate_groups', [])) > 0:
+            raise ValueError("EM only fits linear normal mixtures without common factor and with dense flat gates: %s, %s, %s"%(para_train['para_model_type'], 
+                                                                                                                             para_train['para_distr_type'], 
+                                                                                                                             para_train['para_add_common_factor']))
+
+        self.para_train = para_train
+        self.var_type = para_train['para_var_type']
+
+        # mean, variance and gate heads
+        self.bool_bias = [para_train['para_bool_bias_in_mean'], para_train['para_bool_bias_in_var'], para_train['para_bool_bias_in_gate']]
+        self.l2 = [hyper_para["l2_mean"] if para_train['para_regu_mean'] == True else 0.0,
+                   hyper_para["l2_var"] if para_train['para_regu_var'] == True else 0.0,
+                   hyper_para["l2_gate"] if para_train['para_regu_gate'] == True else 0.0]
+
+        # [3 [S P]], P: T*D, +1 with the bias
+        self.theta = None
+
+    def design(self,
+               x):
+        '''
+        Argu.:
+          x: [S [B T D]]
+        Return:
+          [3 [S B P]], design matrix of each head, the last column is one with the bias
+        '''
+        # [S B T*D]
+        x_flatten = linear_src_flatten(x).astype(np.float64)
+        x_one = np.concatenate([x_flatten, np.ones(x_flatten.shape[:2] + (1,))], -1)
+        return [x_one if tmp_bool_bias == True else x_flatten for tmp_bool_bias in self.bool_bias]
+
+    def ridge(self,
+              num_ins):
+        '''
+        Return:
+          [3 [P]], the l2 of the mean loss in the scale of the summed log-likelihood, no penalty on the bias
+        '''
+        ridge = []
+        for tmp_l2, tmp_bool_bias in zip(self.l2, self.bool_bias):
+            tmp_ridge = 2.0*num_ins*tmp_l2*np.ones(self.dim_x + (1 if tmp_bool_bias == True else 0))
+            if tmp_bool_bias == True:
+                tmp_ridge[-1] = 0.0
+            # a small jitter keeps the normal equations well-posed
+            ridge.append(tmp_ridge + 1e-8)
+        return ridge
+
+    def heads(self,
+              x_design):
+        '''
+        Return:
+          mean_stack, tmp_var, gate_logits: [B S]
+        '''
+        return [np.transpose(np.matmul(tmp_x, tmp_theta[:, :, None])[:, :, 0], [1, 0]) for tmp_x, tmp_theta in zip(x_design, self.theta)]
+
+    def responsibility(self,
+                       mean_stack,
+                       tmp_var,
+                       gate_logits,
+                       y):
+        '''
+        E-step
+
+        Argu.:
+          y: [B 1]
+        Return:
+          posterior of the sources r: [B S], mean negative log-likelihood
+        '''
+        lam, _, _ = var_link(tmp_var,
+                             self.var_type)
+        lam = np.maximum(lam, 1e-10)
+        # [B S]
+        log_joint = gate_logits - np.logaddexp.reduce(gate_logits, axis = -1, keepdims = True) \
+                    + 0.5*np.log(0.5/np.pi*lam) - 0.5*lam*np.square(y - mean_stack)
+        # [B 1]
+        log_lk = np.logaddexp.reduce(log_joint, axis = -1, keepdims = True)
+        return np.exp(log_joint - log_lk), -1.0*np.mean(log_lk)
+
+    def m_step_mean(self,
+                    x_mean,
+                    r,
+                    lam,
+                    y,
+                    ridge):
+        # weighted least squares, weights: r*lam
+        # [S P]
+        return ridge_solve(x_mean,
+                           np.transpose(r*lam, [1, 0]),
+                           np.tile(np.transpose(y, [1, 0]), [len(x_mean), 1]),
+                           ridge)
+
+    def m_step_var(self,
+                   x_var,
+                   theta_var,
+                   r,
+                   sq_err,
+                   ridge,
+                   num_newton,
+                   max_halving = 10):
+        '''
+        IRLS/Newton on sum_b r_bs [0.5 log lam_bs - 0.5 lam_bs e_bs] - 0.5 ridge |theta|^2 of each source
+        '''
+        # [S B]
+        r = np.transpose(r, [1, 0])
+        sq_err = np.transpose(sq_err, [1, 0])
+
+        def objective(tmp_theta):
+            # [S B]
+            tmp_lam, _, _ = var_link(np.matmul(x_var, tmp_theta[:, :, None])[:, :, 0],
+                                     self.var_type)
+            tmp_lam = np.maximum(tmp_lam, 1e-10)
+            # [S]
+            return np.sum(r*(0.5*np.log(tmp_lam) - 0.5*tmp_lam*sq_err), 1) - 0.5*np.sum(ridge*np.square(tmp_theta), 1)
+
+        for _ in range(num_newton):
+            z = np.matmul(x_var, theta_var[:, :, None])[:, :, 0]
+            lam, d_lam, d2_lam = var_link(z,
+                                          self.var_type)
+            lam = np.maximum(lam, 1e-10)
+            # first and second derivatives in z, [S B]
+            grad_z = 0.5*d_lam/lam - 0.5*d_lam*sq_err
+            curv_z = np.maximum(-0.5*(d2_lam/lam - np.square(d_lam/lam)) + 0.5*d2_lam*sq_err, 1e-8)
+            # Newton direction, [S P]
+            tmp_grad = np.matmul(np.transpose(x_var, [0, 2, 1]), (r*grad_z)[:, :, None])[:, :, 0] - ridge*theta_var
+            tmp_hess = np.matmul(np.transpose(x_var, [0, 2, 1]), x_var*(r*curv_z)[:, :, None]) + np.diag(ridge)
+            direction = np.linalg.solve(tmp_hess, tmp_grad[:, :, None])[:, :, 0]
+
+            theta_var = self.line_search(objective,
+                                         theta_var,
+                                         direction,
+                                         max_halving)
+        return theta_var
+
+    def m_step_gate(self,
+                    x_gate,
+                    theta_gate,
+                    r,
+                    ridge,
+                    num_newton,
+                    max_halving = 10):
+        '''
+        Multinomial-logistic IRLS, block-wise over sources, on sum_b sum_s r_bs log p_bs - 0.5 ridge |theta|^2,
+        the logit of source s only depends on the input of source s.
+        '''
+        num_src = len(x_gate)
+        # [S B]
+        r = np.transpose(r, [1, 0])
+        logits = np.matmul(x_gate, theta_gate[:, :, None])[:, :, 0]
+
+        for _ in range(num_newton):
+            for i in range(num_src):
+
+                def objective(tmp_theta):
+                    tmp_logits = np.copy(logits)
+                    tmp_logits[i] = np.matmul(x_gate[i], tmp_theta[0])
+                    return np.array([np.sum(r*(tmp_logits - np.logaddexp.reduce(tmp_logits, axis = 0))) - 0.5*np.sum(ridge*np.square(tmp_theta))])
+
+                # [S B]
+                prob = np.exp(logits - np.logaddexp.reduce(logits, axis = 0))
+                # [P]
+                tmp_grad = np.matmul(np.transpose(x_gate[i]), r[i] - prob[i]) - ridge*theta_gate[i]
+                tmp_hess = np.matmul(np.transpose(x_gate[i]), x_gate[i]*(prob[i]*(1.0 - prob[i]))[:, None]) + np.diag(ridge)
+                direction = np.linalg.solve(tmp_hess, tmp_grad)
+
+                theta_gate[i] = self.line_search(objective,
+                                                 theta_gate[i:i+1],
+                                                 direction[None, :],
+                                                 max_halving)[0]
+                logits[i] = np.matmul(x_gate[i], theta_gate[i])
+        return theta_gate
+
+    def line_search(self,
+                    objective,
+                    theta,
+                    direction,
+                    max_halving):
+        '''
+        Step halving on each source until the objective does not decrease.
+
+        Argu.:
+          theta, direction: [S P]
+          objective: [S P] -> [S]
+        '''
+        obj_cur = objective(theta)
+        step = np.ones(len(theta))
+        theta_new = theta + direction
+        obj_new = objective(theta_new)
+
+        for _ in range(max_halving):
+            # [S]
+            bool_worse = ~(obj_new >= obj_cur - 1e-12)
+            if np.any(bool_worse) == False:
+                break
+            step = np.where(bool_worse, 0.5*step, step)
+            theta_new = theta + step[:, None]*direction
+            obj_new = objective(theta_new)
+
+        # keep the current coefficients of the sources not improved
+        bool_worse = ~(obj_new >= obj_cur - 1e-12)
+        return np.where(bool_worse[:, None], theta, theta_new)
+
+    def initialize(self,
+                   x_design,
+                   y,
+                   ridge):
+        num_src = len(x_design[0])
+        num_ins = len(y)
+        # [S B]
+        tmp_y = np.tile(np.transpose(y, [1, 0]), [num_src, 1])
+        tmp_one = np.ones([num_src, num_ins])
+
+        # - source-wise ridge regression for the means
+        theta_mean = ridge_solve(x_design[0], tmp_one, tmp_y, ridge[0])
+        # - constant inverse variance at the residual variance of each source
+        tmp_sq_err = np.square(tmp_y - np.matmul(x_design[0], theta_mean[:, :, None])[:, :, 0])
+        tmp_z = var_link_inverse(1.0/(np.mean(tmp_sq_err, 1, keepdims = True) + 1e-5), self.var_type)
+        theta_var = ridge_solve(x_design[1], tmp_one, tmp_z*tmp_one, ridge[1])
+        # - uniform gates
+        theta_gate = np.zeros([num_src, x_design[2].shape[-1]])
+
+        return [theta_mean, theta_var, theta_gate]
+
+    def fit_ini(self,
+                xtr,
+                ytr):
+        '''
+        Design matrices and initial weights on the training data
+        
+        Argu.:
+          xtr: [S [N T D]]
+          ytr: [N 1] or [N 3] as fed to mixture_statistic, only the first column is used
+        '''
+        # [N 1]
+        self.y = np.asarray(ytr, dtype = np.float64)[:, :1]
+
+        self.x_design = self.design(xtr)
+        self.dim_x = self.x_design[0].shape[-1] - (1 if self.bool_bias[0] == True else 0)
+        self.ridge_tr = self.ridge(len(self.y))
+
+        self.theta = self.initialize(self.x_design,
+                                     self.y,
+                                     self.ridge_tr)
+        return
+
+    def iterate(self,
+                num_newton = 1):
+        '''
+        One EM iteration over the training data of fit_ini
+        
+        Argu.:
+          num_newton: Newton steps of the variance and gate heads in the M-step
+        Return:
+          training loss of mixture_statistic, before the M-step
+        '''
+        x_design = self.x_design
+        y = self.y
+
+        # -- E-step
+        mean_stack, tmp_var, gate_logits = self.heads(x_design)
+        r, nllk = self.responsibility(mean_stack,
+                                      tmp_var,
+                                      gate_logits,
+                                      y)
+        # -- M-step
+        lam, _, _ = var_link(tmp_var,
+                             self.var_type)
+        self.theta[0] = self.m_step_mean(x_design[0],
+                                         r,
+                                         np.maximum(lam, 1e-10),
+                                         y,
+                                         self.ridge_tr[0])
+        sq_err = np.square(y - self.heads(x_design)[0])
+        self.theta[1] = self.m_step_var(x_design[1],
+                                        self.theta[1],
+                                        r,
+                                        sq_err,
+                                        self.ridge_tr[1],
+                                        num_newton)
+        self.theta[2] = self.m_step_gate(x_design[2],
+                                         self.theta[2],
+                                         r,
+                                         self.ridge_tr[2],
+                                         num_newton)
+        # -- training loss of mixture_statistic, before this M-step
+        return nllk + sum([tmp_l2*np.sum(np.square(tmp_theta[:, :self.dim_x])) for tmp_l2, tmp_theta in zip(self.l2, self.theta)])
+
+    def fit(self,
+            xtr,
+            ytr,
+            xval = None,
+            yval = None,
+            num_iter = 50,
+            tol = 1e-6,
+            num_newton = 1):
+        '''
+        Standalone fit, train_validate_process runs the same iterations under para_optimizer "em"
+        
+        Argu.:
+          xtr: [S [N T D]]
+          ytr: [N 1] or [N 3] as fed to mixture_statistic, only the first column is used
+          num_iter: maximum number of EM iterations over the full training data
+          tol: stop when the relative decrease of the training loss is below tol
+          num_newton: Newton steps of the variance and gate heads in each M-step
+        Return:
+          step_error: [[iteration, training metric, validation metric]], metric: [rmse, mae, mape, nnllk],
+                      the same layout as the epoch-wise log of train_validate_process
+          seconds per iteration
+        '''
+        self.fit_ini(xtr,
+                     ytr)
+        step_error = []
+        loss_pre = np.inf
+        st_time = time.time()
+
+        for tmp_iter in range(num_iter):
+
+            loss = self.iterate(num_newton)
+
+            tr_metric = self.evaluate(xtr, ytr)
+            val_metric = self.evaluate(xval, yval) if xval is not None else None
+            step_error.append([tmp_iter, tr_metric, val_metric])
+
+            print("\n --- At EM iteration %d : \n  %s \n   loss : %f "%(tmp_iter, str(step_error[-1]), loss))
+
+            if np.isnan(loss) == True:
+                print("\n --- NAN loss !! \n" )
+                break
+            if loss_pre - loss < tol*np.abs(loss_pre):
+                break
+            loss_pre = loss
+
+        ed_time = time.time()
+
+        return step_error, 1.0*(ed_time - st_time)/(tmp_iter + 1)
+
+    def export(self):
+        '''
+        Return:
+          dictionary in the format of linear_snapshot_export
+        '''
+        export = {}
+        for tmp_name, tmp_theta, tmp_bool_bias in zip(linear_head_names, self.theta, self.bool_bias):
+            # [S T*D]
+            export["w_" + tmp_name] = tmp_theta[:, :self.dim_x].astype(np.float32)
+            # [S]
+            export["b_" + tmp_name] = tmp_theta[:, -1].astype(np.float32) if tmp_bool_bias == True else np.zeros(len(tmp_theta), dtype = np.float32)
+
+        export["para_distr_type"] = self.para_train['para_distr_type']
+        export["para_var_type"] = self.para_train['para_var_type']
+        export["para_num_source"] = self.para_train['para_num_source']
+        export["x_steps"] = self.para_train['x_steps']
+        export["x_dims"] = self.para_train['x_dims']
+        export["para_gate_topk"] = 0
+
+        return export
+
+    def evaluate(self,
+                 x,
+                 y):
+        '''
+        Return:
+          [rmse, mae, mape, nnllk], as mixture_statistic.inference, 
+          nnllk on the likelihood normalized by y as the evaluation nnllk of mixture_statistic
+        '''
+        py_mean, _, _, _, _, py_lk = mixture_linear_numpy(self.export()).inference(x, 
+                                                                                   y)
+        # [B 1]
+        y = np.asarray(y)[:, :1]
+        return [func_rmse(y, py_mean), func_mae(y, py_mean), func_mape(y, py_mean), func_nnllk(py_lk)]
+
+def em_weights_load(export,
+                    sess):
+    '''
+    Load EM weights into the linear heads of the mixture_statistic in the graph of sess
+    
+    Argu.:
+      export: dictionary returned by mixture_linear_em.export
+    '''
+    import tensorflow as tf
+
+    tmp_vari = {tmp.name: tmp for tmp in sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)}
+    for tmp_scope, tmp_name in zip(linear_head_scopes, linear_head_names):
+        # [S 1 T*D], [S 1]
+        tmp_vari[tmp_scope + "/w:0"].load(np.expand_dims(export["w_" + tmp_name], 1), sess)
+        tmp_vari[tmp_scope + "/b:0"].load(np.expand_dims(export["b_" + tmp_name], 1), sess)
+    return
+
+def em_snapshot_save(export,
+                     para_train,
+                     hyper_para,
+                     path):
+    '''
+    Write EM weights as a snapshot of mixture_statistic,
+    restored by test_process in the same way as the snapshots saved in train_validate_process.
+
+    Argu.:
+      export: dictionary returned by mixture_linear_em.export
+      path: snapshot path, e.g. path_model + model_type + '_' + retrain_id + '_' + epoch
+    '''
+    import tensorflow as tf
+    from mixture_models import mixture_statistic
+
+    tmp_graph = tf.Graph()
+    with tmp_graph.as_default():
+
+        sess = tf.Session()
+
+        model = mixture_statistic(session = sess,
+                                  para_train = para_train)
+        model.network_ini(hyper_para = hyper_para)
+        # the same order as in train_validate_process
+        saver = tf.train.Saver(max_to_keep = None)
+        model.train_ini()
+        model.inference_ini()
+
+        em_weights_load(export,
+                        sess)
+
+        saver.save(sess, path)
+        sess.close()
+
+# ----- self-check on synthetic data
+
+if __name__ == '__main__':
+
+    def synthetic_sources(num_ins,
+                          seed = 1):
+        '''
+        Return:
+          x: [S [B T D]], two sources padded to the same T and D, y: [B 1] positive as the likelihood is normalized by y, drawn from the source picked by the sign of x[0]
+        '''
+        np.random.seed(seed)
+        x = [np.random.randn(num_ins, 3, 2), np.random.randn(num_ins, 3, 2)]
+        y_src = np.stack([20.0 + np.sum(x[0], (1, 2)), 25.0 - 0.5*np.sum(x[1], (1, 2))], -1) + 0.1*np.random.randn(num_ins, 2)
+        y = np.where(x[0][:, -1, 0] > 0, y_src[:, 0], y_src[:, 1])
+        return x, y[:, None]
+
+    xtr, ytr = synthetic_sources(500)
+    xval, yval = synthetic_sources(200, seed = 2)
+
+    for tmp_var_type in ["square", "exp"]:
+
+        para_train = {'para_model_type': "linear",
+                      'para_distr_type': "normal",
+                      'para_var_type': tmp_var_type,
+                      'para_add_common_factor': False,
+                      'para_bool_bias_in_mean': True,
+                      'para_bool_bias_in_var': True,
+                      'para_bool_bias_in_gate': True,
+                      'para_regu_mean': True,
+                      'para_regu_var': True,
+                      'para_regu_gate': False,
+                      'para_num_source': 2,
+                      'x_steps': [3, 3],
+                      'x_dims': [2, 2]}
+        hyper_para = {"l2_mean": 1e-4,
+                      "l2_var": 1e-4,
+                      "l2_gate": 0.0}
+
+        em = mixture_linear_em(para_train, 
+                               hyper_para)
+        em.fit_ini(xtr, 
+                   ytr)
+        # [iteration]
+        loss = np.asarray([em.iterate() for _ in range(20)])
+        step_error, _ = mixture_linear_em(para_train, 
+                                          hyper_para).fit(xtr,
+                                                          ytr,
+                                                          xval,
+                                                          yval,
+                                                          num_iter = 20,
+                                                          tol = 1e-12)
+        val_nnllk = np.asarray([tmp_step[2][3] for tmp_step in step_error])
+
+        assert np.all(np.isfinite(loss)) and np.all(np.isfinite(val_nnllk))
+        # EM does not increase the training loss, up to the l2 and the inexact Newton M-steps
+        assert np.all(np.diff(loss) < 1e-3)
+        assert loss[-1] < loss[0] - 0.1
+        assert val_nnllk[-1] < val_nnllk[0]
+        print("\n --- EM self-check passed: %s, training loss %f -> %f \n"%(tmp_var_type, loss[0], loss[-1]))
@@ -1,56 +1,17 @@
 #!/usr/bin/python
 
+import os
 import numpy as np
-from sklearn.neighbors.kde import KernelDensity
 import tensorflow as tf
 
 # from utils_training import *
 
 # ----- error metrics
+# vectorised kernels, func_rmse, func_mae, func_mape, func_pearson,
+# func_pred_interval_coverage_prob, func_pred_interval_width, func_nnllk, eval_metrics
 
-def func_rmse(y,
-              yhat):
-    return np.sqrt(np.mean( (np.asarray(y) - np.asarray(yhat))**2) )
-
-def func_mae(y, 
-             yhat):
-    return np.mean(np.abs(np.asarray(y) - np.asarray(yhat)))
-
-def func_mape(y, 
-              yhat):
-    tmp_list = []
-    
-    for idx, val in enumerate(y):
-        if abs(val) > 1e-5:
-            tmp_list.append(abs(1.0*(yhat[idx]-val)/val))
-    
-    return np.mean(tmp_list)
-
-def func_pearson(y, 
-                 yhat):
-    import scipy as sp
-    return sp.stats.pearsonr(y, yhat)
-
-def func_pred_interval_coverage_prob(y,
-                                     yhat_low,
-                                     yhat_up):
-    in_cnt = 0
-    for i in range(len(y)):
-        if yhat_low[i] <= y[i] and y[i] <= yhat_up[i]:
-            in_cnt += 1
-    return 1.0*in_cnt/len(y)
-
-def func_pred_interval_width(y,
-                             yhat_low,
-                             yhat_up):
-    in_cnt = 0
-    in_width_sum = 0.0
-    for i in range(len(y)):
-        if yhat_low[i] <= y[i] and y[i] <= yhat_up[i]:
-            in_cnt += 1
-            in_width_sum += (yhat_up[i]-yhat_low[i])
-            
-    return 1.0*in_width_sum/in_cnt
+from utils_metrics import *
+from utils_numpy_inference import bayesian_ensemble_reduce, bayesian_ensemble_moments, softmax_last_axis
 
 # def func_nnllk_lognormal(nnllk, y):
 #     return np.mean(y) + nnllk
@@ -137,182 +98,57 @@ class ensemble_inference(object):
             
         return p
     
-#     def importance_inference(self,
-#                              snapshot_features,
-#                              y):
-#         '''
-#         snapshot_features: [A M]
-#                             M: feature dimensionality
-#         y: [B 1]
-#         '''
-#         num_snapshot = len(snapshot_features)
-#         snapshot_features = np.reshape(np.asarray(snapshot_features), (num_snapshot, -1))
-        
-#         kde = KernelDensity(kernel = 'gaussian', bandwidth = 0.2).fit(snapshot_features)
-#         kde_score = kde.score_samples(snapshot_features)
-#         snapshot_imp = self.softmax_stable(kde_score, 
-#                                            theta = 1.0, 
-#                                            axis = None)
-#         snapshot_imp = np.expand_dims(np.asarray(snapshot_imp), axis = 1)
-#         print("\n\n ----- test \n", snapshot_imp)
-        
-#         # [A B S]
-#         # A: number of samples
-#         m_src_sample = np.asarray(self.py_mean_src_samples)
-#         v_src_sample = np.asarray(self.py_var_src_samples)
-#         g_src_sample = np.asarray(self.py_gate_src_samples)
-#         # [A B 1]
-#         m_sample = np.asarray(self.py_mean_samples)
-        
-#         # -- mean
-#         # [B]
-#         bayes_mean = np.sum(snapshot_imp*np.sum(m_src_sample*g_src_sample, axis = 2), axis = 0)
-        
-#         # -- total variance
-#         # [B]
-#         sq_mean = bayes_mean**2
-#         # [A B S]
-#         var_plus_sq_mean_src = v_src_sample + m_src_sample**2
-#         # [B]
-#         bayes_total_var = np.sum(snapshot_imp*np.sum(g_src_sample*var_plus_sq_mean_src, -1), 0) - sq_mean
-        
-#         # -- volatility
-#         # heteroskedasticity
-#         # [B]                       [A B S]
-#         bayes_vola = np.sum(snapshot_imp*np.sum(g_src_sample*v_src_sample, -1), 0)
-        
-#         # -- uncertainty on predicted mean
-#         # without heteroskedasticity
-#         # [B]                       [A B S]
-#         bayes_unc = np.sum(snapshot_imp*np.sum(g_src_sample*(m_src_sample**2), -1), 0) - sq_mean
-        
-#         # -- nnllk
-#         # normalized negative log-likelihood
-#         # [1 B 1]
-#         aug_y = np.expand_dims(y, axis=0)
-        
-#         # [A B S]
-#         tmp_lk_src = np.exp(-0.5*(aug_y - m_src_sample)**2/(v_src_sample + 1e-5))/(np.sqrt(2.0*np.pi*v_src_sample) + 1e-5)
-#         # [B]                   [A B S]
-#         tmp_lk = np.sum(snapshot_imp*np.sum(g_src_sample*tmp_lk_src, -1), 0)
-        
-#         nnllk = np.mean(-1.0*np.log(tmp_lk + 1e-5))
-        
-#         # -- uniform nnllk
-#         # take the mixture mean and variance to parameterize one Gaussian distribution
-        
-#         # [B]
-#         uni_nnllk_vol = np.mean(0.5*np.square(np.squeeze(y) - bayes_mean)/(bayes_vola + 1e-5) + 0.5*np.log(bayes_vola + 1e-5) + 0.5*np.log(2*np.pi))
-
-#         uni_nnllk_var = np.mean(0.5*np.square(np.squeeze(y) - bayes_mean)/(bayes_total_var + 1e-5) + 0.5*np.log(bayes_total_var + 1e-5) + 0.5*np.log(2*np.pi))
-        
-#         # -- gate
-#         # [B S]                 [A B S]
-#         bayes_gate_src = np.mean(g_src_sample, axis = 0)
-#         bayes_gate_src_var = np.var(g_src_sample, axis = 0)
-        
-#         # -- output
-#         tmpy = np.squeeze(y)
-        
-#         # error tuple [], prediction tuple []
-#         return [func_rmse(tmpy, bayes_mean), 
-#                 func_mae(tmpy, bayes_mean), 
-#                 func_mape(tmpy, bayes_mean), 
-#                 func_pearson(tmpy, bayes_mean), 
-#                 nnllk, 
-#                 uni_nnllk_vol, 
-#                 uni_nnllk_var],\
-#                [bayes_mean, 
-#                 bayes_total_var,
-#                 bayes_vola, 
-#                 bayes_unc, 
-#                 bayes_gate_src, 
-#                 bayes_gate_src_var, 
-#                 g_src_sample]
+    def importance_inference(self,
+                             snapshot_features,
+                             y,
+                             bandwidth = 0.2,
+                             chunk_size = 0):
+        '''
+        Snapshots weighted by the kernel density of their features.
         
+        snapshot_features: [A M]
+                            M: feature dimensionality
+        y: [B 1]
+        '''
+        snapshot_imp = kde_importance_weights(snapshot_features,
+                                              bandwidth = bandwidth)
+        
+        return self.bayesian_inference(y,
+                                       chunk_size = chunk_size,
+                                       weights = snapshot_imp)
+    
     def bayesian_inference(self, 
-                           y):
+                           y,
+                           chunk_size = 0,
+                           weights = None):
         '''
         y: [B 1]
         A: number of samples
+        chunk_size: int, if > 0, metrics are evaluated over chunks of instances
+        weights: None for uniform, or [A] weights of the samples in the order of add_samples
         '''
-        # [A B S]
-        m_src_sample = np.asarray(self.py_mean_src_samples)
-        v_src_sample = np.asarray(self.py_var_src_samples)
-        g_src_sample = np.asarray(self.py_gate_src_samples)
-        # [A B 1]
-        m_sample = np.asarray(self.py_mean_samples)
-        v_sample = np.asarray(self.py_var_samples)
-        # [A B]
-        lk_sample = np.asarray(self.py_lk_samples)
-        
-        # -- temporary
-        # [B]
-        y_ori = np.asarray([tmp[0] for tmp in y])
-        y_z   = np.asarray([tmp[1] for tmp in y])
-        y_dese = np.asarray([tmp[2] for tmp in y])
-        
-        # -- mean
-        # [B]
-        #bayes_mean = np.mean(np.sum(m_src_sample*g_src_sample, axis = 2), axis = 0)
-        bayes_mean = np.mean(np.squeeze(m_sample, -1), axis = 0)
-        
-        # -- total variance
-        # [B]
-        sq_mean = bayes_mean**2
-        # [A B 1]
-        var_plus_sq_mean = np.squeeze(v_sample + m_sample**2, -1)
-        # [B]
-        bayes_var_total = np.mean(var_plus_sq_mean, 0) - sq_mean
+        # [A B S] [A B S] [A B S] [A B 1] [A B 1] [A B]
+        return bayesian_ensemble_reduce(m_src_sample = np.asarray(self.py_mean_src_samples),
+                                        v_src_sample = np.asarray(self.py_var_src_samples),
+                                        g_src_sample = np.asarray(self.py_gate_src_samples),
+                                        m_sample = np.asarray(self.py_mean_samples),
+                                        v_sample = np.asarray(self.py_var_samples),
+                                        lk_sample = np.asarray(self.py_lk_samples),
+                                        y = y,
+                                        chunk_size = chunk_size,
+                                        weights = weights)
+    
+    def gate_posterior(self):
+        '''
+        Truncated Gaussian on [0, 1] of the gate samples of each instance and source.
         
-        # -- data variance
-        # heteroskedasticity
-        # [B]
-        bayes_var_data = np.mean(np.squeeze(v_sample, -1), 0)
-        
-        # -- model variance
-        # [B]                       [A B 1]
-        bayes_var_model = np.mean(np.squeeze(m_sample**2, -1), 0) - sq_mean
-        
-        # -- nnllk
-        nnllk = np.mean(-1.0*np.log(np.mean(lk_sample, 0) + 1e-5))
-        
-        # -- gate
-        # [B S]                 [A B S]
-        bayes_gate_src = np.mean(g_src_sample, axis = 0)
-        bayes_gate_src_var = np.var(g_src_sample, axis = 0)
-        
-        # -- mean of total variance
-        std_total_mean = np.mean(np.sqrt(bayes_var_total))
-        
-        # -- output
-        # error tuple [], prediction tuple []
-        y_low_model = bayes_mean - 2.0*np.sqrt(bayes_var_model)
-        y_up_model = bayes_mean + 2.0*np.sqrt(bayes_var_model)
-        y_low_total = bayes_mean - 2.0*np.sqrt(bayes_var_total)
-        y_up_total  = bayes_mean + 2.0*np.sqrt(bayes_var_total)
-        func_pred_interval_coverage_prob(y_ori, yhat_low = y_low_model, yhat_up = y_up_model),
-        func_pred_interval_coverage_prob(y_ori, yhat_low = y_low_total, yhat_up = y_up_total),
-        func_pred_interval_width(y_ori, yhat_low = y_low_total, yhat_up = y_up_total), 
-        
-        return [
-            func_rmse(y_ori, bayes_mean),
-            func_mae(y_ori, bayes_mean),
-            func_mape(y_ori, bayes_mean),
-            nnllk,
-            std_total_mean
-        ],\
-              [
-            bayes_mean,
-            bayes_var_total,
-            bayes_var_data,
-            bayes_var_model,
-            bayes_gate_src,
-            bayes_gate_src_var,
-            g_src_sample, 
-            m_src_sample, 
-            v_src_sample
-        ]
+        Return:
+          loc, scale, mean, var: [B S]
+        '''
+        # [A B S]
+        return truncnorm_fit(np.asarray(self.py_gate_src_samples),
+                             left = 0.0,
+                             right = 1.0)
     
 def global_top_steps_multi_retrain(retrain_step_error,
                                    num_step):
@@ -349,3 +185,429 @@ def global_top_steps_multi_retrain(retrain_step_error,
         retrain_id_steps = [id_steps[tmp_id] for tmp_id in id_steps]
         
         return retrain_ids, retrain_id_steps
+
+# ----- on-disk store of test predictions
+
+class prediction_store(object):
+    
+    def __init__(self,
+                 path):
+        '''
+        Test predictions of the snapshots, recorded during re-training, 
+        one uncompressed float32 .npz per (retrain_id, epoch) under the directory "path".
+        '''
+        self.path = path
+        self.names = ["py_mean", "py_var", "py_mean_src", "py_var_src", "py_gate_src", "py_lk"]
+        
+        if not os.path.exists(path):
+            os.makedirs(path)
+        
+    def file_name(self,
+                  retrain_id,
+                  epoch):
+        return os.path.join(self.path, str(retrain_id) + '_' + str(epoch) + ".npz")
+    
+    def write(self,
+              retrain_id,
+              epoch,
+              py_tuple):
+        '''
+        Argu.:
+          py_tuple: [py_mean, py_var, py_mean_src, py_var_src, py_gate_src, py_lk], as mixture_statistic.inference
+        '''
+        np.savez(self.file_name(retrain_id, epoch),
+                 **{tmp_name: np.asarray(tmp_py, dtype = np.float32) for tmp_name, tmp_py in zip(self.names, py_tuple)})
+    
+    def bool_has(self,
+                 retrain_id,
+                 epoch):
+        return os.path.exists(self.file_name(retrain_id, epoch))
+    
+    def read(self,
+             retrain_id,
+             epoch):
+        '''
+        Return:
+          [py_mean, py_var, py_mean_src, py_var_src, py_gate_src, py_lk]
+        '''
+        with np.load(self.file_name(retrain_id, epoch)) as tmp_file:
+            return [tmp_file[tmp_name] for tmp_name in self.names]
+
+# ----- snapshot redundancy diagnostics
+'''
+On the predicted means of A snapshots in the order of training, m_sample: [A B],
+only the predictions are used, not the ground-truth.
+'''
+
+def snapshot_autocorrelation(m_sample):
+    '''
+    Return:
+      rho: [A], autocorrelation at lags 0, ..., A-1, averaged over instances
+    '''
+    # [A B]
+    m_sample = np.reshape(np.asarray(m_sample, dtype = np.float64), [len(m_sample), -1])
+    num_sample = len(m_sample)
+    
+    tmp_center = m_sample - np.mean(m_sample, 0, keepdims = True)
+    # [B]
+    tmp_var = np.sum(np.square(tmp_center), 0)
+    # instances with constant predictions carry no information
+    tmp_center = tmp_center[:, tmp_var > 1e-12]
+    tmp_var = tmp_var[tmp_var > 1e-12]
+    
+    if len(tmp_var) == 0:
+        return np.concatenate([[1.0], np.zeros(num_sample - 1)])
+    
+    return np.asarray([np.mean(np.sum(tmp_center[:num_sample - k]*tmp_center[k:], 0)/tmp_var) for k in range(num_sample)])
+
+def snapshot_ess(m_sample):
+    '''
+    Effective sample size, with Geyer's initial positive sequence on the autocorrelation.
+    '''
+    num_sample = len(m_sample)
+    if num_sample < 3:
+        return 1.0*num_sample
+    
+    rho = snapshot_autocorrelation(m_sample)
+    
+    # sums of adjacent pairs, truncated at the first non-positive one
+    tau = -1.0
+    for m in range(0, num_sample - 1, 2):
+        tmp_pair = rho[m] + rho[m + 1]
+        if tmp_pair <= 0:
+            break
+        tau += 2.0*tmp_pair
+    
+    return min(1.0*num_sample, num_sample/max(tau, 1e-8))
+
+def snapshot_disagreement(m_sample):
+    '''
+    Return:
+      [A A], root-mean-square difference of the predictions of each pair of snapshots,
+      relative to the spread of the ensemble mean over instances
+    '''
+    # [A B]
+    m_sample = np.reshape(np.asarray(m_sample, dtype = np.float64), [len(m_sample), -1])
+    
+    tmp_sq_norm = np.sum(np.square(m_sample), 1)
+    # [A A]
+    tmp_sq_dist = np.maximum(tmp_sq_norm[:, None] + tmp_sq_norm[None, :] - 2.0*np.matmul(m_sample, np.transpose(m_sample)), 0.0)
+    
+    return np.sqrt(tmp_sq_dist/m_sample.shape[1])/(np.std(np.mean(m_sample, 0)) + 1e-8)
+
+def snapshot_subset_selection(m_sample,
+                              target_ess = 0.0,
+                              target_diversity = 0.0):
+    '''
+    Smallest subset of the snapshots that reaches the target.
+    
+    Argu.:
+      target_ess: if > 0, the thinning of the snapshot sequence with the fewest snapshots, 
+                  whose effective sample size is at least min(target_ess, ESS of all snapshots)
+      target_diversity: if > 0, farthest-point selection starting at the last snapshot, 
+                        until no remaining snapshot differs from the selected ones by at least target_diversity
+    Return:
+      sorted indices of the selected snapshots, ESS of all snapshots
+    '''
+    num_sample = len(m_sample)
+    ess_all = snapshot_ess(m_sample)
+    
+    if num_sample <= 1:
+        return list(range(num_sample)), ess_all
+    
+    if target_ess > 0:
+        
+        tmp_target = min(target_ess, ess_all)
+        # the largest stride first, the last snapshot is always kept
+        for tmp_stride in range(num_sample, 0, -1):
+            tmp_idx = list(range(num_sample - 1, -1, -tmp_stride))[::-1]
+            if snapshot_ess(m_sample[tmp_idx]) >= tmp_target - 1e-8:
+                return tmp_idx, ess_all
+        return list(range(num_sample)), ess_all
+    
+    elif target_diversity > 0:
+        
+        # [A A]
+        tmp_dist = snapshot_disagreement(m_sample)
+        selected = [num_sample - 1]
+        # distance to the selected set, [A]
+        tmp_min_dist = np.copy(tmp_dist[num_sample - 1])
+        
+        while len(selected) < num_sample:
+            tmp_next = int(np.argmax(tmp_min_dist))
+            if tmp_min_dist[tmp_next] < target_diversity:
+                break
+            selected.append(tmp_next)
+            tmp_min_dist = np.minimum(tmp_min_dist, tmp_dist[tmp_next])
+        
+        return sorted(selected), ess_all
+    
+    return list(range(num_sample)), ess_all
+
+# ----- ensemble pruning
+
+def greedy_ensemble_selection(m_sample,
+                              lk_sample,
+                              y,
+                              metric = "nnllk",
+                              max_size = 10,
+                              tol = 1e-6):
+    '''
+    Greedy forward selection with replacement (Caruana et al., 2004) on validation predictions,
+    the score of a selection is of the uniform mixture over the selected members.
+    
+    Argu.:
+      m_sample: [A B 1] or [A B], predicted means of the candidate members
+      lk_sample: [A B], likelihood of each member
+      y: [B 1] or [B M], the first column is the ground-truth
+      metric: "nnllk" or "rmse"
+      max_size: maximum number of selection steps, the same member can be selected more than once
+      tol: the selection stops when the score improves less than tol
+      
+    Return:
+      members: sorted indices of the selected candidates
+      weights: [len(members)], selection counts normalized to one
+      scores: score after each selection step
+    '''
+    # [A B]
+    m_sample = np.reshape(np.asarray(m_sample, dtype = np.float64), [len(m_sample), -1])
+    lk_sample = np.reshape(np.asarray(lk_sample, dtype = np.float64), [len(m_sample), -1])
+    # [B]
+    y = np.reshape(np.asarray(y, dtype = np.float64), [m_sample.shape[1], -1])[:, 0]
+    
+    num_cand = len(m_sample)
+    counts = np.zeros(num_cand)
+    # running sums over the selected members
+    # [B]
+    sum_m = np.zeros(m_sample.shape[1])
+    sum_lk = np.zeros(m_sample.shape[1])
+    
+    scores = []
+    
+    for tmp_step in range(max_size):
+        
+        # scores of all candidates added to the current selection
+        # [A B]
+        if metric == "nnllk":
+            tmp_scores = np.mean(-1.0*np.log((sum_lk + lk_sample)/(tmp_step + 1.0) + 1e-5), 1)
+        else:
+            tmp_scores = np.sqrt(np.mean(((sum_m + m_sample)/(tmp_step + 1.0) - y)**2, 1))
+        
+        tmp_best = int(np.argmin(tmp_scores))
+        
+        if len(scores) != 0 and tmp_scores[tmp_best] > scores[-1] - tol:
+            break
+        
+        counts[tmp_best] += 1
+        sum_m += m_sample[tmp_best]
+        sum_lk += lk_sample[tmp_best]
+        scores.append(tmp_scores[tmp_best])
+    
+    members = [i for i in range(num_cand) if counts[i] > 0]
+    
+    return members, counts[members]/np.sum(counts), scores
+
+# ----- ensemble weights
+# [A] weights on the simplex, consumed by ensemble_inference.bayesian_inference
+
+def stacking_weights(lk_sample,
+                     num_iter = 500,
+                     tol = 1e-8):
+    '''
+    Weights maximizing the validation log-likelihood of the weighted mixture of the members,
+    by the EM fixed point w_a <- mean_b(w_a lk_ab / sum_a' w_a' lk_a'b).
+    
+    Argu.:
+      lk_sample: [A B], likelihood of each member on the validation data
+    '''
+    # [A B]
+    lk_sample = np.reshape(np.asarray(lk_sample, dtype = np.float64), [len(lk_sample), -1]) + 1e-12
+    
+    w = np.ones(len(lk_sample))/len(lk_sample)
+    llk = -np.inf
+    
+    for _ in range(num_iter):
+        # [B]
+        tmp_mix = np.matmul(w, lk_sample)
+        # [A]
+        w = w*np.mean(lk_sample/tmp_mix, 1)
+        w = w/np.sum(w)
+        
+        tmp_llk = np.mean(np.log(tmp_mix))
+        if tmp_llk - llk < tol:
+            break
+        llk = tmp_llk
+    
+    return w
+
+def kde_importance_weights(snapshot_features,
+                           bandwidth = 0.2):
+    '''
+    Softmax of the Gaussian kernel density log-score of each snapshot among all snapshots,
+    the same scores as sklearn KernelDensity.score_samples, with pairwise distances in one pass.
+    
+    Argu.:
+      snapshot_features: [A M] or [A [M]]
+    '''
+    # [A M]
+    x = np.reshape(np.asarray(snapshot_features, dtype = np.float64), [len(snapshot_features), -1])
+    num_snapshot, dim = x.shape
+    
+    tmp_sq_norm = np.sum(x**2, 1)
+    # [A A]
+    tmp_sq_dist = np.maximum(tmp_sq_norm[:, None] + tmp_sq_norm[None, :] - 2.0*np.matmul(x, np.transpose(x)), 0.0)
+    tmp_log_kernel = -0.5*tmp_sq_dist/bandwidth**2
+    
+    # log-mean-exp over the snapshots
+    # [A]
+    tmp_max = np.max(tmp_log_kernel, 1)
+    kde_score = tmp_max + np.log(np.mean(np.exp(tmp_log_kernel - tmp_max[:, None]), 1)) - 0.5*dim*np.log(2.0*np.pi*bandwidth**2)
+    
+    return softmax_last_axis(kde_score)
+
+# ----- gate uncertainty
+# truncated Gaussian on [left, right] fitted to the gate samples of each instance and source
+
+def truncnorm_std_moments(alpha,
+                          beta,
+                          order = 4):
+    '''
+    Raw moments of the standard normal truncated to [alpha, beta], element-wise.
+    
+    Argu.:
+      alpha, beta: arrays of the same shape, alpha < beta
+    Return:
+      log normalizer log(Phi(beta) - Phi(alpha)), [order + 1 [...]] moments of order 0, ..., order
+    '''
+    from scipy.special import log_ndtr
+    
+    # both bounds in the right tail are mirrored to the left tail, for the precision of the normalizer
+    bool_flip = alpha > 0
+    tmp_a = np.where(bool_flip, -beta, alpha)
+    tmp_b = np.where(bool_flip, -alpha, beta)
+    
+    log_cdf_a = log_ndtr(tmp_a)
+    log_cdf_b = log_ndtr(tmp_b)
+    log_z = log_cdf_b + np.log1p(-np.exp(np.minimum(log_cdf_a - log_cdf_b, -1e-300)))
+    
+    # pdf at the bounds relative to the normalizer
+    pdf_a = np.exp(-0.5*tmp_a**2 - 0.5*np.log(2.0*np.pi) - log_z)
+    pdf_b = np.exp(-0.5*tmp_b**2 - 0.5*np.log(2.0*np.pi) - log_z)
+    
+    # m_k = (k-1) m_{k-2} + (a^{k-1} pdf_a - b^{k-1} pdf_b)
+    moments = [np.ones_like(tmp_a), pdf_a - pdf_b]
+    for k in range(2, order + 1):
+        moments.append((k - 1)*moments[k - 2] + tmp_a**(k - 1)*pdf_a - tmp_b**(k - 1)*pdf_b)
+    
+    # odd moments change sign under the mirroring
+    moments = [np.where(bool_flip, (-1.0)**k*tmp_m, tmp_m) for k, tmp_m in enumerate(moments)]
+    
+    return log_z, moments
+
+def truncnorm_fit(samples,
+                  left = 0.0,
+                  right = 1.0,
+                  num_iter = 100,
+                  tol = 1e-8,
+                  min_scale = 1e-3,
+                  max_std_dist = 20.0):
+    '''
+    Maximum likelihood location and scale of the truncated Gaussian on [left, right], 
+    for all cells of the sample array at once.
+    
+    The truncated Gaussian is in the exponential family with the sufficient statistics (x, x^2), 
+    so the MLE matches the first two sample moments. Fisher scoring on the natural parameters 
+    (loc/scale^2, -1/(2 scale^2)), with a trust region on the location and scale 
+    and step halving on the cells whose likelihood decreases.
+    
+    Argu.:
+      samples: [A ...], e.g. the gate samples [A B S]
+      min_scale: lower bound of the scale, for the cells of constant samples
+      max_std_dist: the location is kept within max_std_dist scales of the interval and the scale within 
+                    max_std_dist interval widths, where the MLE of exponential-like samples is at infinity
+    Return:
+      loc, scale: [...], parameters of the untruncated Gaussian
+      mean, var: [...], moments of the fitted truncated Gaussian
+    '''
+    samples = np.asarray(samples, dtype = np.float64)
+    
+    # sample moments
+    # [...]
+    s1 = np.mean(samples, 0)
+    s2 = np.mean(samples**2, 0)
+    
+    def project(eta1, eta2, loc, scale):
+        # natural parameters to the feasible location and scale, 
+        # within a trust region of the current ones
+        new_scale = np.clip(np.sqrt(-0.5/np.minimum(eta2, -1e-300)), 0.5*scale, 2.0*scale)
+        new_scale = np.clip(new_scale, min_scale, max_std_dist*(right - left))
+        new_loc = np.clip(eta1*new_scale**2, loc - 2.0*scale, loc + 2.0*scale)
+        new_loc = np.clip(new_loc, left - max_std_dist*new_scale, right + max_std_dist*new_scale)
+        return new_loc, new_scale
+    
+    def stats(loc, scale):
+        # average log-likelihood, E[x], Var[x], Cov[x, x^2], Var[x^2]
+        log_z, m = truncnorm_std_moments((left - loc)/scale, 
+                                         (right - loc)/scale)
+        # central moments of the standardized variable
+        c2 = m[2] - m[1]**2
+        c3 = m[3] - 3.0*m[1]*m[2] + 2.0*m[1]**3
+        c4 = m[4] - 4.0*m[1]*m[3] + 6.0*m[1]**2*m[2] - 3.0*m[1]**4
+        
+        e1 = loc + scale*m[1]
+        # x^2 = (e1 + d)^2, d = x - e1
+        v11 = scale**2*c2
+        v12 = 2.0*e1*v11 + scale**3*c3
+        v22 = 4.0*e1**2*v11 + 4.0*e1*scale**3*c3 + scale**4*c4 - v11**2
+        
+        llk = -0.5*(s2 - 2.0*loc*s1 + loc**2)/scale**2 - np.log(scale) - 0.5*np.log(2.0*np.pi) - log_z
+        
+        return llk, e1, v11, v12, v22
+    
+    # initialization by the sample mean and std
+    loc, scale = s1, np.clip(np.sqrt(np.maximum(s2 - s1**2, 0.0)), min_scale, max_std_dist*(right - left))
+    llk, e1, v11, v12, v22 = stats(loc, scale)
+    
+    for _ in range(num_iter):
+        
+        # Newton direction Cov(T)^-1 (s - E[T]) on the natural parameters, 
+        # with a ridge for the degenerate cells
+        g1 = s1 - e1
+        g2 = s2 - (v11 + e1**2)
+        tmp_v11 = v11 + 1e-12
+        tmp_v22 = v22 + 1e-12
+        det = np.maximum(tmp_v11*tmp_v22 - v12**2, 1e-24)
+        d1 = (tmp_v22*g1 - v12*g2)/det
+        d2 = (tmp_v11*g2 - v12*g1)/det
+        
+        eta1 = loc/scale**2
+        eta2 = -0.5/scale**2
+        
+        # step halving on the cells with a decreasing likelihood
+        step = np.ones_like(eta1)
+        for _ in range(10):
+            new_loc, new_scale = project(eta1 + step*d1, 
+                                         eta2 + step*d2,
+                                         loc,
+                                         scale)
+            new_stats = stats(new_loc, new_scale)
+            bool_worse = ~(new_stats[0] >= llk)
+            if not np.any(bool_worse):
+                break
+            step = np.where(bool_worse, 0.5*step, step)
+        
+        # cells without improvement keep the current parameters
+        bool_worse = ~(new_stats[0] >= llk)
+        new_loc = np.where(bool_worse, loc, new_loc)
+        new_scale = np.where(bool_worse, scale, new_scale)
+        new_stats = [np.where(bool_worse, tmp_old, tmp_new) for tmp_old, tmp_new in zip([llk, e1, v11, v12, v22], new_stats)]
+        
+        tmp_gain = np.max(new_stats[0] - llk)
+        
+        loc, scale = new_loc, new_scale
+        llk, e1, v11, v12, v22 = new_stats
+        
+        if tmp_gain < tol:
+            break
+    
+    return loc, scale, e1, v11
@@ -63,49 +63,22 @@ def multi_src_predictor_linear(x,
     
     x_flatten_src = tf.reshape(x_src, [n_src_indi, -1, step_padding*dim_padding])
     
+    # mean, variance and gate logit heads in one batched matmul
     #[S B]    [S]
-    tmp_mean, regu_mean = multi_src_linear(x = x_flatten_src,
-                                           dim_x = step_padding*dim_padding,
-                                           scope = str_scope + "mean", 
-                                           bool_bias = bool_bias[0],
-                                           bool_scope_reuse = bool_scope_reuse[0], 
-                                           num_src = n_src_indi)
-    #[S B]    [S]
-    tmp_var, regu_var = multi_src_linear(x = x_flatten_src,
-                                           dim_x = step_padding*dim_padding,
-                                           scope = str_scope + "var", 
-                                           bool_bias = bool_bias[1],
-                                           bool_scope_reuse = bool_scope_reuse[1], 
-                                           num_src = n_src_indi)
-    #[S B]    [S]
-    tmp_logit, regu_logit = multi_src_linear(x = x_flatten_src,
-                                             dim_x = step_padding*dim_padding,
-                                             scope = str_scope + "gate_logit", 
-                                             bool_bias = bool_bias[2],
-                                             bool_scope_reuse = bool_scope_reuse[2], 
-                                             num_src = n_src_indi)
-    
-
+    [tmp_mean, regu_mean], [tmp_var, regu_var], [tmp_logit, regu_logit] = multi_src_linear_fused(x = x_flatten_src,
+                                                                                               dim_x = step_padding*dim_padding,
+                                                                                               scopes = [str_scope + "mean", str_scope + "var", str_scope + "gate_logit"],
+                                                                                               bool_bias = bool_bias,
+                                                                                               bool_scope_reuse = bool_scope_reuse,
+                                                                                               num_src = n_src_indi)
     if bool_common_factor == True:
         
-        # [B 1]     
-        facor_mean, regu_factor_mean = bilinear(x = x_common, 
-                                                shape_x = [steps[-1], dims[-1]], 
-                                                scope = "factor_mean",
-                                                bool_bias = True,
-                                                bool_scope_reuse = False)
-        # [B 1]
-        facor_var, regu_factor_var = bilinear(x = x_common, 
-                                              shape_x = [steps[-1], dims[-1]], 
-                                              scope = "factor_var",
-                                              bool_bias = True,
-                                              bool_scope_reuse = False)
         # [B 1]
-        facor_logit, regu_factor_logit = bilinear(x = x_common,
-                                                  shape_x = [steps[-1], dims[-1]], 
-                                                  scope = "factor_logit",
-                                                  bool_bias = True,
-                                                  bool_scope_reuse = False)
+        [facor_mean, regu_factor_mean], [facor_var, regu_factor_var], [facor_logit, regu_factor_logit] = bilinear_fused(x = x_common,
+                                                                                                                        shape_x = [steps[-1], dims[-1]],
+                                                                                                                        scopes = ["factor_mean", "factor_var", "factor_logit"],
+                                                                                                                        bool_bias = [True, True, True],
+                                                                                                                        bool_scope_reuse = [False, False, False])
         '''
         factorCell = tempFactorCell(num_units = common_factor_dim, 
                                     initializer = tf.contrib.layers.xavier_initializer())
@@ -148,6 +121,345 @@ def multi_src_predictor_linear(x,
       
     return tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_logit
     
+def multi_src_predictor_linear_topk(x,
+                                    n_src, 
+                                    steps,
+                                    dims,
+                                    bool_bias,
+                                    bool_scope_reuse,
+                                    str_scope,
+                                    top_k):
+    '''
+    multi_src_predictor_linear with sparse gating,
+    the mean and variance heads are only evaluated on the top-k sources by gate logit of each instance.
+    The variables are the same as multi_src_predictor_linear.
+    
+    Argu.:
+      x: [S [B T D]], padded to the same T and D across sources
+      bool_bias: [bool_bias_mean, bool_bias_var, bool_bias_gate]
+      bool_scope_reuse: [mean, var, gate]
+      top_k: int, number of sources evaluated per instance, 0 < top_k <= S
+    
+    Return:
+      the same as multi_src_predictor_linear, [S B] mean and variance are zero on the sources not selected
+    '''
+    if top_k <= 0 or top_k > n_src:
+        raise ValueError("top_k should be in [1, %d]: %d"%(n_src, top_k))
+    
+    step_padding = steps[0]
+    dim_padding = dims[0]
+    dim_x = step_padding*dim_padding
+    
+    # [S B T*D]
+    x_flatten_src = tf.reshape(tf.stack(x, 0), [n_src, -1, dim_x])
+    
+    w_heads, b_heads = multi_src_linear_heads(dim_x = dim_x,
+                                              scopes = [str_scope + "mean", str_scope + "var", str_scope + "gate_logit"],
+                                              bool_bias = bool_bias,
+                                              bool_scope_reuse = bool_scope_reuse,
+                                              num_src = n_src)
+    
+    # -- gate logits on all sources
+    # [S B T*D] * [S T*D 1] -> [S B]
+    tmp_logit = tf.squeeze(tf.matmul(x_flatten_src, tf.transpose(w_heads[2], [0, 2, 1])), [-1]) + b_heads[2]
+    
+    # -- top-k sources of each instance
+    # [B k]
+    _, topk_idx = tf.nn.top_k(tf.transpose(tmp_logit, [1, 0]), 
+                              k = top_k)
+    batch_size = tf.shape(topk_idx)[0]
+    
+    # (instance, source) pairs selected, [B*k]
+    pair_src = tf.reshape(topk_idx, [-1])
+    pair_ins = tf.reshape(tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, top_k]), [-1])
+    
+    pair_pos = tf.range(tf.shape(pair_src)[0])
+    
+    # -- the selected instances of each source against the shared weights of the source,
+    # no per-instance copy of the weights
+    # [S [b_s]]
+    ins_src = tf.dynamic_partition(pair_ins, pair_src, n_src)
+    pos_src = tf.dynamic_partition(pair_pos, pair_src, n_src)
+    # [S T*D 2], [S 2]
+    w_mv = tf.transpose(tf.concat(w_heads[:2], 1), [0, 2, 1])
+    b_mv = tf.concat(b_heads[:2], 1)
+    
+    h_src = []
+    for i in range(n_src):
+        # [b_s T*D] * [T*D 2] -> [b_s 2]
+        h_src.append(tf.matmul(tf.gather(x_flatten_src[i], ins_src[i]), w_mv[i]) + b_mv[i])
+    # [B*k 2]
+    h_pair = tf.dynamic_stitch(pos_src, h_src)
+    
+    # -- back to all sources, zero on the sources not selected
+    # [B*k 2] -> [B S 2] -> [S B 2]
+    h_all = tf.transpose(tf.scatter_nd(tf.stack([pair_ins, pair_src], -1), 
+                                       h_pair, 
+                                       tf.stack([batch_size, n_src, 2])), [1, 0, 2])
+    tmp_mean = h_all[:, :, 0]
+    tmp_var = h_all[:, :, 1]
+    
+    regu_mean, regu_var, regu_logit = [tf.reduce_sum(tf.square(w)) for w in w_heads]
+    
+    return tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_logit
+
+def multi_src_linear_heads(dim_x,
+                           scopes,
+                           bool_bias,
+                           bool_scope_reuse,
+                           num_src):
+    '''
+    Variables of the per-source linear heads, the same as multi_src_linear_fused.
+    
+    Return:
+      [H [S 1 T*D]], [H [S 1]], bias replaced by zero if disabled
+    '''
+    w_heads = []
+    b_heads = []
+    for tmp_scope, tmp_bool_bias, tmp_bool_reuse in zip(scopes, bool_bias, bool_scope_reuse):
+        with tf.variable_scope(tmp_scope, 
+                               reuse = tmp_bool_reuse):
+            # [S 1 T*D]
+            w = tf.get_variable('w', 
+                                shape = [num_src, 1, dim_x],
+                                initializer = tf.contrib.layers.xavier_initializer())
+            b = tf.get_variable("b", 
+                                shape = [num_src, 1], 
+                                initializer = tf.zeros_initializer())
+        w_heads.append(w)
+        b_heads.append(b if tmp_bool_bias == True else tf.zeros_like(b))
+    return w_heads, b_heads
+
+def multi_src_group_logit(x,
+                          num_group,
+                          bool_bias,
+                          bool_scope_reuse,
+                          str_scope):
+    '''
+    Group-level gate logits of the two-level gating,
+    the logit of each group is linear in the mean input of the sources in this group,
+    so that the group gate costs G rather than S linear maps per instance.
+    
+    Argu.:
+      x: [G B T*D], mean input of the sources in each group
+      
+    Return:
+      group logits: [G B], l2 regularization
+    '''
+    dim_x = x.get_shape().as_list()[-1]
+    
+    with tf.variable_scope(str_scope + "group_logit", 
+                           reuse = bool_scope_reuse):
+        # [G 1 T*D]
+        w = tf.get_variable('w', 
+                            shape = [num_group, 1, dim_x],
+                            initializer = tf.contrib.layers.xavier_initializer())
+        b = tf.get_variable("b", 
+                            shape = [num_group, 1], 
+                            initializer = tf.zeros_initializer())
+    
+    # [G B T*D] * [G T*D 1] -> [G B]
+    h = tf.squeeze(tf.matmul(x, tf.transpose(w, [0, 2, 1])), [-1])
+    if bool_bias == True:
+        h = h + b
+    
+    return h, tf.reduce_sum(tf.square(w))
+
+def multi_src_predictor_linear_group(x,
+                                     n_src, 
+                                     steps,
+                                     dims,
+                                     groups,
+                                     group_topk,
+                                     bool_bias,
+                                     bool_scope_reuse,
+                                     str_scope):
+    '''
+    multi_src_predictor_linear with two-level gating,
+    the group logits are evaluated first, then the within-group gate logits, mean and variance heads
+    only on the sources of the top-m groups of each instance.
+    The source heads have the same variables as multi_src_predictor_linear.
+    
+    Argu.:
+      x: [S [B T D]], padded to the same T and D across sources
+      groups: [G [source indices]], covering all sources
+      group_topk: int, number of groups evaluated per instance, 0 < group_topk <= G
+      bool_bias: [bool_bias_mean, bool_bias_var, bool_bias_gate]
+      bool_scope_reuse: [mean, var, gate]
+    
+    Return:
+      the same as multi_src_predictor_linear, [S B] mean, variance and gate logit are zero on the sources not selected,
+      group logits: [G B], group l2 regularization, group mask: [B G]
+    '''
+    num_group = len(groups)
+    if group_topk <= 0 or group_topk > num_group:
+        raise ValueError("group_topk should be in [1, %d]: %d"%(num_group, group_topk))
+    
+    dim_x = steps[0]*dims[0]
+    
+    # [G [S_g B T*D]]
+    x_group_src = [tf.stack([tf.reshape(x[i], [-1, dim_x]) for i in tmp_group], 0) for tmp_group in groups]
+    
+    # -- group logits
+    # [G B]
+    tmp_group_logit, regu_group = multi_src_group_logit(x = tf.stack([tf.reduce_mean(tmp_x, 0) for tmp_x in x_group_src], 0),
+                                                        num_group = num_group,
+                                                        bool_bias = bool_bias[2],
+                                                        bool_scope_reuse = bool_scope_reuse[2],
+                                                        str_scope = str_scope)
+    # -- top-m groups of each instance
+    # [B m]
+    _, topk_idx = tf.nn.top_k(tf.transpose(tmp_group_logit, [1, 0]), 
+                              k = group_topk)
+    batch_size = tf.shape(topk_idx)[0]
+    # [B G]
+    group_mask = tf.reduce_sum(tf.one_hot(topk_idx, num_group), 1)
+    
+    # -- source heads
+    w_heads, b_heads = multi_src_linear_heads(dim_x = dim_x,
+                                              scopes = [str_scope + "mean", str_scope + "var", str_scope + "gate_logit"],
+                                              bool_bias = bool_bias,
+                                              bool_scope_reuse = bool_scope_reuse,
+                                              num_src = n_src)
+    # [S T*D 3], [S 3]
+    w_heads_concat = tf.transpose(tf.concat(w_heads, 1), [0, 2, 1])
+    b_heads_concat = tf.concat(b_heads, 1)
+    
+    # -- the instances of each group selected, evaluated on the sources of this group only
+    # [B*m]
+    pair_group = tf.reshape(topk_idx, [-1])
+    pair_ins = tf.reshape(tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, group_topk]), [-1])
+    # [G [b_g]]
+    ins_group = tf.dynamic_partition(pair_ins, pair_group, num_group)
+    
+    idx_pair = []
+    h_pair = []
+    for tmp_idx, tmp_group in enumerate(groups):
+        # [S_g b_g T*D]
+        tmp_x = tf.gather(x_group_src[tmp_idx], ins_group[tmp_idx], axis = 1)
+        # [S_g b_g T*D] * [S_g T*D 3] -> [S_g b_g 3]
+        h_pair.append(tf.matmul(tmp_x, tf.gather(w_heads_concat, tmp_group)) + tf.expand_dims(tf.gather(b_heads_concat, tmp_group), 1))
+        # [S_g b_g 2], (instance, source)
+        idx_pair.append(tf.stack([tf.tile(tf.expand_dims(ins_group[tmp_idx], 0), [len(tmp_group), 1]), 
+                                  tf.tile(tf.constant(tmp_group, dtype = tf.int32)[:, None], [1, tf.shape(ins_group[tmp_idx])[0]])], -1))
+    
+    # -- back to all sources, zero on the sources not selected
+    # [S_g b_g 3] -> [B S 3] -> [S B 3]
+    h_all = tf.transpose(tf.scatter_nd(tf.concat([tf.reshape(tmp_idx_pair, [-1, 2]) for tmp_idx_pair in idx_pair], 0), 
+                                       tf.concat([tf.reshape(tmp_h, [-1, 3]) for tmp_h in h_pair], 0), 
+                                       tf.stack([batch_size, n_src, 3])), [1, 0, 2])
+    tmp_mean = h_all[:, :, 0]
+    tmp_var = h_all[:, :, 1]
+    tmp_logit = h_all[:, :, 2]
+    
+    regu_mean, regu_var, regu_logit = [tf.reduce_sum(tf.square(w)) for w in w_heads]
+    
+    return tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_logit, tmp_group_logit, regu_group, group_mask
+
+def multi_src_predictor_bilinear(x,
+                                 n_src, 
+                                 steps,
+                                 dims,
+                                 bool_bias,
+                                 bool_scope_reuse,
+                                 str_scope,
+                                 para_share_logit,
+                                 rank):
+    '''
+    Low-rank bilinear counterpart of multi_src_predictor_linear,
+    the [T D] weight of each source and head is factorized as [T k]*[D k]^T.
+    
+    Argu.:
+      x: [S [B T D]], padded to the same T and D across sources
+      bool_bias: [bool_bias_mean, bool_bias_var, bool_bias_gate]
+      bool_scope_reuse: [mean, var, gate]
+      para_share_logit: no_share, share, the gate weights shared across sources
+      rank: k
+    '''
+    step_padding = steps[0]
+    dim_padding = dims[0]
+    
+    # [S [B T D]] -> [S B T D]
+    x_src = tf.stack(x, 0)
+    
+    # mean, variance and gate logit heads in one batched matmul
+    #[S B]    [S]
+    [tmp_mean, regu_mean], [tmp_var, regu_var], [tmp_logit, regu_logit] = multi_src_lowrank_bilinear_fused(x = x_src,
+                                                                                                         shape_x = [step_padding, dim_padding],
+                                                                                                         scopes = [str_scope + "mean", str_scope + "var", str_scope + "gate_logit"],
+                                                                                                         bool_bias = bool_bias,
+                                                                                                         bool_scope_reuse = bool_scope_reuse,
+                                                                                                         bool_share = [False, False, para_share_logit == "share"],
+                                                                                                         num_src = n_src,
+                                                                                                         rank = rank)
+    return tmp_mean, regu_mean, tmp_var, regu_var, tmp_logit, regu_logit
+
+def multi_src_lowrank_bilinear_fused(x, 
+                                     shape_x, 
+                                     scopes, 
+                                     bool_bias,
+                                     bool_scope_reuse, 
+                                     bool_share,
+                                     num_src,
+                                     rank):
+    '''
+    Argu.:
+      x: [S, B, T, D]
+      shape_x: [T, D]
+      scopes: [H], variable scope of each head
+      bool_bias: [H]
+      bool_scope_reuse: [H]
+      bool_share: [H], if True, weights of the head are shared across sources
+      rank: k
+    
+    Return:
+      [H [h, regularization]], h: [S B]
+    '''
+    w_l_heads = []
+    w_r_heads = []
+    b_heads = []
+    regu_heads = []
+    
+    for tmp_scope, tmp_bool_bias, tmp_bool_reuse, tmp_bool_share in zip(scopes, bool_bias, bool_scope_reuse, bool_share):
+        with tf.variable_scope(tmp_scope, 
+                               reuse = tmp_bool_reuse):
+            tmp_num = 1 if tmp_bool_share == True else num_src
+            # [S T k]
+            w_l = tf.get_variable('w_left', 
+                                  [tmp_num, shape_x[0], rank],
+                                  initializer = tf.contrib.layers.xavier_initializer())
+            # [S D k]
+            w_r = tf.get_variable('w_right', 
+                                  [tmp_num, shape_x[1], rank],
+                                  initializer = tf.contrib.layers.xavier_initializer())
+            # [S 1]
+            b = tf.get_variable("b", 
+                                shape = [tmp_num, 1], 
+                                initializer = tf.zeros_initializer())
+        
+        regu_heads.append(tf.reduce_sum(tf.square(w_l)) + tf.reduce_sum(tf.square(w_r)))
+        
+        if tmp_bool_share == True:
+            w_l = tf.tile(w_l, [num_src, 1, 1])
+            w_r = tf.tile(w_r, [num_src, 1, 1])
+            b = tf.tile(b, [num_src, 1])
+        
+        w_l_heads.append(w_l)
+        w_r_heads.append(w_r)
+        b_heads.append(b if tmp_bool_bias == True else tf.zeros_like(b))
+    
+    num_head = len(scopes)
+    
+    # [S B*T D] * [S D H*k] -> [S B T H k]
+    tmp_h = tf.matmul(tf.reshape(x, [num_src, -1, shape_x[1]]), tf.concat(w_r_heads, -1))
+    tmp_h = tf.reshape(tmp_h, [num_src, -1, shape_x[0], num_head, rank])
+    
+    # [S B T H k] * [S 1 T H k] -> [S B H]
+    h = tf.reduce_sum(tmp_h * tf.expand_dims(tf.stack(w_l_heads, 2), 1), [2, 4]) + tf.expand_dims(tf.concat(b_heads, -1), 1)
+    
+             # [S B]             [S]
+    return [[h[:, :, tmp_idx], regu_heads[tmp_idx]] for tmp_idx in range(num_head)]
+
 def multi_src_logit_bilinear(x, 
                              shape_x, 
                              scope, 
@@ -259,6 +571,53 @@ def multi_src_linear(x,
            # [S B]          l2: regularization
     return h, tf.reduce_sum(tf.square(w))
 
+def multi_src_linear_fused(x, 
+                           dim_x, 
+                           scopes, 
+                           bool_bias,
+                           bool_scope_reuse, 
+                           num_src):
+    '''
+    Several heads of multi_src_linear over the same input in one batched matmul,
+    with the same variables and regularization as separate multi_src_linear calls.
+    
+    Argu.:
+      x: [S, B, T*D]
+      dim_x: T*D
+      scopes: [H], variable scope of each head
+      bool_bias: [H]
+      bool_scope_reuse: [H]
+    
+    Return:
+      [H [h, regularization]], h: [S B]
+    '''
+    w_heads = []
+    b_heads = []
+    
+    for tmp_scope, tmp_bool_bias, tmp_bool_reuse in zip(scopes, bool_bias, bool_scope_reuse):
+        with tf.variable_scope(tmp_scope, 
+                               reuse = tmp_bool_reuse):
+            # [S 1 T*D]
+            w = tf.get_variable('w', 
+                                shape = [num_src, 1, dim_x],
+                                initializer = tf.contrib.layers.xavier_initializer())
+            b = tf.get_variable("b", 
+                                shape = [num_src, 1], 
+                                initializer = tf.zeros_initializer())
+        w_heads.append(w)
+        b_heads.append(b if tmp_bool_bias == True else tf.zeros_like(b))
+    
+    # [S T*D H]
+    w_fused = tf.transpose(tf.concat(w_heads, 1), [0, 2, 1])
+    # [S 1 H]
+    b_fused = tf.expand_dims(tf.concat(b_heads, 1), 1)
+    
+    # [S B T*D] * [S T*D H] -> [S B H]
+    h = tf.matmul(x, w_fused) + b_fused
+    
+             # [S B]            l2: regularization
+    return [[h[:, :, tmp_idx], tf.reduce_sum(tf.square(w))] for tmp_idx, w in enumerate(w_heads)]
+
 def multi_src_bilinear(x, 
                        shape_x, 
                        scope,
@@ -354,6 +713,51 @@ def bilinear(x,
     #return h, tf.reduce_sum(tf.square(w_l), 0) + tf.reduce_sum(tf.square(w_r), 0)
     return h, tf.reduce_sum(tf.square(w_l)) + tf.reduce_sum(tf.square(w_r))
     
+def bilinear_fused(x, 
+                   shape_x, 
+                   scopes,
+                   bool_bias,
+                   bool_scope_reuse):
+    '''
+    Several heads of bilinear over the same input, 
+    with the same variables and regularization as separate bilinear calls.
+    
+    Argu.:
+      shape of x: [b, l, r]
+      shape_x: [l, r]
+      scopes: [H], variable scope of each head
+    
+    Return:
+      [H [h, regularization]], h: [B 1]
+    '''
+    w_l_heads = []
+    w_r_heads = []
+    b_heads = []
+    
+    for tmp_scope, tmp_bool_bias, tmp_bool_reuse in zip(scopes, bool_bias, bool_scope_reuse):
+        with tf.variable_scope(tmp_scope, 
+                               reuse = tmp_bool_reuse):
+            w_l = tf.get_variable('w_left', 
+                                  [shape_x[0], 1],
+                                  initializer = tf.contrib.layers.xavier_initializer())
+            w_r = tf.get_variable('w_right', 
+                                  [shape_x[1], 1],
+                                  initializer = tf.contrib.layers.xavier_initializer())
+            b = tf.get_variable("b", 
+                                shape = [1,], 
+                                initializer = tf.zeros_initializer())
+        w_l_heads.append(w_l)
+        w_r_heads.append(w_r)
+        b_heads.append(b if tmp_bool_bias == True else tf.zeros_like(b))
+    
+    # [b l r] * [r H] -> [b l H]
+    tmph = tf.tensordot(x, tf.concat(w_r_heads, 1), 1)
+    # [b l H] * [1 l H] -> [b H]
+    h = tf.reduce_sum(tmph * tf.expand_dims(tf.concat(w_l_heads, 1), 0), 1) + tf.concat(b_heads, 0)
+    
+    # [B 1]   [1]
+    return [[h[:, tmp_idx:tmp_idx+1], tf.reduce_sum(tf.square(w_l)) + tf.reduce_sum(tf.square(w_r))] for tmp_idx, (w_l, w_r) in enumerate(zip(w_l_heads, w_r_heads))]
+    
 # ------ linear factor process
 
 import sys
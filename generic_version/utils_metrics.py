@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+import numpy as np
+
+# ----- error metrics
+# vectorised over the instance axis, y and yhat: [B] or [B 1]
+
+def func_rmse(y,
+              yhat):
+    return np.sqrt(np.mean( (np.asarray(y) - np.asarray(yhat))**2) )
+
+def func_mae(y,
+             yhat):
+    return np.mean(np.abs(np.asarray(y) - np.asarray(yhat)))
+
+def func_mape(y,
+              yhat):
+    y = np.ravel(np.asarray(y, dtype = np.float64))
+    yhat = np.ravel(np.asarray(yhat, dtype = np.float64))
+    # only on ground-truth values away from zero
+    mask = np.abs(y) > 1e-5
+
+    return np.mean(np.abs((yhat[mask] - y[mask])/y[mask]))
+
+def func_pearson(y,
+                 yhat):
+    import scipy as sp
+    return sp.stats.pearsonr(y, yhat)
+
+def func_pred_interval_coverage_prob(y,
+                                     yhat_low,
+                                     yhat_up):
+    y = np.ravel(np.asarray(y))
+    bool_in = (np.ravel(np.asarray(yhat_low)) <= y) & (y <= np.ravel(np.asarray(yhat_up)))
+
+    return 1.0*np.sum(bool_in)/len(y)
+
+def func_pred_interval_width(y,
+                             yhat_low,
+                             yhat_up):
+    '''
+    mean width of the intervals that cover the ground-truth
+    '''
+    y = np.ravel(np.asarray(y))
+    yhat_low = np.ravel(np.asarray(yhat_low))
+    yhat_up = np.ravel(np.asarray(yhat_up))
+    bool_in = (yhat_low <= y) & (y <= yhat_up)
+
+    return 1.0*np.sum((yhat_up - yhat_low)[bool_in])/np.sum(bool_in)
+
+def func_nnllk(lk_sample):
+    '''
+    Argu.:
+      lk_sample: [A B] likelihood of each sample, or [B] of one sample
+    '''
+    lk_sample = np.asarray(lk_sample)
+    if lk_sample.ndim > 1:
+        lk_sample = np.mean(lk_sample, 0)
+
+    return np.mean(-1.0*np.log(lk_sample + 1e-5))
+
+# ----- one-pass evaluation
+
+metric_names = ['rmse', 'mae', 'mape', 'nnllk', 'coverage_model', 'coverage_total', 'width_total']
+
+def metric_sufficient_stats(y,
+                            yhat,
+                            var_model,
+                            var_total,
+                            lk_sample,
+                            interval_multiplier):
+    '''
+    Sums from which all metrics in "metric_names" are recovered,
+    additive over disjoint sets of instances.
+
+    Argu.:
+      y, yhat, var_model, var_total: [B]
+      lk_sample: [A B]
+
+    Return:
+      [num, sum_sq_err, sum_abs_err, num_mape, sum_ape, sum_nllk,
+       num_in_model, num_in_total, sum_width_in_total]
+    '''
+    err = yhat - y
+    abs_err = np.abs(err)
+
+    mask = np.abs(y) > 1e-5
+
+    # intervals
+    half_model = interval_multiplier*np.sqrt(var_model)
+    half_total = interval_multiplier*np.sqrt(var_total)
+    bool_in_model = abs_err <= half_model
+    bool_in_total = abs_err <= half_total
+
+    # [B]
+    nllk = -1.0*np.log(np.mean(lk_sample, 0) + 1e-5)
+
+    return np.asarray([len(y),
+                       np.sum(err**2),
+                       np.sum(abs_err),
+                       np.sum(mask),
+                       np.sum(abs_err[mask]/np.abs(y[mask])),
+                       np.sum(nllk),
+                       np.sum(bool_in_model),
+                       np.sum(bool_in_total),
+                       np.sum(2.0*half_total[bool_in_total])], dtype = np.float64)
+
+def eval_metrics(y,
+                 yhat,
+                 var_model,
+                 var_total,
+                 lk_sample,
+                 interval_multiplier = 2.0,
+                 chunk_size = 0):
+    '''
+    All metrics in one pass over the evaluation set.
+
+    Argu.:
+      y, yhat, var_model, var_total: [B] or [B 1]
+      lk_sample: [A B] likelihood of each ensemble sample, or [B]
+      interval_multiplier: prediction interval, yhat +/- multiplier*std
+      chunk_size: int, if > 0, the instance axis is processed in chunks of this size
+                  to bound the memory of temporaries on very large sets
+
+    Return:
+      [rmse, mae, mape, nnllk, coverage_model, coverage_total, width_total], in the order of "metric_names"
+    '''
+    y = np.ravel(np.asarray(y, dtype = np.float64))
+    yhat = np.ravel(np.asarray(yhat, dtype = np.float64))
+    var_model = np.ravel(np.asarray(var_model, dtype = np.float64))
+    var_total = np.ravel(np.asarray(var_total, dtype = np.float64))
+    # [A B]
+    lk_sample = np.reshape(np.asarray(lk_sample, dtype = np.float64), [-1, len(y)])
+
+    num_ins = len(y)
+    if chunk_size <= 0:
+        chunk_size = num_ins
+
+    stats = np.zeros(9)
+    for tmp_st in range(0, num_ins, int(chunk_size)):
+        tmp_ed = min(num_ins, tmp_st + int(chunk_size))
+        stats += metric_sufficient_stats(y[tmp_st:tmp_ed],
+                                         yhat[tmp_st:tmp_ed],
+                                         var_model[tmp_st:tmp_ed],
+                                         var_total[tmp_st:tmp_ed],
+                                         lk_sample[:, tmp_st:tmp_ed],
+                                         interval_multiplier)
+
+    num, sum_sq_err, sum_abs_err, num_mape, sum_ape, sum_nllk, num_in_model, num_in_total, sum_width = stats
+
+    return [np.sqrt(sum_sq_err/num),
+            sum_abs_err/num,
+            sum_ape/num_mape if num_mape > 0 else np.nan,
+            sum_nllk/num,
+            num_in_model/num,
+            num_in_total/num,
+            sum_width/num_in_total if num_in_total > 0 else np.nan]
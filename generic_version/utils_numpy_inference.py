@@ -0,0 +1,487 @@
+#!/usr/bin/python
+
+import numpy as np
+import pickle
+
+from utils_metrics import *
+from utils_profiling import *
+
+# ----- TensorFlow-free inference for linear mixtures
+'''
+Dictionary of abbreviation, consistent with mixture_models.py:
+   A: number of samples
+   S: source
+   B: batch size
+   T: time steps
+   D: data dimensionality at each time step
+
+Only the exporter imports TensorFlow, lazily. The predictor is pure NumPy.
+'''
+
+# the variable scopes created by multi_src_predictor_linear with str_scope = "linear"
+linear_head_scopes = ["linearmean", "linearvar", "lineargate_logit"]
+linear_head_names = ["mean", "var", "gate"]
+
+def linear_snapshot_export(path_meta,
+                           path_data,
+                           para_train,
+                           path_export = None):
+    '''
+    Dump the weights and biases of the linear heads from one snapshot.
+
+    Argu.:
+      path_meta: snapshot meta graph, e.g. path_model + model_type + '_' + retrain_id + '_' + epoch + '.meta'
+      path_data: snapshot checkpoint, the same path without '.meta'
+      para_train: training set-up of the snapshot
+      path_export: if not None, the exported dictionary is pickled to this path
+
+    Return:
+      dictionary of
+        w_mean, w_var, w_gate: [S T*D]
+        b_mean, b_var, b_gate: [S], zero if the bias is disabled in the head
+        and the set-up needed for inference
+    '''
+    import tensorflow as tf
+
+    if para_train['para_model_type'] != "linear" or para_train['para_add_common_factor'] == True or len(para_train['para_gate_groups']) > 0:
+        print("\n --- EXPORT ERROR: only linear mixtures without common factor and with flat gates ---- \n")
+        return None
+
+    bool_bias = [para_train['para_bool_bias_in_mean'], para_train['para_bool_bias_in_var'], para_train['para_bool_bias_in_gate']]
+
+    tmp_graph = tf.Graph()
+    with tmp_graph.as_default():
+
+        with tf.Session() as sess:
+
+            saver = tf.train.import_meta_graph(path_meta,
+                                               clear_devices = True)
+            saver.restore(sess,
+                          path_data)
+
+            export = {}
+            for tmp_scope, tmp_name, tmp_bool_bias in zip(linear_head_scopes, linear_head_names, bool_bias):
+                # [S 1 T*D], [S 1]
+                tmp_w, tmp_b = sess.run([tmp_graph.get_tensor_by_name(tmp_scope + "/w:0"),
+                                         tmp_graph.get_tensor_by_name(tmp_scope + "/b:0")])
+                # [S T*D]
+                export["w_" + tmp_name] = np.squeeze(tmp_w, 1)
+                # [S]
+                export["b_" + tmp_name] = np.squeeze(tmp_b, 1) if tmp_bool_bias == True else np.zeros(len(tmp_b), dtype = tmp_b.dtype)
+
+    export["para_distr_type"] = para_train['para_distr_type']
+    export["para_var_type"] = para_train['para_var_type']
+    export["para_num_source"] = para_train['para_num_source']
+    export["x_steps"] = para_train['x_steps']
+    export["x_dims"] = para_train['x_dims']
+    export["para_gate_topk"] = para_train['para_gate_topk']
+
+    if path_export != None:
+        pickle.dump(export,
+                    open(path_export, "wb"))
+    return export
+
+# ----- mixture moments
+
+def softmax_last_axis(logits):
+    # logsumexp trick
+    tmp = np.exp(logits - np.max(logits, axis = -1, keepdims = True))
+    return tmp/np.sum(tmp, axis = -1, keepdims = True)
+
+def inv_var_transform(tmp_var,
+                      var_type):
+    '''
+    The same transformation as para_var_type in mixture_statistic.network_ini
+    '''
+    if var_type == "square":
+        return np.square(tmp_var)
+
+    elif var_type == "exp":
+        return np.exp(tmp_var)
+
+    elif var_type == "logexp":
+        # log(exp(x) + 1)
+        return np.logaddexp(0.0, tmp_var)
+
+    print("\n --- VARIANCE TYPE ERROR ---- \n")
+    return None
+
+def mixture_moments(mean_stack,
+                    tmp_var,
+                    gate_logits,
+                    distr_type,
+                    var_type,
+                    y = None,
+                    gate_topk = 0):
+    '''
+    NumPy counterpart of the mixture mean, variance and likelihood in mixture_statistic.network_ini,
+    for the loss type "heter_lk_inv".
+
+    Argu.:
+      mean_stack, tmp_var, gate_logits: [... B S], outputs of the mean, variance and gate heads,
+                                        with any leading axes, e.g. [A B S] for ensembles
+      y: [B 1], the original target, or None to skip the likelihood
+      gate_topk: int, if 0 < gate_topk < S, the gates are renormalized on the top-k logits of each instance
+
+    Return:
+      py_mean: [... B 1]
+      py_var: [... B 1]
+      py_mean_src: [... B S]
+      py_var_src: [... B S]
+      gate_src: [... B S]
+      py_lk: [... B], None if y is None
+    '''
+    # [... B S]
+    inv_var_stack = inv_var_transform(tmp_var,
+                                      var_type)
+    gate_src = softmax_last_axis(gate_logits)
+
+    if 0 < gate_topk < gate_logits.shape[-1]:
+        # [... B S], ties at the k-th logit keep the first indices as tf.nn.top_k
+        topk_idx = np.argsort(-gate_logits, axis = -1, kind = "stable")[..., :gate_topk]
+        gate_mask = np.zeros(gate_logits.shape)
+        np.put_along_axis(gate_mask, topk_idx, 1.0, axis = -1)
+        gate_src = softmax_last_axis(np.where(gate_mask > 0, gate_logits, -np.inf))
+        # the sources not selected have zero mean and unit inverse variance in the sparse graph
+        mean_stack = mean_stack*gate_mask
+        inv_var_stack = gate_mask*inv_var_stack + (1.0 - gate_mask)
+
+    if y is not None:
+        # [B 1]
+        y = np.reshape(np.asarray(y), [-1, 1])
+    py_lk = None
+
+    if distr_type == 'normal':
+
+        # [... B S]
+        py_mean_src = mean_stack
+        py_var_src = 1.0/(inv_var_stack + 1e-5)
+        # [... B 1]
+        py_mean = np.sum(mean_stack*gate_src, -1, keepdims = True)
+        py_var = np.sum((py_var_src + np.square(py_mean_src))*gate_src, -1, keepdims = True) - np.square(py_mean)
+
+        if y is not None:
+            # in the linear scale
+            tmp_lk_src = np.exp(-0.5*np.square(y - py_mean_src)*inv_var_stack)*np.sqrt(0.5/np.pi*inv_var_stack)/(1.0*y + 1e-5)
+            # [... B]
+            py_lk = np.sum(tmp_lk_src*gate_src, -1)
+
+    elif distr_type in ['log_normal_logOpt_linearComb', 'log_normal_linearOpt_linearComb']:
+
+        log_py_var_src = 1.0/(inv_var_stack + 1e-5)
+        log_py_mean_src = mean_stack
+
+        # [... B S]
+        py_mean_src = np.exp(log_py_mean_src + log_py_var_src/2.0)
+        py_var_src = (np.exp(log_py_var_src) - 1.0)*np.exp(2.0*log_py_mean_src + log_py_var_src)
+        # [... B 1]
+        py_mean = np.sum(py_mean_src*gate_src, -1, keepdims = True)
+        py_var = np.sum((py_var_src + np.square(py_mean_src))*gate_src, -1, keepdims = True) - np.square(py_mean)
+
+        if y is not None:
+            log_y = np.log(y + 1e-5)
+            # in the linear scale
+            tmp_lk_src = np.exp(-0.5*np.square(log_y - log_py_mean_src)*inv_var_stack)*np.sqrt(0.5/np.pi*inv_var_stack)/(1.0*y + 1e-5)
+            # [... B]
+            py_lk = np.sum(tmp_lk_src*gate_src, -1)
+
+    elif distr_type == 'log_normal_logOpt_logComb':
+
+        log_py_var_src = 1.0/(inv_var_stack + 1e-5)
+        log_py_mean_src = mean_stack
+
+        # mixture mean and variance of log_y
+        # [... B 1]
+        log_py_mean = np.sum(log_py_mean_src*gate_src, -1, keepdims = True)
+        log_py_var = np.sum((log_py_var_src + np.square(log_py_mean_src))*gate_src, -1, keepdims = True) - np.square(log_py_mean)
+
+        py_mean_src = np.exp(log_py_mean_src + log_py_var_src/2.0)
+        py_mean = np.exp(log_py_mean + log_py_var/2.0)
+
+        py_var_src = (np.exp(log_py_var_src) - 1.0)*np.exp(2.0*log_py_mean_src + log_py_var_src)
+        py_var = (np.exp(log_py_var) - 1.0)*np.exp(2.0*log_py_mean + log_py_var)
+
+        if y is not None:
+            log_y = np.log(y + 1e-5)
+            # [... B]
+            py_lk = np.squeeze(np.exp(-0.5*np.square(log_y - log_py_mean)/(1.0*log_py_var))*np.sqrt(0.5/np.pi/log_py_var)/(1.0*y + 1e-5), -1)
+    else:
+        print("\n --- DISTRIBUTION TYPE ERROR ---- \n")
+        return None
+
+    return py_mean, py_var, py_mean_src, py_var_src, gate_src, py_lk
+
+# ----- predictor
+
+def linear_src_flatten(x):
+    '''
+    Argu.:
+      x: [S [B T D]], padded to the same T and D across sources
+    Return:
+      [S B T*D]
+    '''
+    x_src = np.asarray(x)
+    return np.reshape(x_src, [x_src.shape[0], x_src.shape[1], -1])
+
+class mixture_linear_numpy(object):
+
+    def __init__(self,
+                 export):
+        '''
+        Argu.:
+          export: dictionary returned by linear_snapshot_export, or the path to its pickle
+        '''
+        if isinstance(export, str):
+            export = pickle.load(open(export, "rb"))
+
+        self.distr_type = export["para_distr_type"]
+        self.var_type = export["para_var_type"]
+        # snapshots exported before the sparse gating are dense
+        self.gate_topk = export["para_gate_topk"] if "para_gate_topk" in export else 0
+
+        # [S T*D 3]: mean, variance and gate heads
+        self.w = np.stack([export["w_" + tmp_name] for tmp_name in linear_head_names], -1)
+        # [S 3]
+        self.b = np.stack([export["b_" + tmp_name] for tmp_name in linear_head_names], -1)
+
+    def heads(self,
+              x):
+        '''
+        Argu.:
+          x: [S [B T D]]
+        Return:
+          mean_stack, tmp_var, gate_logits: [B S]
+        '''
+        # [S B T*D] [S T*D 3] -> [S B 3] -> [B S 3]
+        h = np.transpose(np.matmul(linear_src_flatten(x).astype(self.w.dtype),
+                                   self.w), [1, 0, 2]) + self.b
+        return h[:, :, 0], h[:, :, 1], h[:, :, 2]
+
+    def inference(self,
+                  x,
+                  y = None):
+        '''
+        Argu.:
+          x: [S [B T D]]
+          y: [B 1] or [B 3] as fed to mixture_statistic, only the first column is used,
+             if None, py_lk is None
+        Return:
+          py_mean, py_var, py_mean_src, py_var_src, py_gate_src, py_lk,
+          in the order of the prediction tuple of mixture_statistic.inference
+        '''
+        if y is not None:
+            # [B 1]
+            y = np.asarray(y)[:, :1]
+
+        with profiler.stage("linear_heads", num_ins = len(x[0])):
+            mean_stack, tmp_var, gate_logits = self.heads(x)
+
+        with profiler.stage("linear_moments", num_ins = len(x[0])):
+            return mixture_moments(mean_stack,
+                                   tmp_var,
+                                   gate_logits,
+                                   distr_type = self.distr_type,
+                                   var_type = self.var_type,
+                                   y = y,
+                                   gate_topk = self.gate_topk)
+
+# ----- ensemble reduction
+
+def bayesian_ensemble_moments(m_sample,
+                              v_sample,
+                              g_src_sample,
+                              weights = None):
+    '''
+    Argu.:
+      m_sample, v_sample: [A B 1]
+      g_src_sample: [A B S]
+      weights: None for uniform, or [A] non-negative weights of the samples, summing to one
+
+    Return:
+      bayes_mean, bayes_var_total, bayes_var_data, bayes_var_model: [B]
+      bayes_gate_src, bayes_gate_src_var: [B S]
+    '''
+    if weights is None:
+        weights = np.ones(len(m_sample))/len(m_sample)
+    # [A 1]
+    w = np.reshape(np.asarray(weights, dtype = np.float64), [-1, 1])
+    
+    # -- mean
+    # [B]
+    #bayes_mean = np.mean(np.sum(m_src_sample*g_src_sample, axis = 2), axis = 0)
+    bayes_mean = np.sum(w*np.squeeze(m_sample, -1), axis = 0)
+    
+    # -- total variance
+    # [B]
+    sq_mean = bayes_mean**2
+    # [A B 1]
+    var_plus_sq_mean = np.squeeze(v_sample + m_sample**2, -1)
+    # [B]
+    bayes_var_total = np.sum(w*var_plus_sq_mean, 0) - sq_mean
+    
+    # -- data variance
+    # heteroskedasticity
+    # [B]
+    bayes_var_data = np.sum(w*np.squeeze(v_sample, -1), 0)
+    
+    # -- model variance
+    # [B]                       [A B 1]
+    bayes_var_model = np.sum(w*np.squeeze(m_sample**2, -1), 0) - sq_mean
+    
+    # -- gate
+    # [B S]                 [A B S]
+    bayes_gate_src = np.sum(np.expand_dims(w, -1)*g_src_sample, axis = 0)
+    bayes_gate_src_var = np.sum(np.expand_dims(w, -1)*(g_src_sample - bayes_gate_src)**2, axis = 0)
+    
+    return bayes_mean, bayes_var_total, bayes_var_data, bayes_var_model, bayes_gate_src, bayes_gate_src_var
+
+def bayesian_ensemble_reduce(m_src_sample,
+                             v_src_sample,
+                             g_src_sample,
+                             m_sample,
+                             v_sample,
+                             lk_sample,
+                             y,
+                             chunk_size = 0,
+                             weights = None):
+    '''
+    Bayesian model averaging over A samples, shared by ensemble_inference.bayesian_inference
+    and ensemble_linear_numpy.
+
+    Argu.:
+      m_src_sample, v_src_sample, g_src_sample: [A B S]
+      m_sample, v_sample: [A B 1]
+      lk_sample: [A B]
+      y: [B 3], original y, normalizer, deseasonalized y
+      chunk_size: int, if > 0, metrics are evaluated over chunks of instances
+      weights: None for uniform, or [A] weights of the samples, e.g. from the ensemble pruning
+
+    Return:
+      error tuple [], prediction tuple []
+    '''
+    # -- temporary
+    # [B]
+    y_ori = np.asarray([tmp[0] for tmp in y])
+    y_z   = np.asarray([tmp[1] for tmp in y])
+    y_dese = np.asarray([tmp[2] for tmp in y])
+    
+    bayes_mean, bayes_var_total, bayes_var_data, bayes_var_model, bayes_gate_src, bayes_gate_src_var = bayesian_ensemble_moments(m_sample,
+                                                                                                                               v_sample,
+                                                                                                                               g_src_sample,
+                                                                                                                               weights = weights)
+    # the mixture likelihood of the weighted samples
+    if weights is not None:
+        # [1 B]
+        lk_sample = np.sum(np.reshape(weights, [-1, 1])*np.reshape(lk_sample, [len(weights), -1]), 0, keepdims = True)
+    
+    # -- mean of total variance
+    std_total_mean = np.mean(np.sqrt(bayes_var_total))
+    
+    # -- errors
+    # rmse, mae, mape, nnllk, interval coverage on model and total variance, interval width on total variance
+    rmse, mae, mape, nnllk, coverage_model, coverage_total, width_total = eval_metrics(y_ori,
+                                                                                      bayes_mean,
+                                                                                      var_model = bayes_var_model,
+                                                                                      var_total = bayes_var_total,
+                                                                                      lk_sample = lk_sample,
+                                                                                      interval_multiplier = 2.0,
+                                                                                      chunk_size = chunk_size)
+    # -- output
+    # error tuple [], prediction tuple []
+    return [
+        rmse,
+        mae,
+        mape,
+        nnllk,
+        std_total_mean,
+        coverage_model,
+        coverage_total,
+        width_total
+    ],\
+          [
+        bayes_mean,
+        bayes_var_total,
+        bayes_var_data,
+        bayes_var_model,
+        bayes_gate_src,
+        bayes_gate_src_var,
+        g_src_sample, 
+        m_src_sample, 
+        v_src_sample
+    ]
+
+# ----- compiled ensemble
+
+class ensemble_linear_numpy(object):
+
+    def __init__(self,
+                 exports):
+        '''
+        Fold A linear snapshots into one stacked-weight predictor.
+
+        Argu.:
+          exports: [A], dictionaries returned by linear_snapshot_export, or paths to their pickles,
+                   sharing the same distribution and variance set-up
+        '''
+        exports = [pickle.load(open(tmp, "rb")) if isinstance(tmp, str) else tmp for tmp in exports]
+
+        self.distr_type = exports[0]["para_distr_type"]
+        self.var_type = exports[0]["para_var_type"]
+        self.gate_topk = exports[0]["para_gate_topk"] if "para_gate_topk" in exports[0] else 0
+
+        # [A S T*D 3]: mean, variance and gate heads
+        self.w = np.stack([np.stack([tmp["w_" + tmp_name] for tmp_name in linear_head_names], -1) for tmp in exports], 0)
+        # [A 1 S 3]
+        self.b = np.expand_dims(np.stack([np.stack([tmp["b_" + tmp_name] for tmp_name in linear_head_names], -1) for tmp in exports], 0), 1)
+
+    def samples(self,
+                x,
+                y = None):
+        '''
+        Argu.:
+          x: [S [B T D]]
+          y: [B 1] or [B 3], only the first column is used
+        Return:
+          py_mean, py_var: [A B 1]
+          py_mean_src, py_var_src, py_gate_src: [A B S]
+          py_lk: [A B], None if y is None
+        '''
+        if y is not None:
+            y = np.asarray(y)[:, :1]
+
+        # one batched matmul over samples and sources
+        # [1 S B T*D] [A S T*D 3] -> [A S B 3] -> [A B S 3]
+        with profiler.stage("ensemble_linear_heads", num_ins = len(x[0])):
+            h = np.transpose(np.matmul(np.expand_dims(linear_src_flatten(x).astype(self.w.dtype), 0),
+                                       self.w), [0, 2, 1, 3]) + self.b
+
+        with profiler.stage("ensemble_linear_moments", num_ins = len(x[0])):
+            return mixture_moments(h[..., 0],
+                                   h[..., 1],
+                                   h[..., 2],
+                                   distr_type = self.distr_type,
+                                   var_type = self.var_type,
+                                   y = y,
+                                   gate_topk = self.gate_topk)
+
+    def bayesian_inference(self,
+                           x,
+                           y,
+                           chunk_size = 0):
+        '''
+        Argu.:
+          x: [S [B T D]]
+          y: [B 3], original y, normalizer, deseasonalized y
+        Return:
+          error tuple [], prediction tuple [], the same as ensemble_inference.bayesian_inference
+        '''
+        py_mean, py_var, py_mean_src, py_var_src, py_gate_src, py_lk = self.samples(x, y)
+
+        return bayesian_ensemble_reduce(m_src_sample = py_mean_src,
+                                        v_src_sample = py_var_src,
+                                        g_src_sample = py_gate_src,
+                                        m_sample = py_mean,
+                                        v_sample = py_var,
+                                        lk_sample = py_lk,
+                                        y = y,
+                                        chunk_size = chunk_size)
@@ -23,6 +23,7 @@ from tensorflow.python.ops import gen_random_ops
 # pylint: disable=wildcard-import
 from tensorflow.python.ops.gen_random_ops import *
 import tensorflow as tf
+import numpy as np
 
 '''
 https://www.tensorflow.org/api_docs/python/tf/disable_resource_variables
@@ -1457,3 +1458,122 @@ class StochasticGradientLangevinDynamics(optimizer.Optimizer):
           shape=result_shape, mean=mean, stddev=stddev, dtype=grad.dtype)
 
 
+class flat_sg_mcmc(object):
+  """
+  Flat-buffer counterpart of sg_mcmc_adam, sg_mcmc_adam_revision, sg_mcmc_RMSprop and
+  StochasticGradientLangevinDynamics.
+  
+  The gradients of all trainable variables are packed into one vector [P],
+  the preconditioner slots are two [P] buffers, and the moment update, the drift and
+  the Gaussian noise are a handful of vector ops on [P] instead of a set of ops per variable.
+  The update rules are the same as the per-variable optimizers.
+  """
+
+  def __init__(self,
+               learning_rate,
+               method,
+               beta1 = 0.9,
+               beta2 = 0.999,
+               epsilon = 1e-8,
+               preconditioner_decay_rate = 0.95,
+               data_size = 1,
+               burnin = 200,
+               diagonal_bias = 1e-8,
+               noise_scale = 1.0,
+               name = "flat_sg_mcmc"):
+    '''
+    Argu.:
+      method: "sg_mcmc_adam", "sg_mcmc_adam_revision", "sg_mcmc_RMSprop" or "sgld"
+      beta1, beta2, epsilon: as sg_mcmc_adam and sg_mcmc_RMSprop
+      preconditioner_decay_rate, data_size, burnin, diagonal_bias: as StochasticGradientLangevinDynamics
+      noise_scale: float or scalar tensor multiplying the injected noise, e.g. 0 in the exploration phase of cyclical schedules
+    '''
+    if method not in ["sg_mcmc_adam", "sg_mcmc_adam_revision", "sg_mcmc_RMSprop", "sgld"]:
+      print("\n --- OPTIMIZER ERROR ---- \n")
+    
+    self._lr = learning_rate
+    self._method = method
+    self._beta1 = beta1
+    self._beta2 = beta2
+    self._epsilon = epsilon
+    self._decay = preconditioner_decay_rate
+    self._data_size = data_size
+    self._burnin = burnin
+    self._diagonal_bias = diagonal_bias
+    self._noise_scale = noise_scale
+    self._name = name
+
+  def minimize(self,
+               loss,
+               global_step = None,
+               var_list = None):
+    
+    if var_list is None:
+      var_list = tf.trainable_variables()
+    
+    with tf.name_scope(self._name):
+      
+      # ----- pack
+      grads = tf.gradients(loss, var_list)
+      grads = [tf.zeros_like(v) if g is None else tf.convert_to_tensor(g) for g, v in zip(grads, var_list)]
+      
+      var_sizes = [int(np.prod(v.get_shape().as_list())) for v in var_list]
+      num_para = sum(var_sizes)
+      # [P]
+      g = tf.concat([tf.reshape(tmp_g, [-1]) for tmp_g in grads], 0)
+      
+      # ----- slots
+      with tf.variable_scope(self._name):
+        # first and second moments, or the RMS preconditioner of SGLD
+        m = tf.get_variable("m", shape = [num_para], initializer = tf.zeros_initializer(), trainable = False)
+        v = tf.get_variable("v", shape = [num_para], initializer = tf.zeros_initializer(), trainable = False)
+        beta1_power = tf.get_variable("beta1_power", initializer = tf.constant(self._beta1, tf.float32), trainable = False)
+        beta2_power = tf.get_variable("beta2_power", initializer = tf.constant(self._beta2, tf.float32), trainable = False)
+        iterations = tf.get_variable("iterations", initializer = tf.constant(0, tf.int64), trainable = False)
+      
+      lr_t = tf.cast(self._lr, tf.float32)
+      # one draw for all parameters
+      rnd = tf.random.normal([num_para]) * self._noise_scale
+      
+      # ----- fused update, [P]
+      if self._method == "sgld":
+        
+        stddev = tf.where(iterations > tf.cast(self._burnin, tf.int64),
+                          tf.math.rsqrt(lr_t),
+                          tf.zeros([]))
+        v_t = tf.assign(v, self._decay * v + (1.0 - self._decay) * tf.square(g))
+        preconditioner = tf.math.rsqrt(v_t + self._diagonal_bias)
+        new_grad = 0.5 * preconditioner * g * tf.cast(self._data_size, tf.float32) + rnd * stddev * tf.sqrt(preconditioner)
+        delta = lr_t * new_grad
+        slot_updates = [v_t]
+        
+      else:
+        lr = lr_t * tf.sqrt(1.0 - beta2_power) / (1.0 - beta1_power)
+        v_t = tf.assign(v, self._beta2 * v + (1.0 - self._beta2) * g * g)
+        v_sqrt = tf.sqrt(v_t)
+        
+        if self._method == "sg_mcmc_RMSprop":
+          inject_noise = rnd * tf.sqrt(1.0 * lr / (v_sqrt + self._epsilon))
+          delta = lr * g / (v_sqrt + self._epsilon) - inject_noise
+          slot_updates = [v_t]
+          
+        else:
+          m_t = tf.assign(m, self._beta1 * m + (1.0 - self._beta1) * g)
+          inject_noise = rnd * tf.sqrt(lr * (1.0 - self._beta1) * (1.0 - self._beta1) / (v_sqrt + self._epsilon))
+          if self._method == "sg_mcmc_adam":
+            delta = lr * m_t / (v_sqrt + self._epsilon) - inject_noise
+          else:
+            delta = lr * m_t / (v_sqrt + self._epsilon) + inject_noise
+          slot_updates = [m_t, v_t]
+      
+      # ----- unpack
+      var_updates = [tf.assign_sub(tmp_v, tf.reshape(tmp_delta, tf.shape(tmp_v))) for tmp_v, tmp_delta in zip(var_list, tf.split(delta, var_sizes))]
+      
+      with tf.control_dependencies(var_updates + slot_updates):
+        step_updates = [tf.assign(beta1_power, beta1_power * self._beta1),
+                        tf.assign(beta2_power, beta2_power * self._beta2),
+                        tf.assign_add(iterations, 1)]
+        if global_step is not None:
+          step_updates.append(tf.assign_add(global_step, 1))
+      
+      return tf.group(*(var_updates + step_updates))
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+import numpy as np
+import time
+import json
+import collections
+
+# ----- stage-wise latency and throughput
+
+class null_stage(object):
+    # shared no-op context, used when profiling is off
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class timed_stage(object):
+
+    def __init__(self,
+                 profiler,
+                 name,
+                 num_ins):
+        self.profiler = profiler
+        self.name = name
+        self.num_ins = num_ins
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name,
+                             time.perf_counter() - self.start,
+                             self.num_ins)
+        return False
+
+class stage_profiler(object):
+
+    def __init__(self,
+                 window = 10000):
+        '''
+        Argu.:
+          window: int, number of latest latencies kept per stage for the percentiles
+        '''
+        self.enabled = False
+        self.window = window
+        self.null = null_stage()
+        self.reset()
+
+    def reset(self):
+        # stage: deque of seconds
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen = self.window))
+        # stage: [calls, instances, total seconds]
+        self.counter = collections.defaultdict(lambda: [0, 0, 0.0])
+        self.wall_start = time.time()
+
+    def stage(self,
+              name,
+              num_ins = 0):
+        '''
+        Usage:
+          with profiler.stage("name", num_ins = B):
+              ...
+        '''
+        if self.enabled == False:
+            return self.null
+        return timed_stage(self, name, num_ins)
+
+    def record(self,
+               name,
+               seconds,
+               num_ins = 0):
+        self.latency[name].append(seconds)
+        tmp_counter = self.counter[name]
+        tmp_counter[0] += 1
+        tmp_counter[1] += num_ins
+        tmp_counter[2] += seconds
+
+    def summary(self):
+        '''
+        Return:
+          {stage: {calls, instances, total_sec, p50_ms, p95_ms, p99_ms, mean_ms, instances_per_sec}}
+        '''
+        summary = {}
+        for tmp_name in self.counter:
+            tmp_calls, tmp_ins, tmp_total = self.counter[tmp_name]
+            # [window]
+            tmp_ms = 1000.0*np.asarray(self.latency[tmp_name])
+            p50, p95, p99 = np.percentile(tmp_ms, [50, 95, 99])
+
+            summary[tmp_name] = {"calls": tmp_calls,
+                                 "instances": tmp_ins,
+                                 "total_sec": tmp_total,
+                                 "p50_ms": float(p50),
+                                 "p95_ms": float(p95),
+                                 "p99_ms": float(p99),
+                                 "mean_ms": 1000.0*tmp_total/tmp_calls,
+                                 "instances_per_sec": tmp_ins/tmp_total if tmp_total > 0 else 0.0}
+        return summary
+
+    def dump_json(self,
+                  path):
+        with open(path, "w") as json_file:
+            json.dump({"wall_sec": time.time() - self.wall_start,
+                       "stages": self.summary()},
+                      json_file,
+                      indent = 2)
+
+    def dump_prometheus(self,
+                        path,
+                        prefix = "mixture"):
+        '''
+        Prometheus text exposition format, a summary of latency and a counter of instances per stage,
+        each metric family in one block under its own # HELP and # TYPE
+        '''
+        summary = self.summary()
+        
+        # -- latency summary
+        lines = ["# HELP %s_stage_latency_seconds latency of each stage in seconds"%(prefix),
+                 "# TYPE %s_stage_latency_seconds summary"%(prefix)]
+        for tmp_name, tmp_stats in summary.items():
+            for tmp_q, tmp_key in [("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")]:
+                lines.append('%s_stage_latency_seconds{stage="%s",quantile="%s"} %.9f'%(prefix, tmp_name, tmp_q, tmp_stats[tmp_key]/1000.0))
+            lines.append('%s_stage_latency_seconds_sum{stage="%s"} %.9f'%(prefix, tmp_name, tmp_stats["total_sec"]))
+            lines.append('%s_stage_latency_seconds_count{stage="%s"} %d'%(prefix, tmp_name, tmp_stats["calls"]))
+        
+        # -- instance counter
+        lines += ["# HELP %s_stage_instances_total instances processed by each stage"%(prefix),
+                  "# TYPE %s_stage_instances_total counter"%(prefix)]
+        for tmp_name, tmp_stats in summary.items():
+            lines.append('%s_stage_instances_total{stage="%s"} %d'%(prefix, tmp_name, tmp_stats["instances"]))
+
+        with open(path, "w") as text_file:
+            text_file.write("\n".join(lines) + "\n")
+
+    def dump(self,
+             path):
+        # the format follows the file extension, ".json" or Prometheus text otherwise
+        if path.endswith(".json"):
+            self.dump_json(path)
+        else:
+            self.dump_prometheus(path)
+
+# shared by the models, the ensembles and the pipeline
+profiler = stage_profiler()
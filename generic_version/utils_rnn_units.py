@@ -23,7 +23,11 @@ def multi_src_predictor_rnn(x,
                             rnn_cell_type,
                             dropout_keep,
                             dense_num,
-                            max_norm_cons):
+                            max_norm_cons,
+                            steps,
+                            dims,
+                            encoder_type,
+                            seed = 1):
     
     '''
     Argu.:
@@ -31,28 +35,55 @@ def multi_src_predictor_rnn(x,
          [S+1 [B T D]] when bool_common_factor = True
       bool_bias: [bool_bias_mean, bool_bias_var, bool_bias_gate]
       bool_scope_reuse: [mean, var, gate]
+      steps, dims: [S], T and D of each source
+      encoder_type: "plain", one RNN per source, 
+                    "block" or "fused", one RNN per source on the CPU-efficient block kernels, or 
+                    "batched", all sources in one recurrent loop
+      seed: int, of the initializers and dropout masks, e.g. one per chain of multi-chain sampling
     '''
-    np.random.seed(1)
-    tf.set_random_seed(1)
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
     
     x_list = x
     
-    # --- data source specific RNN encoder
-    h_list = []
-    for i in range(n_src):
-        h, _  = plain_rnn(x = x_list[i],
-                          dim_layers = rnn_size_layers,
-                          scope = str_scope + "_rnn_" + str(i),
-                          dropout_keep_prob = dropout_keep,
-                          cell_type = rnn_cell_type)
-        # obtain the last hidden state
-        # [B T d] -> [T B d]
-        tmp_h = tf.transpose(h, [1,0,2])
-        # [S, B d]
-        h_list.append(tmp_h[-1])
-    
-    # [S B d]
-    h_src = tf.stack(h_list, 0)
+    if encoder_type == "batched":
+        # --- all data sources in one recurrent loop
+        # [S B d]
+        h_src = multi_src_rnn_encoder(x = x_list,
+                                      steps = steps,
+                                      dims = dims,
+                                      dim_layers = rnn_size_layers,
+                                      scope = str_scope + "_rnn_batched",
+                                      dropout_keep_prob = dropout_keep,
+                                      cell_type = rnn_cell_type,
+                                      seed = seed)
+    else:
+        # --- data source specific RNN encoder
+        h_list = []
+        for i in range(n_src):
+            if encoder_type in ["block", "fused"]:
+                h, _  = block_rnn(x = x_list[i],
+                                  dim_layers = rnn_size_layers,
+                                  scope = str_scope + "_rnn_" + str(i),
+                                  dropout_keep_prob = dropout_keep,
+                                  cell_type = rnn_cell_type,
+                                  bool_fused = (encoder_type == "fused"),
+                                  seed = seed)
+            else:
+                h, _  = plain_rnn(x = x_list[i],
+                                  dim_layers = rnn_size_layers,
+                                  scope = str_scope + "_rnn_" + str(i),
+                                  dropout_keep_prob = dropout_keep,
+                                  cell_type = rnn_cell_type,
+                                  seed = seed)
+            # obtain the last hidden state
+            # [B T d] -> [T B d]
+            tmp_h = tf.transpose(h, [1,0,2])
+            # [S, B d]
+            h_list.append(tmp_h[-1])
+        
+        # [S B d]
+        h_src = tf.stack(h_list, 0)
     
     # --- mean
     # [S B d]
@@ -64,7 +95,8 @@ def multi_src_predictor_rnn(x,
                                                       num_vari = n_src,
                                                       activation_type = "relu",
                                                       max_norm_regul = max_norm_cons,
-                                                      regul_type = "l2")
+                                                      regul_type = "l2",
+                                                      seed = seed)
     # output layer
     # [S B 1] 
     # no dropout on output layer
@@ -75,7 +107,8 @@ def multi_src_predictor_rnn(x,
                                         dim_to = 1, 
                                         activation_type = "", 
                                         max_norm_regul = max_norm_cons, 
-                                        regul_type = "l2")
+                                        regul_type = "l2",
+                                        seed = seed)
     
     regu_mean = reg_mean_h + regu_mean_pred
     
@@ -91,7 +124,8 @@ def multi_src_predictor_rnn(x,
                                                    num_vari = n_src,
                                                    activation_type = "tanh",
                                                    max_norm_regul = max_norm_cons,
-                                                   regul_type = "l2")
+                                                   regul_type = "l2",
+                                                   seed = seed)
     # output layer
     # [S B 1]
     # no dropout on output layer
@@ -102,7 +136,8 @@ def multi_src_predictor_rnn(x,
                                       dim_to = 1, 
                                       activation_type = "", 
                                       max_norm_regul = max_norm_cons, 
-                                      regul_type = "l2")
+                                      regul_type = "l2",
+                                      seed = seed)
     
     regu_var = reg_var_h + regu_var_pred
     
@@ -141,7 +176,8 @@ def multi_src_predictor_rnn(x,
                                      dim_to = 1, 
                                      activation_type = "", 
                                      max_norm_regul = max_norm_cons, 
-                                     regul_type = "l2")
+                                     regul_type = "l2",
+                                     seed = seed)
     
     return tf.squeeze(tmp_mean), regu_mean, tf.squeeze(tmp_var), regu_var, tf.squeeze(tmp_logit), regu_logit
 
@@ -155,7 +191,8 @@ def multi_mv_dense(num_layers,
                    num_vari,
                    activation_type,
                    max_norm_regul,
-                   regul_type):
+                   regul_type,
+                   seed = 1):
     '''
     Argu.:
       h_vari: [V B D] -> [V B d]
@@ -181,7 +218,7 @@ def multi_mv_dense(num_layers,
                 # h_mv [V B d]
                 h_mv_input = tf.nn.dropout(h_mv_input, 
                                            keep_prob, 
-                                           seed = 1)
+                                           seed = seed)
             # ? max norm constrains
             h_mv_input, tmp_regu_dense = mv_dense(h_vari = h_mv_input, 
                                                   dim_vari = in_dim_vari,
@@ -190,7 +227,8 @@ def multi_mv_dense(num_layers,
                                                   dim_to = out_dim_vari,
                                                   activation_type = activation_type, 
                                                   max_norm_regul = max_norm_regul, 
-                                                  regul_type = regul_type)
+                                                  regul_type = regul_type,
+                                                  seed = seed)
             reg_mv_dense += tmp_regu_dense
             
             in_dim_vari = out_dim_vari
@@ -206,7 +244,8 @@ def mv_dense(h_vari,
              dim_to, 
              activation_type, 
              max_norm_regul, 
-             regul_type):
+             regul_type,
+             seed = 1):
     '''
     Argu.:
       h_vari: [V B D] -> [V B d]
@@ -219,26 +258,23 @@ def mv_dense(h_vari,
         # [V 1 D d]
         w = tf.get_variable('w',  
                             [num_vari, 1, dim_vari, dim_to], 
-                            initializer = tf.contrib.layers.xavier_initializer(seed = 1))
+                            initializer = tf.contrib.layers.xavier_initializer(seed = seed))
         # [V 1 1 d]
         b = tf.get_variable("b", 
                             shape = [num_vari, 1, 1, dim_to], 
                             initializer = tf.zeros_initializer())
-        # [V B D 1]
-        h_expand = tf.expand_dims(h_vari, -1)
-        
         if max_norm_regul > 0:
             clipped = tf.clip_by_norm(w, 
                                       clip_norm = max_norm_regul, 
                                       axes = 2)
             clip_w = tf.assign(w, clipped)
-            
-            tmp_h =  tf.reduce_sum(h_expand * clip_w + b, 2)
-            
         else:
-            tmp_h =  tf.reduce_sum(h_expand * w + b, 2)
-            
-        # [V B D 1] * [V 1 D d] -> [V B d]
+            clip_w = w
+        
+        # batched matmul, the bias is added once
+        # [V B D] * [V D d] + [V 1 d] -> [V B d]
+        tmp_h = tf.matmul(h_vari, tf.squeeze(clip_w, [1])) + tf.squeeze(b, [1])
+        
         if activation_type == "relu":
             h = tf.nn.relu(tmp_h)
         elif activation_type == "tanh":
@@ -312,11 +348,253 @@ def cudnn_rnn(x,
                                        dtype = tf.float32)
     return hiddens, state
     
+def multi_src_kernel_initializer(dims_in,
+                                 max_dim_in,
+                                 seed):
+    '''
+    Initializer of the batched kernel [S D+d 4d] of multi_src_rnn_encoder.
+    Each source slice is drawn by glorot_normal on its own [D_s+d 4d] shape, as the cell of plain_rnn, 
+    rather than on the fans of the whole [S D+d 4d] variable, which shrink the scale with S.
+    The rows of the padded input dimensions are zero.
+    
+    Argu.:
+      dims_in: [S], input dimension D_s of each source
+      max_dim_in: int, padded input dimension D
+    '''
+    def initializer(shape, 
+                    dtype = tf.float32, 
+                    partition_info = None):
+        kernel_src = []
+        for i in range(shape[0]):
+            # [D_s+d 4d], the seed of the lstm cells of plain_rnn
+            tmp_kernel = tf.contrib.keras.initializers.glorot_normal(seed = seed)([shape[1] - max_dim_in + dims_in[i], shape[2]], 
+                                                                                dtype = dtype)
+            # [D+d 4d]
+            kernel_src.append(tf.concat([tmp_kernel[:dims_in[i]], 
+                                         tf.zeros([max_dim_in - dims_in[i], shape[2]], dtype = dtype), 
+                                         tmp_kernel[dims_in[i]:]], 0))
+        return tf.stack(kernel_src, 0)
+    
+    return initializer
+
+def multi_src_rnn_encoder(x,
+                          steps,
+                          dims,
+                          dim_layers,
+                          scope,
+                          dropout_keep_prob,
+                          cell_type,
+                          sequence_length = None,
+                          seed = 1):
+    '''
+    All data sources in one recurrent loop, with source-specific weights in a batched cell.
+    Only the last hidden state is kept.
+    
+    Argu.:
+      x: [S [B T D]], T and D can differ across sources
+      steps: [S], T of each source
+      dims: [S], D of each source
+      dim_layers: [int]
+      dropout_keep_prob: float or scalar tensor
+      cell_type: lstm, gru
+      sequence_length: [S] or [S B], number of valid steps, by default "steps"
+                       states are not updated after the last valid step of a source
+    
+    Return:
+      h: [S B d], the output of the last layer at the last valid step, 
+         the dropout is on the recurrent states only, as DropoutWrapper in plain_rnn
+    '''
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
+    
+    n_src = len(x)
+    max_step = max(steps)
+    max_dim = max(dims)
+    
+    # -- padding at the end of time steps and dimensions, as data_padding_x
+    # [S B T D]
+    x_src = tf.stack([tf.pad(x[i], [[0, 0], [0, max_step - steps[i]], [0, max_dim - dims[i]]]) for i in range(n_src)], 0)
+    # [T S B D]
+    x_time = tf.transpose(x_src, [2, 0, 1, 3])
+    
+    if sequence_length is None:
+        sequence_length = steps
+    # [S 1 1] or [S B 1]
+    seq_len = tf.cast(tf.convert_to_tensor(sequence_length), tf.int32)
+    seq_len = tf.reshape(seq_len, [n_src, -1, 1])
+    
+    num_gate = 4 if cell_type == 'lstm' else 3
+    
+    # -- batched cell weights
+    kernels = []
+    biases = []
+    with tf.variable_scope(scope):
+        for i in range(len(dim_layers)):
+            tmp_dim_in = (max_dim if i == 0 else dim_layers[i-1]) + dim_layers[i]
+            # [S D+d 4d] for lstm, [S D+d 3d] for gru
+            kernels.append(tf.get_variable('kernel' + str(i),
+                                           [n_src, tmp_dim_in, num_gate*dim_layers[i]],
+                                           initializer = multi_src_kernel_initializer(dims_in = dims if i == 0 else [dim_layers[i-1]]*n_src,
+                                                                                      max_dim_in = max_dim if i == 0 else dim_layers[i-1],
+                                                                                      seed = seed)))
+            # [S 1 4d] or [S 1 3d]
+            biases.append(tf.get_variable('bias' + str(i),
+                                          [n_src, 1, num_gate*dim_layers[i]],
+                                          initializer = tf.zeros_initializer()))
+    
+    def cell_step(tmp_x, 
+                  tmp_state, 
+                  tmp_layer):
+        # tmp_x: [S B D], tmp_state: [c, h] for lstm, [h] for gru
+        d = dim_layers[tmp_layer]
+        
+        if cell_type == 'lstm':
+            c, h = tmp_state
+            # [S B D+d] * [S D+d 4d] -> [S B 4d]
+            z = tf.matmul(tf.concat([tmp_x, h], -1), kernels[tmp_layer]) + biases[tmp_layer]
+            i, j, f, o = tf.split(z, 4, axis = -1)
+            # forget bias 1.0, as in LSTMCell
+            new_c = tf.sigmoid(f + 1.0)*c + tf.sigmoid(i)*tf.tanh(j)
+            new_h = tf.sigmoid(o)*tf.tanh(new_c)
+            return [new_c, new_h]
+        
+        elif cell_type == 'gru':
+            h = tmp_state[0]
+            w_gate, w_cand = tf.split(kernels[tmp_layer], [2*d, d], axis = -1)
+            b_gate, b_cand = tf.split(biases[tmp_layer], [2*d, d], axis = -1)
+            # [S B 2d], gate bias 1.0, as the initial gate bias of GRUCell
+            r, u = tf.split(tf.sigmoid(tf.matmul(tf.concat([tmp_x, h], -1), w_gate) + b_gate + 1.0), 2, axis = -1)
+            # [S B d]
+            cand = tf.tanh(tf.matmul(tf.concat([tmp_x, r*h], -1), w_cand) + b_cand)
+            return [u*h + (1.0 - u)*cand]
+    
+    # -- recurrent loop over time steps
+    batch_size = tf.shape(x_src)[1]
+    num_state = 2 if cell_type == 'lstm' else 1
+    # [L [c, h]], [S B d]
+    ini_states = [[tf.zeros([n_src, batch_size, d]) for _ in range(num_state)] for d in dim_layers]
+    # [S B d], the output of the last layer
+    ini_output = tf.zeros([n_src, batch_size, dim_layers[-1]])
+    
+    def loop_cond(t, 
+                  states,
+                  output):
+        return t < max_step
+    
+    def loop_body(t, 
+                  states,
+                  output):
+        # [S B 1]
+        valid_mask = tf.cast(tf.less(t, seq_len), tf.float32)
+        tmp_input = x_time[t]
+        new_states = []
+        
+        for tmp_layer in range(len(dim_layers)):
+            # dropout on the input of upper layers, as plain_rnn
+            if tmp_layer != 0:
+                tmp_input = tf.nn.dropout(tmp_input, 
+                                          dropout_keep_prob, 
+                                          seed = seed)
+            tmp_state = cell_step(tmp_input, 
+                                  states[tmp_layer], 
+                                  tmp_layer)
+            # the emitted output is not dropped, as DropoutWrapper with state_keep_prob only
+            tmp_output = tmp_state[-1]
+            # dropout on the recurrent hidden state, not on the lstm memory
+            tmp_state[-1] = tf.nn.dropout(tmp_state[-1], 
+                                          dropout_keep_prob, 
+                                          seed = seed)
+            # keep the state after the last valid step
+            tmp_state = [valid_mask*tmp_new + (1.0 - valid_mask)*tmp_old for tmp_new, tmp_old in zip(tmp_state, states[tmp_layer])]
+            
+            new_states.append(tmp_state)
+            tmp_input = tmp_output
+        
+        # [S B d], the output at the last valid step
+        new_output = valid_mask*tmp_output + (1.0 - valid_mask)*output
+        
+        return t + 1, new_states, new_output
+    
+    _, _, last_output = tf.while_loop(loop_cond,
+                                      loop_body,
+                                      [tf.constant(0), ini_states, ini_output])
+    # [S B d]
+    return last_output
+
+def block_rnn(x, 
+              dim_layers, 
+              scope, 
+              dropout_keep_prob, 
+              cell_type,
+              bool_fused,
+              seed = 1):
+    '''
+    CPU-efficient counterpart of plain_rnn on the block kernels of tf.contrib.rnn.
+    
+    Argu.:
+      x: [B T D] 
+      dim_layers: [int]
+      dropout_keep_prob: float 
+      cell_type: lstm, gru
+      bool_fused: 
+        False, LSTMBlockCell or GRUBlockCellV2 with the same DropoutWrapper as plain_rnn
+        True, LSTMBlockFusedCell, the whole sequence in one kernel, 
+              the state dropout inside the sequence is not accessible, 
+              only the inputs of the upper layers are dropped out, once, as the input dropout of plain_rnn, 
+              and the emitted outputs are not dropped out; 
+              gru has no fused kernel and falls back to GRUBlockCellV2
+    '''
+    # stabilize the network by fixing random seeds
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
+    
+    hiddens = x
+    
+    for i in range(len(dim_layers)):
+        
+        with tf.variable_scope(scope if i == 0 else scope + str(i), 
+                               initializer = tf.contrib.keras.initializers.glorot_normal(seed = seed)):
+            
+            if bool_fused == True and cell_type == 'lstm':
+                
+                # dropout between layers only, no dropout on the input of the first layer, as plain_rnn
+                if i != 0:
+                    hiddens = tf.nn.dropout(hiddens, 
+                                            dropout_keep_prob, 
+                                            seed = seed)
+                
+                fused_cell = tf.contrib.rnn.LSTMBlockFusedCell(dim_layers[i],
+                                                               forget_bias = 1.0)
+                # time major [T B d]
+                tmp_hiddens, state = fused_cell(tf.transpose(hiddens, [1, 0, 2]), 
+                                                dtype = tf.float32)
+                # [B T d]
+                hiddens = tf.transpose(tmp_hiddens, [1, 0, 2])
+            else:
+                
+                if cell_type == 'lstm':
+                    tmp_cell = tf.contrib.rnn.LSTMBlockCell(dim_layers[i], 
+                                                            forget_bias = 1.0)
+                elif cell_type == 'gru':
+                    tmp_cell = tf.contrib.rnn.GRUBlockCellV2(dim_layers[i])
+                
+                # !! only dropout on hidden states in the first layer !!
+                # dropout on both input and hidden states in the others
+                rnn_cell = tf.nn.rnn_cell.DropoutWrapper(tmp_cell,
+                                                         input_keep_prob = 1.0 if i == 0 else dropout_keep_prob,
+                                                         state_keep_prob = dropout_keep_prob, 
+                                                         seed = seed)
+                hiddens, state = tf.nn.dynamic_rnn(cell = rnn_cell, 
+                                                   inputs = hiddens, 
+                                                   dtype = tf.float32)
+    return hiddens, state
+
 def plain_rnn(x, 
               dim_layers, 
               scope, 
               dropout_keep_prob, 
-              cell_type):
+              cell_type,
+              seed = 1):
     '''
     Argu.:
       x: [B T D] 
@@ -325,21 +603,21 @@ def plain_rnn(x,
       cell_type: lstm, gru
     '''
     # stabilize the network by fixing random seeds
-    np.random.seed(1)
-    tf.set_random_seed(1)
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
     
     with tf.variable_scope(scope):
         
         if cell_type == 'lstm':
             tmp_cell = tf.nn.rnn_cell.LSTMCell(dim_layers[0], 
-                                               initializer = tf.contrib.keras.initializers.glorot_normal(seed = 1))
+                                               initializer = tf.contrib.keras.initializers.glorot_normal(seed = seed))
         elif cell_type == 'gru':
             tmp_cell = tf.nn.rnn_cell.GRUCell(dim_layers[0],
-                                              kernel_initializer = tf.contrib.keras.initializers.glorot_normal(seed = 1))
+                                              kernel_initializer = tf.contrib.keras.initializers.glorot_normal(seed = seed))
         # !! only dropout on hidden states !!
         rnn_cell = tf.nn.rnn_cell.DropoutWrapper(tmp_cell,
                                                  state_keep_prob = dropout_keep_prob, 
-                                                 seed = 1)
+                                                 seed = seed)
             
         hiddens, state = tf.nn.dynamic_rnn(cell = rnn_cell, 
                                            inputs = x, 
@@ -350,16 +628,16 @@ def plain_rnn(x,
             
             if cell_type == 'lstm':
                 tmp_cell = tf.nn.rnn_cell.LSTMCell(dim_layers[i], 
-                                                   initializer= tf.contrib.keras.initializers.glorot_normal(seed = 1))
+                                                   initializer= tf.contrib.keras.initializers.glorot_normal(seed = seed))
             elif cell_type == 'gru':
                 tmp_cell = tf.nn.rnn_cell.GRUCell(dim_layers[i],
-                                                  kernel_initializer= tf.contrib.keras.initializers.glorot_normal(seed = 1))
+                                                  kernel_initializer= tf.contrib.keras.initializers.glorot_normal(seed = seed))
             
             # dropout on both input and hidden states
             rnn_cell = tf.nn.rnn_cell.DropoutWrapper(tmp_cell,
                                                      input_keep_prob = dropout_keep_prob,
                                                      state_keep_prob = dropout_keep_prob, 
-                                                     seed = 1)
+                                                     seed = seed)
             
             hiddens, state = tf.nn.dynamic_rnn(cell = rnn_cell, 
                                                inputs = hiddens, 
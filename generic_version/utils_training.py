@@ -308,10 +308,12 @@ def snapshot_selection(train_log,
                        snapshot_num,
                        total_step_num, 
                        metric_idx, 
-                       val_snapshot_num):
+                       val_snapshot_num,
+                       cycle_steps = []):
     '''
     Argu.:
       train_log: [[step, tr_metric, val_metric, epoch]] 
+      cycle_steps: if not empty, the bayes steps are these steps, e.g. from cyclical_snapshot_steps
     '''
     full_steps = [k[0] for k in train_log]
     
@@ -322,8 +324,12 @@ def snapshot_selection(train_log,
         step_error_pairs.append([tmp_record[0], tmp_record[2][metric_idx]])
         
     # -- bayes steps    
-    bayes_steps = [i for i in full_steps if i >= (total_step_num - snapshot_num)]  
-    bayes_steps_features = [ [k[2]] for k in train_log if k[0] >= (total_step_num - snapshot_num) ]
+    if len(cycle_steps) != 0:
+        bayes_steps = [i for i in full_steps if i in cycle_steps]
+        bayes_steps_features = [ [k[2]] for k in train_log if k[0] in cycle_steps ]
+    else:
+        bayes_steps = [i for i in full_steps if i >= (total_step_num - snapshot_num)]  
+        bayes_steps_features = [ [k[2]] for k in train_log if k[0] >= (total_step_num - snapshot_num) ]
     
     # -- top steps
     snapshot_steps = full_steps[:len(bayes_steps)]
@@ -337,6 +343,72 @@ def snapshot_selection(train_log,
            val_error,\
            step_error_pairs
 
+def cyclical_snapshot_steps(para_train):
+    '''
+    Epochs at the low step-size end of each cycle of the cyclical schedule,
+    the last "para_lr_cycle_snapshot_num" epochs of each cycle within its sampling phase.
+    '''
+    cycle_epochs = 1.0*para_train['para_n_epoch']/para_train['para_lr_cycle_num']
+    
+    steps = []
+    for tmp_cycle in range(para_train['para_lr_cycle_num']):
+        
+        tmp_st = int(np.ceil(tmp_cycle*cycle_epochs + para_train['para_lr_cycle_explore_ratio']*cycle_epochs))
+        # the last epoch ending within the cycle
+        tmp_ed = int(np.floor((tmp_cycle + 1)*cycle_epochs + 1e-8))
+        
+        steps += list(range(max(tmp_st, tmp_ed - para_train['para_lr_cycle_snapshot_num']), min(tmp_ed, para_train['para_n_epoch'])))
+    return steps
+
+# ----- step-level samples
+
+class step_sample_reservoir(object):
+    
+    def __init__(self,
+                 size,
+                 burnin,
+                 interval,
+                 random_seed = 1):
+        '''
+        Bounded reservoir of the samples collected at batch steps, 
+        uniform over all the thinned steps after the burn-in.
+        
+        Argu.:
+          size: maximum number of kept samples
+          burnin: number of batch steps before the collection
+          interval: thinning interval in batch steps
+        '''
+        self.size = size
+        self.burnin = burnin
+        self.interval = interval
+        self.rand = np.random.RandomState(random_seed)
+        
+        # [K] batch steps and samples
+        self.steps = []
+        self.samples = []
+        # number of collected steps, including the replaced ones
+        self.num_seen = 0
+        # variable names for the weight samples
+        self.names = []
+        
+    def bool_collect(self,
+                     step):
+        return self.interval > 0 and step > self.burnin and (step - self.burnin) % self.interval == 0
+    
+    def add(self,
+            step,
+            sample):
+        # reservoir sampling, ref: Vitter, "Random sampling with a reservoir", 1985
+        self.num_seen += 1
+        if len(self.samples) < self.size:
+            self.steps.append(step)
+            self.samples.append(sample)
+        else:
+            tmp_idx = self.rand.randint(0, self.num_seen)
+            if tmp_idx < self.size:
+                self.steps[tmp_idx] = step
+                self.samples[tmp_idx] = sample
+        
 # ----- data loader
 
 class data_loader(object):